@@ -0,0 +1,172 @@
+# accounts/idempotency.py
+"""
+Идемпотентные POST по заголовку Idempotency-Key.
+
+Первый запрос с ключом записывает заготовку IdempotencyKey, выполняется и
+сохраняет код и тело ответа. Повтор с тем же ключом и тем же телом получает
+сохранённый ответ без повторной заморозки активов; повтор, пришедший, пока
+первый ещё выполняется, — 409.
+
+Ответ сохраняется в той же транзакции, что и изменения запроса: ключ
+освобождается для повтора, только если ничего не закоммичено. Заготовка
+живёт IDEMPOTENCY_LEASE: ключ упавшего воркера не блокирует повторы на весь
+IDEMPOTENCY_KEY_TTL.
+"""
+
+import functools
+import hashlib
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+from rest_framework.response import Response
+
+from eve_backend.db import retry_on_conflict
+from .models import IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+
+
+def _request_hash(request):
+    body = json.dumps(request.data, sort_keys=True, default=str)
+    return hashlib.sha256(f"{request.method}\n{request.path}\n{body}".encode()).hexdigest()
+
+
+def _claim(request, key, request_hash):
+    """
+    Создаёт заготовку под ключ: (id, None). При конфликте — (None, существующая запись)
+    """
+    while True:
+        now = timezone.now()
+        try:
+            with transaction.atomic():
+                record = IdempotencyKey.objects.create(
+                    user=request.user, key=key, method=request.method, path=request.path[:255],
+                    request_hash=request_hash,
+                    expires_at=now + timedelta(seconds=settings.IDEMPOTENCY_LEASE),
+                )
+            return record.id, None
+        except IntegrityError:
+            record = IdempotencyKey.objects.filter(user=request.user, key=key).first()
+            if record is None:
+                continue
+            if record.expires_at <= now:
+                # Просроченный ключ или брошенная заготовка — можно использовать заново
+                IdempotencyKey.objects.filter(id=record.id, expires_at__lte=now).delete()
+                continue
+            return None, record
+
+
+def _store(claimed, response):
+    claimed.update(
+        status_code=response.status_code,
+        response=getattr(response, 'data', None),
+        expires_at=timezone.now() + timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL),
+    )
+
+
+def record_response(request, response):
+    """
+    Для @idempotent(atomic=False): вызывается внутри транзакции, коммитящей
+    изменения запроса, и сохраняет ответ вместе с ними. После коммита ключ
+    больше не освобождается; итоговый ответ view перезапишет этот.
+    """
+    claimed = getattr(request, 'idempotency_claim', None)
+    if claimed is not None:
+        _store(claimed, response)
+
+
+def idempotent(view_method=None, *, atomic=True):
+    """
+    Декоратор метода APIView/ViewSet. Без заголовка запрос выполняется как обычно.
+
+    atomic=True — view целиком выполняется в одной транзакции с сохранением
+    ответа (конфликт блокировок повторяется целиком). atomic=False — для
+    view, коммитящих по шагам (создание лота сводится после коммита): view
+    сам вызывает record_response() в транзакции своих изменений.
+    Ответы 5xx и исключения до коммита изменений не сохраняются: ключ освобождается.
+    """
+    if view_method is None:
+        return functools.partial(idempotent, atomic=atomic)
+
+    @functools.wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if not key:
+            return view_method(self, request, *args, **kwargs)
+        if len(key) > 255:
+            return Response({"error": f"{HEADER} длиннее 255 символов"}, status=400)
+
+        request_hash = _request_hash(request)
+        claim_id, record = _claim(request, key, request_hash)
+        if record is not None:
+            if record.request_hash != request_hash:
+                return Response({"error": f"{HEADER} уже использован с другим запросом"}, status=422)
+            if record.status_code is None:
+                return Response({"error": "Запрос с этим ключом ещё выполняется"}, status=409)
+            response = Response(record.response, status=record.status_code)
+            response['Idempotent-Replayed'] = 'true'
+            return response
+
+        # По id заготовки: после истечения аренды ключ мог занять повтор
+        claimed = IdempotencyKey.objects.filter(id=claim_id, status_code__isnull=True)
+        if atomic:
+            return _run_atomic(self, request, claimed, view_method, args, kwargs)
+        return _run_steps(self, request, claim_id, view_method, args, kwargs)
+
+    return wrapper
+
+
+def _run_atomic(self, request, claimed, view_method, args, kwargs):
+    @retry_on_conflict('idempotent')
+    def run():
+        with transaction.atomic():
+            response = view_method(self, request, *args, **kwargs)
+            # Ошибка внутри (в т.ч. пойманная view после atomic(savepoint=False))
+            # или 5xx — изменения откатываются вместе с ответом
+            if response.status_code >= 500 or connection.needs_rollback:
+                transaction.set_rollback(True)
+                return response, False
+            _store(claimed, response)
+            return response, True
+
+    try:
+        response, stored = run()
+    except Exception as exc:
+        # Ошибки API (400/403/404) сохраняются как ответ, остальное освобождает ключ
+        try:
+            response = self.handle_exception(exc)
+        except Exception:
+            claimed.delete()
+            raise
+        stored = False
+
+    if not stored:
+        # Изменения view откатились: сохраняется только ответ 4xx
+        if response.status_code >= 500:
+            claimed.delete()
+        else:
+            _store(claimed, response)
+    return response
+
+
+def _run_steps(self, request, claim_id, view_method, args, kwargs):
+    pending = IdempotencyKey.objects.filter(id=claim_id, status_code__isnull=True)
+    request.idempotency_claim = IdempotencyKey.objects.filter(id=claim_id)
+    try:
+        response = view_method(self, request, *args, **kwargs)
+    except Exception as exc:
+        try:
+            response = self.handle_exception(exc)
+        except Exception:
+            # Ответ, сохранённый с изменениями, остаётся: повтор получит его
+            pending.delete()
+            raise
+
+    if response.status_code >= 500:
+        pending.delete()
+    else:
+        _store(request.idempotency_claim, response)
+    return response
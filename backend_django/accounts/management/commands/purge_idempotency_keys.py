@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from accounts.models import IdempotencyKey
+
+
+class Command(BaseCommand):
+    help = "Удаляет просроченные ключи идемпотентности пачками"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=5000, help="Ключей в одном DELETE")
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        now = timezone.now()
+        total = 0
+
+        while True:
+            ids = list(
+                IdempotencyKey.objects.filter(expires_at__lte=now)
+                .values_list('id', flat=True)[:chunk_size]
+            )
+            if not ids:
+                break
+            IdempotencyKey.objects.filter(id__in=ids).delete()
+            total += len(ids)
+
+        self.stdout.write(f"Удалено ключей: {total}")
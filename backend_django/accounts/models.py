@@ -2,6 +2,7 @@
 import secrets
 
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
 from django.db.models import Q
 from django.utils.crypto import get_random_string
@@ -68,4 +69,28 @@ class AutomatToken(models.Model):
         super().save(*args, **kwargs)
 
     def __str__(self):
-        return f"{self.user.login} token"
\ No newline at end of file
+        return f"{self.user.login} token"
+
+class IdempotencyKey(models.Model):
+    """
+    Сохранённый ответ на запрос с заголовком Idempotency-Key.
+    Повтор с тем же ключом получает этот ответ, не выполняя запрос снова.
+    status_code = NULL — первый запрос ещё выполняется.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='idempotency_keys')
+    key = models.CharField(max_length=255)
+    method = models.CharField(max_length=8)
+    path = models.CharField(max_length=255)
+    request_hash = models.CharField(max_length=64, help_text="sha256 метода, пути и тела запроса")
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    response = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='idempotency_user_key_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id}:{self.key} → {self.status_code}"
@@ -1,3 +1,68 @@
-from django.test import TestCase
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from rest_framework.test import APITestCase
+
+from actors.models import Actor
+from economy.matching import reset_books
+from economy.models import Currency, MarketLot
+from economy.views import MarketLotViewSet
+from products.models import Product
+from wallet_inventory.models import FrozenInventory
+from wallet_inventory.utils import change_inventory_quantity
+from .models import IdempotencyKey, User
+
+
+class IdempotentLotCreateTests(APITestCase):
+    def setUp(self):
+        reset_books()
+        self.client.force_authenticate(User.objects.create_user(login='gm', password='x', role='master', is_staff=True))
+        gold = Currency.objects.create(name='Gold', symbol='G')
+        sword = Product.objects.create(name='Sword', price=Decimal('10'), currency=gold)
+        self.alice = Actor.objects.create(name='alice', type='npc')
+        change_inventory_quantity(self.alice, sword, 50)
+        self.data = {'actor_id': self.alice.id, 'lot_type': 'sell', 'product': sword.id,
+                     'quantity': 5, 'price_per_unit': '12', 'currency': gold.id}
+
+    def tearDown(self):
+        reset_books()
+
+    def post(self, data, key='k1'):
+        return self.client.post('/economy/market/lots/', data, format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_replay_returns_stored_response(self):
+        first = self.post(self.data)
+        second = self.post(self.data)
+
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(second.status_code, 201)
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(second.data['id'], first.data['id'])
+        self.assertEqual(MarketLot.objects.count(), 1)
+        self.assertEqual(FrozenInventory.objects.get().quantity, 5)
+
+    def test_same_key_other_body(self):
+        self.post(self.data)
+        response = self.post(dict(self.data, quantity=6))
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(MarketLot.objects.count(), 1)
+
+    def test_failure_after_commit_keeps_key(self):
+        # Лот и заморозка закоммичены, сопоставление упало: повтор не замораживает второй раз
+        with mock.patch.object(MarketLotViewSet, '_try_execute_match', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.post(self.data)
+        response = self.post(self.data)
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response['Idempotent-Replayed'], 'true')
+        self.assertEqual(MarketLot.objects.count(), 1)
+        self.assertEqual(FrozenInventory.objects.get().quantity, 5)
+
+    def test_rejected_request_is_stored(self):
+        data = dict(self.data, quantity=500)
+        self.assertEqual(self.post(data).status_code, 400)
+        response = self.post(data)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response['Idempotent-Replayed'], 'true')
+        self.assertEqual(IdempotencyKey.objects.get().status_code, 400)
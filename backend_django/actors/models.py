@@ -49,6 +49,12 @@ class Actor(models.Model):
         help_text="Роль актора в мире"
     )
 
+    # Горячие акторы (банк, налоговая): зачисления расходятся по N строкам Wallet
+    wallet_stripes = models.PositiveSmallIntegerField(
+        default=1,
+        help_text="Число полос кошелька; >1 — зачисления в случайную полосу, чтение суммирует"
+    )
+
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
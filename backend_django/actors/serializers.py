@@ -21,6 +21,7 @@ class ActorSerializer(serializers.ModelSerializer):
             'type',
             'type_display',         # "Player", "Merchant" и т.д. вместо кода
             'is_player',            # True только для type='player'
+            'wallet_stripes',       # полосы кошелька горячего актора
             'created_at',
             'updated_at',
         ]
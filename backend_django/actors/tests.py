@@ -1,3 +1,28 @@
-from django.test import TestCase
+from decimal import Decimal
 
-# Create your tests here.
+from rest_framework.test import APITestCase
+
+from accounts.models import User
+from economy.models import BrokerAccrual, Currency
+from .models import Actor
+
+
+class ActorDeleteTests(APITestCase):
+    def setUp(self):
+        self.client.force_authenticate(User.objects.create_user(login='gm', password='x', role='master', is_staff=True))
+        self.gold = Currency.objects.create(name='Gold', symbol='G')
+
+    def test_actor_with_commission_history_is_protected(self):
+        alice = Actor.objects.create(name='alice', type='npc')
+        BrokerAccrual.objects.create(payer=alice, currency=self.gold, amount=Decimal('0.48'))
+
+        response = self.client.delete(f'/actors/actors/{alice.id}/')
+
+        self.assertEqual(response.status_code, 409)
+        self.assertTrue(Actor.objects.filter(id=alice.id).exists())
+        self.assertEqual(BrokerAccrual.objects.count(), 1)
+
+    def test_actor_without_history_is_deleted(self):
+        bob = Actor.objects.create(name='bob', type='npc')
+        self.assertEqual(self.client.delete(f'/actors/actors/{bob.id}/').status_code, 204)
+        self.assertFalse(Actor.objects.filter(id=bob.id).exists())
@@ -3,7 +3,7 @@
 from rest_framework import viewsets
 from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated, IsAdminUser
-from django.db.models import Q
+from django.db.models import Q, ProtectedError
 from rest_framework.response import Response
 
 from .models import Actor
@@ -58,6 +58,16 @@ class ActorViewSet(viewsets.ModelViewSet):
 
         return qs.order_by('name')  # удобнее, чем по дате
 
+    def destroy(self, request, *args, **kwargs):
+        try:
+            return super().destroy(request, *args, **kwargs)
+        except ProtectedError:
+            # Например, начисления комиссии (economy.BrokerAccrual) — их история сохраняется
+            return Response(
+                {"error": "У актёра есть связанные финансовые записи — деактивируйте его (is_active=false)"},
+                status=409,
+            )
+
     @action(detail=False, methods=['get'], permission_classes=[IsAuthenticated])
     def me(self, request):
         actor = request.user.actor  # связь user → actor уже есть
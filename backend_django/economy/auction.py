@@ -0,0 +1,198 @@
+# economy/auction.py
+"""
+Аукцион с единой ценой (call auction) для пакетной загрузки лотов.
+
+Пакет вместе с лежащими в стакане лотами сводится по одной цене клиринга на
+каждую пару (product, currency): выбирается цена с максимальным исполнимым
+объёмом. Заморозка активов и расчёты идут агрегированными bulk-запросами.
+"""
+
+import bisect
+from collections import defaultdict
+
+from django.db import transaction
+
+from actors.models import Actor
+from eve_backend.db import retry_on_conflict
+from products.models import Product
+from wallet_inventory.escrow import EscrowRef
+from wallet_inventory.utils import bulk_freeze_inventory, bulk_freeze_wallet
+from .market_data import record_depth
+from .matching import Fill, lock_books, refresh_books, settle_fills
+from .models import Currency, MarketLot
+from .serializers import AuctionLotSerializer
+
+
+def clearing_price(buys, sells):
+    """
+    Цена клиринга для buy- и sell-лотов одной пары: (price, volume).
+    Максимизирует исполнимый объём, затем минимизирует дисбаланс спроса и
+    предложения; из оставшихся равноценных цен берётся средняя.
+    Если стороны не пересекаются — (None, 0).
+    """
+    if not buys or not sells:
+        return None, 0
+
+    buy_levels = sorted((lot.price_per_unit, lot.remaining_quantity) for lot in buys)
+    sell_levels = sorted((lot.price_per_unit, lot.remaining_quantity) for lot in sells)
+    buy_prices = [price for price, _ in buy_levels]
+    sell_prices = [price for price, _ in sell_levels]
+
+    # demand_from[i] — спрос всех покупок с ценой >= buy_prices[i]
+    demand_from = [0] * (len(buy_levels) + 1)
+    for i in range(len(buy_levels) - 1, -1, -1):
+        demand_from[i] = demand_from[i + 1] + buy_levels[i][1]
+    # supply_to[i] — предложение всех продаж с ценой <= sell_prices[i - 1]
+    supply_to = [0]
+    for _, quantity in sell_levels:
+        supply_to.append(supply_to[-1] + quantity)
+
+    best_key, candidates = None, []
+    for price in sorted(set(buy_prices) | set(sell_prices)):
+        demand = demand_from[bisect.bisect_left(buy_prices, price)]
+        supply = supply_to[bisect.bisect_right(sell_prices, price)]
+        volume = min(demand, supply)
+        if volume == 0:
+            continue
+        key = (volume, -abs(demand - supply))
+        if best_key is None or key > best_key:
+            best_key, candidates = key, [price]
+        elif key == best_key:
+            candidates.append(price)
+
+    if best_key is None:
+        return None, 0
+    return candidates[(len(candidates) - 1) // 2], best_key[0]
+
+
+def uncross(buys, sells):
+    """Сводит пару по единой цене, приоритет цена-время. Возвращает (price, fills)"""
+    price, volume = clearing_price(buys, sells)
+    if not volume:
+        return None, []
+
+    buys = sorted((lot for lot in buys if lot.price_per_unit >= price),
+                  key=lambda lot: (-lot.price_per_unit, lot.created_at, lot.id))
+    sells = sorted((lot for lot in sells if lot.price_per_unit <= price),
+                   key=lambda lot: (lot.price_per_unit, lot.created_at, lot.id))
+
+    fills = []
+    buy_left = {lot.id: lot.remaining_quantity for lot in buys}
+    sell_left = {lot.id: lot.remaining_quantity for lot in sells}
+    b = s = 0
+    while volume > 0:
+        buy_lot, sell_lot = buys[b], sells[s]
+        quantity = min(buy_left[buy_lot.id], sell_left[sell_lot.id], volume)
+        fills.append(Fill(buy_lot, sell_lot, quantity, price))
+        buy_left[buy_lot.id] -= quantity
+        sell_left[sell_lot.id] -= quantity
+        volume -= quantity
+        if buy_left[buy_lot.id] == 0:
+            b += 1
+        if sell_left[sell_lot.id] == 0:
+            s += 1
+    return price, fills
+
+
+@retry_on_conflict('auction')
+def run_auction(lots_data):
+    """
+    Создаёт лоты пакета, замораживает под них активы и проводит аукцион
+    по каждой затронутой паре (product, currency).
+    Возвращает (created_lots, errors, clearing) — clearing это список
+    {product, currency, price, volume} по парам, где была сделка.
+    """
+    errors = []
+    valid = []
+    for i, lot_data in enumerate(lots_data):
+        serializer = AuctionLotSerializer(data=lot_data)
+        if serializer.is_valid():
+            valid.append((i, serializer.validated_data))
+        else:
+            errors.append({"index": i, "error": serializer.errors})
+
+    actors = Actor.objects.in_bulk(
+        {data['actor_id'] for _, data in valid} | {data['broker'] for _, data in valid if data.get('broker')}
+    )
+    products = Product.objects.in_bulk({data['product'] for _, data in valid})
+    currencies = Currency.objects.in_bulk({data['currency'] for _, data in valid})
+
+    indexes, lots = [], []
+    for i, data in valid:
+        actor = actors.get(data['actor_id'])
+        product = products.get(data['product'])
+        currency = currencies.get(data['currency'])
+        if actor is None or product is None or currency is None:
+            errors.append({"index": i, "error": "Актёр, товар или валюта не существует"})
+            continue
+        broker = actors.get(data['broker']) if data.get('broker') else None
+        if data.get('broker') and (broker is None or not broker.is_active):
+            errors.append({"index": i, "error": "Брокер должен быть активным актором"})
+            continue
+        indexes.append(i)
+        lots.append(MarketLot(
+            actor=actor,
+            lot_type=data['lot_type'],
+            product=product,
+            quantity=data['quantity'],
+            remaining_quantity=data['quantity'],
+            price_per_unit=data['price_per_unit'],
+            currency=currency,
+            broker=broker,
+            expires_at=data.get('expires_at'),
+        ))
+
+    with transaction.atomic():
+        MarketLot.objects.bulk_create(lots)
+
+        sells = [(i, lot) for i, lot in zip(indexes, lots) if lot.lot_type == 'sell']
+        buys = [(i, lot) for i, lot in zip(indexes, lots) if lot.lot_type == 'buy']
+        failed = set()
+        for k in bulk_freeze_inventory(
+            [(lot.actor, lot.product_id, lot.quantity, EscrowRef.lot(lot.id), lot.id) for _, lot in sells]
+        ):
+            failed.add(sells[k][1].id)
+            errors.append({"index": sells[k][0], "error": "Недостаточно предметов в инвентаре"})
+        for k in bulk_freeze_wallet(
+            [(lot.actor, lot.currency_id, lot.total_price, EscrowRef.lot(lot.id), lot.id) for _, lot in buys]
+        ):
+            failed.add(buys[k][1].id)
+            errors.append({"index": buys[k][0], "error": "Недостаточно средств"})
+
+        if failed:
+            MarketLot.objects.filter(id__in=failed).delete()
+        created = {lot.id: lot for lot in lots if lot.id not in failed}
+        record_depth(opened=created.values())
+
+        # Пакет + лежащие в стакане лоты затронутых пар
+        pairs = {(lot.product_id, lot.currency_id) for lot in created.values()}
+        # Непрерывное сопоставление этих стаканов ждёт окончания аукциона
+        lock_books(pairs)
+        books = defaultdict(lambda: {'buy': [], 'sell': []})
+        resting = MarketLot.objects.live().select_for_update().filter(
+            product_id__in={product_id for product_id, _ in pairs},
+            currency_id__in={currency_id for _, currency_id in pairs},
+        )
+        for lot in resting:
+            if (lot.product_id, lot.currency_id) in pairs:
+                lot = created.get(lot.id, lot)
+                books[(lot.product_id, lot.currency_id)][lot.lot_type].append(lot)
+
+        fills, clearing, touched = [], [], list(created.values())
+        for (product_id, currency_id), book in books.items():
+            price, book_fills = uncross(book['buy'], book['sell'])
+            if book_fills:
+                fills.extend(book_fills)
+                touched.extend(lot for lot in book['buy'] + book['sell'] if lot.id not in created)
+                clearing.append({
+                    "product": product_id,
+                    "currency": currency_id,
+                    "price": price,
+                    "volume": sum(fill.quantity for fill in book_fills),
+                })
+
+        settle_fills(fills)
+        transaction.on_commit(lambda: refresh_books(touched))
+
+    errors.sort(key=lambda error: error["index"])
+    return list(created.values()), errors, clearing
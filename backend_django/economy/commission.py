@@ -0,0 +1,97 @@
+# economy/commission.py
+"""
+Комиссия брокера (README, раздел 7).
+
+Продавец платит BROKER_COMMISSION_BPS с выручки каждого исполнения брокеру
+своего лота, а если брокер не назначен — системе. Сделка только добавляет
+строки BrokerAccrual и проводки на счёт accrued: кошельки брокеров на горячем
+пути не блокируются. settle_commissions() периодически выплачивает всё
+накопленное — одним зачислением на брокера и валюту.
+"""
+
+import uuid
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from actors.models import Actor
+from eve_backend.db import retry_on_conflict
+from eve_backend.money import Money, to_minor
+from wallet_inventory import ledger
+from wallet_inventory.utils import bulk_change_wallet, lock_balances
+from .models import BrokerAccrual, BrokerPayout
+
+ACCRUAL = BrokerAccrual._meta.db_table
+
+
+def commission(amount):
+    """Комиссия с суммы исполнения, с округлением вниз до минимальной единицы"""
+    return Money.from_minor(to_minor(amount) * settings.BROKER_COMMISSION_BPS // 10_000)
+
+
+def accrue(accruals):
+    """Записывает начисления (список BrokerAccrual) одной вставкой и проводками на accrued"""
+    if not accruals:
+        return
+    BrokerAccrual.objects.bulk_create(accruals)
+    with ledger.operation('commission') as op:
+        for accrual in accruals:
+            op.add(accrual.broker_id, 'accrued', accrual.amount, None, accrual.currency_id)
+
+
+def system_actor():
+    """Получатель комиссии по лотам без брокера — первый активный системный актор"""
+    return Actor.objects.filter(is_system=True, is_active=True).order_by('id').first()
+
+
+# Пометка и сумма невыплаченного — один запрос: UPDATE видит только
+# закоммиченные начисления, поэтому выплачивается ровно то, что помечено
+_SETTLE = f"""
+    WITH paid AS (
+        UPDATE {ACCRUAL} SET payout = %s
+        WHERE payout IS NULL {{brokers}}
+        RETURNING broker_id, currency_id, amount
+    )
+    SELECT broker_id, currency_id, SUM(amount), COUNT(*) FROM paid GROUP BY broker_id, currency_id
+"""
+
+
+@retry_on_conflict('settle_commissions')
+def settle_commissions():
+    """
+    Выплачивает невыплаченные начисления: каждый брокер (и системный актор
+    за лоты без брокера) получает одно зачисление на валюту. Без системного
+    актора доля системы копится до его появления.
+    Возвращает созданные BrokerPayout или None, если выплату уже проводит другой процесс.
+    """
+    with transaction.atomic():
+        if not ledger.try_lock('settle_commissions'):
+            return None
+
+        system = system_actor()
+        batch = uuid.uuid4()
+        with connection.cursor() as cursor:
+            cursor.execute(_SETTLE.format(brokers="" if system else "AND broker_id IS NOT NULL"), [batch])
+            rows = cursor.fetchall()
+        if not rows:
+            return []
+
+        payouts = [
+            BrokerPayout(
+                batch=batch, broker_id=broker_id, recipient_id=broker_id or system.id,
+                currency_id=currency_id, amount=Money.from_minor(total), accruals=count,
+            )
+            for broker_id, currency_id, total, count in rows
+        ]
+        credits = defaultdict(int)
+        for payout in payouts:
+            credits[(payout.recipient_id, payout.currency_id)] += payout.amount
+
+        with ledger.operation('commission:payout') as op:
+            lock_balances(wallet_keys=credits)
+            bulk_change_wallet(credits)
+            for payout in payouts:
+                op.add(payout.broker_id, 'accrued', -payout.amount, None, payout.currency_id)
+        BrokerPayout.objects.bulk_create(payouts)
+        return payouts
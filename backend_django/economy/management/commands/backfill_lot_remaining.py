@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+
+from economy.market_data import rebuild_depth
+from economy.models import MarketLot
+
+
+class Command(BaseCommand):
+    help = (
+        "Заполняет remaining_quantity у лотов, созданных до частичного исполнения: "
+        "миграция ставит им 0, активным возвращается полное количество, закрытые "
+        "остаются с 0. Нужен один раз — сразу после migrate, до запуска воркеров и expire_lots"
+    )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            # Остатка 0 у активного лота не бывает: исполненный целиком получает completed
+            opened = MarketLot.objects.filter(status='active', remaining_quantity=0).update(
+                remaining_quantity=F('quantity'),
+            )
+            rebuild_depth()
+        self.stdout.write(f"Восстановлен остаток активных лотов: {opened}")
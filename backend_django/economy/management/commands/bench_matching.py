@@ -0,0 +1,287 @@
+import math
+import queue
+import random
+import threading
+import time
+from collections import defaultdict
+from decimal import Decimal
+from types import SimpleNamespace
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from actors.models import Actor
+from economy.models import Currency, MarketLot
+from economy.serializers import MarketLotSerializer
+from economy.views import MarketLotViewSet
+from eve_backend import metrics
+from products.models import Product
+from wallet_inventory import batch
+from wallet_inventory.escrow import EscrowRef
+from wallet_inventory.utils import bulk_freeze_inventory, bulk_freeze_wallet
+
+PREFIX = 'bench-'
+TICK = Decimal('0.01')
+
+
+class OrderFlow:
+    """
+    Синтетический поток заявок: пуассоновские моменты прихода, цена вокруг
+    случайного блуждания середины, доля покупок buy_skew.
+    """
+
+    def __init__(self, rng, rate, mid, volatility, spread, buy_skew, max_quantity):
+        self.rng = rng
+        self.rate = rate
+        self.mid = mid
+        self.volatility = volatility
+        self.spread = spread
+        self.buy_skew = buy_skew
+        self.max_quantity = max_quantity
+        self.clock = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        # rate = 0 — замкнутый цикл: следующая заявка сразу после предыдущей
+        if self.rate > 0:
+            self.clock += self.rng.expovariate(self.rate)
+        self.mid = max(self.mid + self.rng.gauss(0, self.volatility), self.spread + 1)
+
+        lot_type = 'buy' if self.rng.random() < self.buy_skew else 'sell'
+        # Заявка ставится по обе стороны середины: часть пересекает стакан, часть ложится в него
+        price = Decimal(self.mid + self.rng.uniform(-self.spread, self.spread)).quantize(TICK)
+        return self.clock, lot_type, max(price, TICK), self.rng.randint(1, self.max_quantity)
+
+
+class QueryCounter:
+    """Считает запросы текущего потока (без журнала запросов и его лимита)"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        self.count = 0
+        self._wrapper = connection.execute_wrapper(self)
+        self._wrapper.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self._wrapper.__exit__(*exc)
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))]
+
+
+class Command(BaseCommand):
+    help = (
+        "Нагрузочный прогон движка сопоставления на синтетическом потоке заявок: "
+        "orders/sec, задержка размещения p50/p99 и запросы к БД на заявку. "
+        "Работает в отдельной базе test_<DB_NAME>, как тесты; настроенная БД не затрагивается."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=2000, help="Заявок через perform_create")
+        parser.add_argument('--rate', type=float, default=0.0,
+                            help="Интенсивность пуассоновского потока, заявок/сек (0 — как можно быстрее)")
+        parser.add_argument('--threads', type=int, default=1, help="Параллельных размещающих потоков")
+        parser.add_argument('--actors', type=int, default=20, help="Участников рынка")
+        parser.add_argument('--mid', type=float, default=100.0, help="Начальная середина цены")
+        parser.add_argument('--volatility', type=float, default=0.05, help="Шаг случайного блуждания середины")
+        parser.add_argument('--spread', type=float, default=1.0, help="Разброс цены заявки вокруг середины")
+        parser.add_argument('--buy-skew', type=float, default=0.5, help="Доля заявок на покупку")
+        parser.add_argument('--max-quantity', type=int, default=10, help="Максимальный объём заявки")
+        parser.add_argument('--trades', type=int, default=500, help="Прямых вызовов _execute_trade")
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--keep', action='store_true',
+                            help="Не удалять базу прогона; следующий прогон использует её же")
+
+    def handle(self, *args, **options):
+        if options['threads'] < 1 or options['orders'] < 0 or not 0 <= options['buy_skew'] <= 1:
+            raise CommandError("threads >= 1, orders >= 0, 0 <= buy-skew <= 1")
+
+        rng = random.Random(options['seed'])
+        # Прогон сеет активы и удаляет свои данные — только в собственной базе,
+        # а не в настроенной (там удаление акторов унесло бы проводки журнала)
+        configured = connection.settings_dict['NAME']
+        try:
+            bench_db = connection.creation.create_test_db(verbosity=0, keepdb=options['keep'], serialize=False)
+        except Exception as e:
+            raise CommandError(f"Не удалось создать базу прогона для {configured}: {e}")
+        if bench_db == configured:
+            raise CommandError(f"База прогона совпадает с настроенной: {configured}")
+        self.stdout.write(f"База прогона: {bench_db}")
+        try:
+            env = self.setup(options)
+            if options['orders']:
+                self.bench_placement(env, rng, options)
+            if options['trades']:
+                self.bench_trades(env, rng, options)
+        finally:
+            if not options['keep']:
+                connection.creation.destroy_test_db(configured, verbosity=0)
+
+    # ---------- окружение ----------
+
+    def setup(self, options):
+        suffix = f"{time.time_ns()}"
+        user = get_user_model().objects.create_user(login=f"{PREFIX}{suffix}", role='master')
+        currency = Currency.objects.create(name=f"{PREFIX}{suffix}", symbol='BN')
+        product = Product.objects.create(name=f"{PREFIX}{suffix}", price=Decimal(options['mid']).quantize(TICK), currency=currency)
+        actors = Actor.objects.bulk_create([
+            Actor(name=f"{PREFIX}{suffix}-{i}", type='npc') for i in range(options['actors'])
+        ])
+        # Запас с избытком: заявки не должны отклоняться из-за нехватки активов.
+        # Через пакетное начисление — с проводками, как у /internal/batch/update/
+        batch.apply(
+            [(0, a.id, product.id, None, 10 ** 8) for a in actors]
+            + [(0, a.id, None, currency.id, Decimal(10 ** 9)) for a in actors]
+        )
+        return SimpleNamespace(user=user, currency=currency, product=product, actors=actors)
+
+    def view(self, env):
+        view = MarketLotViewSet()
+        view.request = SimpleNamespace(user=env.user)
+        view.format_kwarg = None
+        return view
+
+    # ---------- размещение: perform_create + _try_execute_match ----------
+
+    def bench_placement(self, env, rng, options):
+        flow = OrderFlow(
+            rng, options['rate'], options['mid'], options['volatility'], options['spread'],
+            options['buy_skew'], options['max_quantity'],
+        )
+        orders = queue.Queue()
+        for _ in range(options['orders']):
+            arrival, lot_type, price, quantity = next(flow)
+            orders.put((arrival, {
+                'actor_id': rng.choice(env.actors).id,
+                'lot_type': lot_type,
+                'product': env.product.id,
+                'quantity': quantity,
+                'price_per_unit': price,
+                'currency': env.currency.id,
+            }))
+
+        stats = defaultdict(list)
+        lock = threading.Lock()
+        retries = metrics.snapshot()
+        started = time.perf_counter()
+
+        def worker():
+            view = self.view(env)
+            latencies, match_times, queries, fills, errors = [], [], [], 0, 0
+            try_execute_match = view._try_execute_match
+
+            def timed_match(lot):
+                t0 = time.perf_counter()
+                result = try_execute_match(lot)
+                match_times.append(time.perf_counter() - t0)
+                return result
+
+            view._try_execute_match = timed_match
+            while True:
+                try:
+                    arrival, data = orders.get_nowait()
+                except queue.Empty:
+                    break
+                # Открытый поток: задержка считается от планового прихода заявки
+                delay = started + arrival - time.perf_counter()
+                if options['rate'] > 0 and delay > 0:
+                    time.sleep(delay)
+                t0 = started + arrival if options['rate'] > 0 else time.perf_counter()
+
+                serializer = MarketLotSerializer(data=data)
+                serializer.is_valid(raise_exception=True)
+                with QueryCounter() as counter:
+                    try:
+                        view.perform_create(serializer)
+                    except Exception:
+                        errors += 1
+                        continue
+                latencies.append(time.perf_counter() - t0)
+                queries.append(counter.count)
+                fills += serializer.instance.quantity - serializer.instance.remaining_quantity
+
+            connection.close()
+            with lock:
+                stats['latency'] += latencies
+                stats['match'] += match_times
+                stats['queries'] += queries
+                stats['filled'].append(fills)
+                stats['errors'].append(errors)
+
+        threads = [threading.Thread(target=worker) for _ in range(options['threads'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        placed = len(stats['latency'])
+        self.stdout.write(self.style.MIGRATE_HEADING("Размещение (perform_create → _try_execute_match)"))
+        self.stdout.write(f"  заявок: {placed}, ошибок: {sum(stats['errors'])}, потоков: {options['threads']}")
+        self.stdout.write(f"  исполнено единиц при размещении: {sum(stats['filled'])}, "
+                          f"активных лотов: {MarketLot.objects.filter(product=env.product, status='active').count()}")
+        self.report(placed, elapsed, stats['latency'], stats['queries'])
+        self.stdout.write(f"  из них сопоставление: p50 {percentile(stats['match'], 50) * 1000:.2f} ms, "
+                          f"p99 {percentile(stats['match'], 99) * 1000:.2f} ms")
+        retried = {
+            key: value - retries.get(key, 0) for key, value in metrics.snapshot().items()
+            if key.startswith('db_retry') and value != retries.get(key, 0)
+        }
+        self.stdout.write(f"  повторы транзакций: {retried or 'нет'}")
+
+    # ---------- прямое исполнение: _execute_trade ----------
+
+    def bench_trades(self, env, rng, options):
+        count = options['trades']
+        price = Decimal(options['mid']).quantize(TICK)
+        buyers = [rng.choice(env.actors) for _ in range(count)]
+        sellers = [rng.choice(env.actors) for _ in range(count)]
+
+        # Пары встречных лотов кладутся в БД в обход стакана, чтобы мерить только сделку
+        lots = MarketLot.objects.bulk_create(
+            [MarketLot(actor=a, lot_type='buy', product=env.product, currency=env.currency, quantity=1,
+                       remaining_quantity=1, price_per_unit=price) for a in buyers]
+            + [MarketLot(actor=a, lot_type='sell', product=env.product, currency=env.currency, quantity=1,
+                         remaining_quantity=1, price_per_unit=price) for a in sellers]
+        )
+        buy_lots, sell_lots = lots[:count], lots[count:]
+        with transaction.atomic():
+            bulk_freeze_wallet([(lot.actor, env.currency.id, price, EscrowRef.lot(lot.id), lot.id) for lot in buy_lots])
+            bulk_freeze_inventory([(lot.actor, env.product.id, 1, EscrowRef.lot(lot.id), lot.id) for lot in sell_lots])
+
+        view = self.view(env)
+        latencies, queries = [], []
+        started = time.perf_counter()
+        for buy_lot, sell_lot in zip(buy_lots, sell_lots):
+            t0 = time.perf_counter()
+            with QueryCounter() as counter, transaction.atomic():
+                view._execute_trade(buy_lot, sell_lot, 1, price)
+            latencies.append(time.perf_counter() - t0)
+            queries.append(counter.count)
+        elapsed = time.perf_counter() - started
+
+        self.stdout.write(self.style.MIGRATE_HEADING("Исполнение (_execute_trade)"))
+        self.stdout.write(f"  сделок: {count}")
+        self.report(count, elapsed, latencies, queries)
+
+    def report(self, count, elapsed, latencies, queries):
+        self.stdout.write(f"  время: {elapsed:.2f} s, {count / elapsed if elapsed else 0:.1f} в секунду")
+        self.stdout.write(
+            f"  задержка: p50 {percentile(latencies, 50) * 1000:.2f} ms, "
+            f"p99 {percentile(latencies, 99) * 1000:.2f} ms, max {max(latencies, default=0) * 1000:.2f} ms"
+        )
+        self.stdout.write(f"  запросов на операцию: {sum(queries) / len(queries) if queries else 0:.1f}")
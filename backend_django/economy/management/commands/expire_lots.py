@@ -0,0 +1,48 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from economy.matching import close_lots
+from economy.models import MarketLot
+from eve_backend.db import retry_on_conflict
+
+
+class Command(BaseCommand):
+    help = "Снимает истёкшие лоты (status=expired) и возвращает их escrow пачками"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help="Лотов в одной транзакции")
+        parser.add_argument('--loop', action='store_true', help="Работать постоянно, как фоновый воркер")
+        parser.add_argument('--interval', type=float, default=10.0, help="Пауза между проходами в режиме --loop, сек")
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+
+        while True:
+            total = 0
+            while True:
+                expired = self.expire_chunk(chunk_size)
+                total += expired
+                if expired < chunk_size:
+                    break
+
+            if total:
+                self.stdout.write(f"Истекло лотов: {total}")
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+    @staticmethod
+    @retry_on_conflict('expire_lots')
+    def expire_chunk(chunk_size):
+        with transaction.atomic():
+            # Частичный индекс marketlot_active_expiry_idx; занятые другими транзакциями лоты пропускаем
+            lots = list(
+                MarketLot.objects.select_for_update(skip_locked=True)
+                .filter(status='active', expires_at__isnull=False, expires_at__lte=timezone.now())
+                .order_by('expires_at')[:chunk_size]
+            )
+            close_lots(lots, 'expired')
+        return len(lots)
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from economy.market_data import rebuild_depth
+from economy.models import MarketDepthLevel
+
+
+class Command(BaseCommand):
+    help = "Пересобирает агрегат глубины рынка (MarketDepthLevel) из активных лотов"
+
+    def handle(self, *args, **options):
+        rebuild_depth()
+        self.stdout.write(self.style.SUCCESS(f"Уровней стакана: {MarketDepthLevel.objects.count()}"))
@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from economy.commission import settle_commissions
+
+
+class Command(BaseCommand):
+    help = (
+        "Выплачивает накопленную комиссию брокерам и системе: "
+        "одно зачисление на получателя и валюту"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help="Работать постоянно, как фоновый воркер")
+        parser.add_argument('--interval', type=float, default=300.0, help="Пауза между проходами в режиме --loop, сек")
+
+    def handle(self, *args, **options):
+        while True:
+            payouts = settle_commissions()
+            if payouts is None:
+                self.stdout.write("Выплату уже проводит другой процесс")
+            else:
+                total = sum(payout.accruals for payout in payouts)
+                self.stdout.write(f"Выплат: {len(payouts)}, начислений: {total}")
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
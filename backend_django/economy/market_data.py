@@ -0,0 +1,261 @@
+# economy/market_data.py
+"""
+Рыночные данные, которые поддерживаются инкрементально при изменении лотов,
+чтобы чтение не требовало сканировать MarketLot.
+"""
+
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Max, Min, Q
+from django.utils import timezone
+
+from eve_backend.events import publish
+from eve_backend.money import Money, to_minor
+from products.models import Product
+from .models import Candle, MarketDepthLevel, MarketLot, Trade
+
+# Интервалы свечей: усечение времени сделки до начала интервала
+CANDLE_BUCKETS = {
+    '1m': lambda ts: ts.replace(second=0, microsecond=0),
+    '1h': lambda ts: ts.replace(minute=0, second=0, microsecond=0),
+    '1d': lambda ts: ts.replace(hour=0, minute=0, second=0, microsecond=0),
+}
+
+
+class DepthDelta:
+    """Накапливает изменения уровней стакана и применяет их одним upsert"""
+
+    def __init__(self):
+        # (product_id, currency_id, side, price) -> [quantity, lot_count]
+        self._levels = defaultdict(lambda: [0, 0])
+
+    def add(self, lot, quantity, lots=0):
+        level = self._levels[(lot.product_id, lot.currency_id, lot.lot_type, lot.price_per_unit)]
+        level[0] += quantity
+        level[1] += lots
+
+    def opened(self, lot):
+        """Лот встал в стакан с текущим остатком"""
+        self.add(lot, lot.remaining_quantity, 1)
+
+    def closed(self, lot):
+        """Лот ушёл из стакана (отмена, истечение) с текущим остатком"""
+        self.add(lot, -lot.remaining_quantity, -1)
+
+    def apply(self):
+        # Строки уровней блокируются в едином порядке (product, currency, side, price):
+        # встречные расчёты по тем же уровням ждут друг друга, а не взаимоблокируются
+        levels = {key: value for key, value in sorted(self._levels.items()) if value != [0, 0]}
+        self._levels.clear()
+        if not levels:
+            return
+
+        table = MarketDepthLevel._meta.db_table
+        columns = list(zip(*(
+            (product_id, currency_id, side, to_minor(price), *value)
+            for (product_id, currency_id, side, price), value in levels.items()
+        )))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {table} (product_id, currency_id, side, price, quantity, lot_count)
+                SELECT product_id, currency_id, side, price, quantity, lot_count
+                FROM unnest(%s::bigint[], %s::bigint[], %s::varchar[], %s::bigint[], %s::bigint[], %s::int[])
+                    WITH ORDINALITY AS level(product_id, currency_id, side, price, quantity, lot_count, n)
+                ORDER BY n
+                ON CONFLICT (product_id, currency_id, side, price) DO UPDATE
+                SET quantity = {table}.quantity + EXCLUDED.quantity,
+                    lot_count = {table}.lot_count + EXCLUDED.lot_count
+                RETURNING id, product_id, currency_id, side, price, quantity, lot_count
+                """,
+                [list(column) for column in columns],
+            )
+            rows = cursor.fetchall()
+
+        empty = [row[0] for row in rows if row[5] <= 0]
+        if empty:
+            MarketDepthLevel.objects.filter(id__in=empty, quantity__lte=0).delete()
+
+        # Уровни отдаются абсолютными значениями; 0 — уровень исчез
+        publish([
+            {"type": "book", "product": product_id, "currency": currency_id, "side": side,
+             "price": Money.from_minor(price), "quantity": max(quantity, 0), "lots": max(lot_count, 0)}
+            for _, product_id, currency_id, side, price, quantity, lot_count in rows
+        ])
+
+        invalidate_top_of_book({product_id for product_id, *_ in levels})
+
+
+def record_depth(opened=(), closed=()):
+    """Короткая запись для одиночных изменений стакана"""
+    delta = DepthDelta()
+    for lot in opened:
+        delta.opened(lot)
+    for lot in closed:
+        delta.closed(lot)
+    delta.apply()
+
+
+@transaction.atomic
+def rebuild_depth():
+    """Пересобирает агрегат стакана целиком из активных лотов"""
+    MarketDepthLevel.objects.all().delete()
+    delta = DepthDelta()
+    for lot in MarketLot.objects.filter(status='active', remaining_quantity__gt=0).only(
+        'product_id', 'currency_id', 'lot_type', 'price_per_unit', 'remaining_quantity'
+    ).iterator():
+        delta.opened(lot)
+    delta.apply()
+
+
+def record_trades(fills):
+    """
+    Записывает ленту сделок и обновляет свечи всех интервалов.
+    Свечи пачки агрегируются в памяти и вливаются одним upsert:
+    open сохраняется, high/low расширяются, close и объём обновляются.
+    """
+    if not fills:
+        return
+
+    now = timezone.now()
+    trades = Trade.objects.bulk_create([
+        Trade(
+            buy_lot_id=buy_lot.id,
+            sell_lot_id=sell_lot.id,
+            buyer_id=buy_lot.actor_id,
+            seller_id=sell_lot.actor_id,
+            product_id=sell_lot.product_id,
+            currency_id=sell_lot.currency_id,
+            quantity=quantity,
+            price=price,
+            created_at=now,
+        )
+        for buy_lot, sell_lot, quantity, price in fills
+    ])
+
+    # (product_id, currency_id, interval, bucket) -> [open, high, low, close, volume, trade_count]
+    candles = {}
+    for _, sell_lot, quantity, price in fills:
+        for interval, truncate in CANDLE_BUCKETS.items():
+            key = (sell_lot.product_id, sell_lot.currency_id, interval, truncate(now))
+            candle = candles.get(key)
+            if candle is None:
+                candles[key] = [price, price, price, price, quantity, 1]
+            else:
+                candle[1] = max(candle[1], price)
+                candle[2] = min(candle[2], price)
+                candle[3] = price
+                candle[4] += quantity
+                candle[5] += 1
+
+    # Как и уровни стакана, свечи блокируются в едином порядке ключей
+    table = Candle._meta.db_table
+    columns = list(zip(*(
+        (*key, *map(to_minor, prices), volume, trade_count)
+        for key, (*prices, volume, trade_count) in sorted(candles.items())
+    )))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            INSERT INTO {table} (product_id, currency_id, interval, bucket, open, high, low, close, volume, trade_count)
+            SELECT product_id, currency_id, interval, bucket, open, high, low, close, volume, trade_count
+            FROM unnest(
+                %s::bigint[], %s::bigint[], %s::varchar[], %s::timestamptz[],
+                %s::bigint[], %s::bigint[], %s::bigint[], %s::bigint[], %s::bigint[], %s::int[]
+            ) WITH ORDINALITY AS candle(product_id, currency_id, interval, bucket, open, high, low, close,
+                                        volume, trade_count, n)
+            ORDER BY n
+            ON CONFLICT (product_id, currency_id, interval, bucket) DO UPDATE
+            SET high = GREATEST({table}.high, EXCLUDED.high),
+                low = LEAST({table}.low, EXCLUDED.low),
+                close = EXCLUDED.close,
+                volume = {table}.volume + EXCLUDED.volume,
+                trade_count = {table}.trade_count + EXCLUDED.trade_count
+            """,
+            [list(column) for column in columns],
+        )
+
+    publish([
+        {"type": "trade", "id": trade.id, "product": trade.product_id, "currency": trade.currency_id,
+         "price": trade.price, "quantity": trade.quantity, "created_at": trade.created_at}
+        for trade in trades
+    ])
+    invalidate_top_of_book({sell_lot.product_id for _, sell_lot, _, _ in fills})
+
+
+# ====================
+# Снимок лучших цен (top of book) для обзора рынка
+# ====================
+
+def _top_of_book_key(product_id):
+    return f"market:top:{product_id}"
+
+
+def invalidate_top_of_book(product_ids):
+    """Сбрасывает снимки лучших цен продуктов после коммита текущей транзакции"""
+    keys = [_top_of_book_key(product_id) for product_id in product_ids]
+    if keys:
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def _compute_top_of_book(product_ids):
+    """
+    Лучшие цены и последняя сделка для набора продуктов: по одному
+    агрегирующему запросу к уровням стакана и к дневным свечам.
+    """
+    tops = {product_id: {} for product_id in product_ids}
+
+    def pair(product_id, currency_id):
+        return tops[product_id].setdefault(currency_id, {
+            "currency": currency_id, "best_bid": None, "best_ask": None, "spread": None, "last_price": None,
+        })
+
+    levels = (
+        MarketDepthLevel.objects.filter(product_id__in=product_ids)
+        .values('product_id', 'currency_id')
+        .annotate(best_bid=Max('price', filter=Q(side='buy')), best_ask=Min('price', filter=Q(side='sell')))
+    )
+    for row in levels:
+        entry = pair(row['product_id'], row['currency_id'])
+        entry["best_bid"], entry["best_ask"] = row['best_bid'], row['best_ask']
+        if row['best_bid'] is not None and row['best_ask'] is not None:
+            entry["spread"] = row['best_ask'] - row['best_bid']
+
+    # Последняя сделка — close последней дневной свечи пары (DISTINCT ON)
+    last_candles = (
+        Candle.objects.filter(product_id__in=product_ids, interval='1d')
+        .order_by('product_id', 'currency_id', '-bucket')
+        .distinct('product_id', 'currency_id')
+        .values('product_id', 'currency_id', 'close')
+    )
+    for row in last_candles:
+        pair(row['product_id'], row['currency_id'])["last_price"] = row['close']
+
+    return {product_id: list(pairs.values()) for product_id, pairs in tops.items()}
+
+
+def market_overview():
+    """
+    Лучшие bid/ask, спред и последняя цена по всем продуктам.
+    Снимки берутся из кэша пачкой, пересчитываются только промахи.
+    """
+    products = list(Product.objects.filter(is_active=True).order_by('name').values_list('id', 'name'))
+    keys = {product_id: _top_of_book_key(product_id) for product_id, _ in products}
+    cached = cache.get_many(keys.values())
+
+    tops = {product_id: cached[key] for product_id, key in keys.items() if key in cached}
+    missing = [product_id for product_id in keys if product_id not in tops]
+    if missing:
+        computed = _compute_top_of_book(missing)
+        cache.set_many({keys[product_id]: top for product_id, top in computed.items()},
+                       timeout=settings.MARKET_TOP_OF_BOOK_TTL)
+        tops.update(computed)
+
+    return [
+        {"product": product_id, "product_name": name, **entry}
+        for product_id, name in products
+        for entry in tops[product_id]
+    ]
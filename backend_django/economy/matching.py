@@ -0,0 +1,598 @@
+# economy/matching.py
+"""
+Движок сопоставления рыночных лотов.
+
+Для каждой пары (product, currency) в памяти процесса держится стакан —
+отсортированные уровни цен покупки и продажи с приоритетом цена-время.
+Источником истины остаётся таблица MarketLot: стакан строится из активных
+лотов при первом обращении, догружает свежие лоты других воркеров и
+перепроверяет каждого кандидата в БД перед сделкой.
+
+Сопоставление в одном стакане последовательно во всех воркерах за счёт
+транзакционной advisory-блокировки (product_id, currency_id); разные стаканы
+сводятся параллельно. Лоты, ждущие своей очереди в процессе, сводятся
+одним пакетом в одной транзакции (group commit). Если расчёт пакета падает
+на мейкере без обеспечения, мейкер снимается с рынка, а пакет сводится заново.
+"""
+
+import bisect
+import logging
+import threading
+from collections import defaultdict, deque, namedtuple
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from eve_backend import metrics
+from eve_backend.db import retry_on_conflict
+from wallet_inventory import ledger
+from wallet_inventory.escrow import LOT
+from wallet_inventory.models import FrozenInventory, FrozenWallet
+from wallet_inventory.utils import (
+    bulk_change_inventory,
+    bulk_change_wallet,
+    bulk_consume_frozen_inventory,
+    bulk_consume_frozen_wallet,
+    lock_balances,
+)
+from .commission import accrue, commission
+from .market_data import DepthDelta, record_trades
+from .models import BrokerAccrual, MarketLot
+
+logger = logging.getLogger(__name__)
+
+# Окно, за которое стакан перечитывает новые лоты: лот другого воркера
+# мог получить created_at раньше, а закоммититься позже нашей синхронизации
+SYNC_GRACE = timedelta(seconds=60)
+
+
+class OrderBook:
+    """Стакан одной пары (product, currency)"""
+
+    def __init__(self, product_id, currency_id):
+        self.product_id = product_id
+        self.currency_id = currency_id
+        self.lock = threading.RLock()
+        # Отсортированные по возрастанию цены уровней каждой стороны
+        self._prices = {'buy': [], 'sell': []}
+        # цена -> очередь [lot_id, quantity] в порядке поступления
+        self._levels = {'buy': {}, 'sell': {}}
+        # lot_id -> (side, price) для удаления без поиска по уровням
+        self._index = {}
+        self.synced_at = None
+        # Очередь лотов на сопоставление (group commit)
+        self.turn = threading.Condition()
+        self.pending = []
+        self.draining = False
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, lot_id):
+        return lot_id in self._index
+
+    # Мутаторы берут self.lock сами (RLock — повторный вход из-под lock
+    # сводящего потока бесплатен): стакан меняют и колбэки on_commit
+    # отмены, и сброс после отката, не держащие блокировку
+
+    def add(self, lot_id, side, price, quantity):
+        with self.lock:
+            if lot_id in self._index:
+                return
+            levels = self._levels[side]
+            level = levels.get(price)
+            if level is None:
+                level = levels[price] = deque()
+                bisect.insort(self._prices[side], price)
+            level.append([lot_id, quantity])
+            self._index[lot_id] = (side, price)
+
+    def remove(self, lot_id):
+        with self.lock:
+            try:
+                side, price = self._index.pop(lot_id)
+            except KeyError:
+                return
+            level = self._levels[side][price]
+            for entry in level:
+                if entry[0] == lot_id:
+                    level.remove(entry)
+                    break
+            if not level:
+                del self._levels[side][price]
+                prices = self._prices[side]
+                del prices[bisect.bisect_left(prices, price)]
+
+    def upsert(self, lot_id, side, price, quantity):
+        with self.lock:
+            if lot_id in self._index:
+                self.set_quantity(lot_id, quantity)
+            else:
+                self.add(lot_id, side, price, quantity)
+
+    def set_quantity(self, lot_id, quantity):
+        """Обновляет остаток лота после частичного исполнения; 0 — убрать из стакана"""
+        with self.lock:
+            if quantity <= 0:
+                self.remove(lot_id)
+                return
+            try:
+                side, price = self._index[lot_id]
+            except KeyError:
+                return
+            for entry in self._levels[side][price]:
+                if entry[0] == lot_id:
+                    entry[1] = quantity
+                    break
+
+    def best_price(self, side):
+        prices = self._prices[side]
+        if not prices:
+            return None
+        return prices[-1] if side == 'buy' else prices[0]
+
+    def iter_crossing(self, lot_type, price):
+        """
+        Кандидаты встречной стороны, пересекающиеся с ценой price,
+        в порядке цена-время: (lot_id, price, quantity).
+        """
+        side = 'buy' if lot_type == 'sell' else 'sell'
+        prices = self._prices[side]
+        if side == 'buy':
+            crossing = reversed(prices[bisect.bisect_left(prices, price):])
+        else:
+            crossing = prices[:bisect.bisect_right(prices, price)]
+
+        for level_price in list(crossing):
+            level = self._levels[side].get(level_price)
+            if not level:
+                continue
+            for lot_id, quantity in list(level):
+                yield lot_id, level_price, quantity
+
+    def refresh(self, lots):
+        """Приводит стакан в соответствие с сохранёнными лотами этой пары"""
+        with self.lock:
+            for lot in lots:
+                if lot.status == 'active' and lot.remaining_quantity > 0:
+                    self.upsert(lot.id, lot.lot_type, lot.price_per_unit, lot.remaining_quantity)
+                else:
+                    self.remove(lot.id)
+
+    def clear(self):
+        """Забывает содержимое; следующий sync() перечитает все активные лоты"""
+        with self.lock:
+            self._prices = {'buy': [], 'sell': []}
+            self._levels = {'buy': {}, 'sell': {}}
+            self._index = {}
+            self.synced_at = None
+
+    def load(self, rows):
+        with self.lock:
+            for lot_id, lot_type, price, quantity in rows:
+                self.add(lot_id, lot_type, price, quantity)
+
+    def sync(self):
+        """Догружает активные лоты, созданные с момента прошлой синхронизации"""
+        now = timezone.now()
+        qs = MarketLot.objects.live(now).filter(
+            product_id=self.product_id,
+            currency_id=self.currency_id,
+        )
+        if self.synced_at is not None:
+            qs = qs.filter(created_at__gte=self.synced_at - SYNC_GRACE)
+        self.load(qs.order_by('created_at', 'id').values_list('id', 'lot_type', 'price_per_unit', 'remaining_quantity'))
+        self.synced_at = now
+
+
+_books = {}
+_books_loaded = False
+_registry_lock = threading.Lock()
+
+
+def load_books():
+    """Перестраивает все стаканы процесса одним запросом по активным лотам"""
+    with _registry_lock:
+        _load_books()
+
+
+def _load_books():
+    global _books_loaded
+    now = timezone.now()
+    books = {}
+    rows = MarketLot.objects.live(now).order_by('created_at', 'id').values_list(
+        'id', 'product_id', 'currency_id', 'lot_type', 'price_per_unit', 'remaining_quantity'
+    )
+    for lot_id, product_id, currency_id, lot_type, price, quantity in rows:
+        book = books.get((product_id, currency_id))
+        if book is None:
+            book = books[(product_id, currency_id)] = OrderBook(product_id, currency_id)
+            book.synced_at = now
+        book.add(lot_id, lot_type, price, quantity)
+
+    _books.clear()
+    _books.update(books)
+    _books_loaded = True
+
+
+def reset_books():
+    """Сбрасывает стаканы; при следующем обращении они будут построены заново"""
+    global _books_loaded
+    with _registry_lock:
+        _books.clear()
+        _books_loaded = False
+
+
+def get_book(product_id, currency_id):
+    with _registry_lock:
+        # Проверка под блокировкой: иначе параллельные первые обращения
+        # построили бы несколько экземпляров одного стакана
+        if not _books_loaded:
+            _load_books()
+        book = _books.get((product_id, currency_id))
+        if book is None:
+            book = _books[(product_id, currency_id)] = OrderBook(product_id, currency_id)
+        return book
+
+
+def refresh_books(lots):
+    """Приводит стаканы процесса в соответствие с сохранёнными лотами"""
+    for lot in lots:
+        get_book(lot.product_id, lot.currency_id).refresh([lot])
+
+
+def lock_books(pairs):
+    """
+    Берёт транзакционные advisory-блокировки стаканов (product_id, currency_id)
+    до конца текущей транзакции. Порядок фиксирован, чтобы транзакции,
+    затрагивающие несколько стаканов, не взаимоблокировались.
+    """
+    pairs = sorted(set(pairs))
+    if not pairs:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT pg_advisory_xact_lock(product_id, currency_id) "
+            "FROM unnest(%s::int[], %s::int[]) AS book(product_id, currency_id)",
+            [[product_id for product_id, _ in pairs], [currency_id for _, currency_id in pairs]],
+        )
+
+
+class _Ticket:
+    """Лот в очереди на сопоставление и результат для ждущего потока"""
+
+    def __init__(self, lot):
+        self.lot = lot
+        self.fills = []
+        self.error = None
+        self.done = False
+
+
+def match_lot(lot):
+    """
+    Сводит закоммиченный лот со встречными лотами стакана, проходя уровни
+    цен по порядку, пока лот не исполнится целиком или не кончатся
+    пересекающиеся цены. Сделка идёт по цене лежащего в стакане лота.
+
+    Вызывается вне транзакции. Пока один поток сводит пакет, лоты того же
+    стакана копятся в очереди; первый освободившийся из ждущих забирает их
+    все и сводит в одной транзакции. Возвращает сделки лота, status и
+    remaining_quantity лота обновляются.
+    """
+    book = get_book(lot.product_id, lot.currency_id)
+    ticket = _Ticket(lot)
+
+    with book.turn:
+        book.pending.append(ticket)
+        while book.draining and not ticket.done:
+            book.turn.wait()
+        leader = not ticket.done
+        if leader:
+            book.draining = True
+            batch, book.pending = book.pending, []
+
+    if leader:
+        try:
+            _match_batch(book, batch)
+        finally:
+            with book.turn:
+                book.draining = False
+                book.turn.notify_all()
+
+    if ticket.error is not None:
+        raise ticket.error
+    return ticket.fills
+
+
+def _match_batch(book, tickets):
+    try:
+        _match_tickets(book, tickets)
+    except Exception as e:
+        # Пакет откатился целиком: стакан перечитывается, а лоты сводятся
+        # по одному, чтобы ошибка одного не досталась остальным
+        book.clear()
+        if len(tickets) == 1:
+            tickets[0].error = e
+        else:
+            for ticket in tickets:
+                try:
+                    _match_tickets(book, [ticket])
+                except Exception as error:
+                    book.clear()
+                    ticket.error = error
+    finally:
+        for ticket in tickets:
+            ticket.done = True
+
+
+# Откат пакета оставляет в стакане несохранённые изменения — перед повтором он перечитывается
+@retry_on_conflict('match', on_retry=lambda book, tickets: book.clear())
+def _match_tickets(book, tickets):
+    with book.lock, transaction.atomic():
+        lock_books([(book.product_id, book.currency_id)])
+        try:
+            # Быстрый путь: весь пакет — один расчёт, в своей точке сохранения
+            with transaction.atomic():
+                results = _sweep(book, tickets, _claim(book, tickets))
+        except ValueError:
+            # Расчёт упёрся в лот без обеспечения: стакан и лоты перечитываются,
+            # и каждый мейкер рассчитывается отдельно
+            book.clear()
+            results = _sweep_isolated(book, tickets, _claim(book, tickets))
+
+    for ticket, lot, fills in results:
+        if lot is not None:
+            ticket.lot.status = lot.status
+            ticket.lot.remaining_quantity = lot.remaining_quantity
+        ticket.fills = fills
+
+
+def _claim(book, tickets):
+    """Синхронизирует стакан и блокирует лоты пакета; сами они встают в стакан только в свою очередь"""
+    book.sync()
+    for ticket in tickets:
+        book.remove(ticket.lot.id)
+    # Лоты пакета и уже взятые мейкеры: строки заблокированы этой транзакцией
+    return MarketLot.objects.live().select_for_update().in_bulk([ticket.lot.id for ticket in tickets])
+
+
+def _sweep(book, tickets, claimed):
+    settlement = Settlement()
+    results = []
+    for ticket in tickets:
+        lot = claimed.get(ticket.lot.id)
+        fills = []
+        # Лот мог быть отменён или исполнен до своей очереди
+        if lot is not None:
+            fills = _match_into(book, lot, claimed)
+            settlement.add(fills)
+            # Следующие лоты пакета видят остаток этого как лежащий в стакане
+            book.refresh([lot] + [fill.maker_of(lot) for fill in fills])
+        results.append((ticket, lot, fills))
+    settlement.write()
+    return results
+
+
+def _sweep_isolated(book, tickets, claimed):
+    """
+    Медленный путь: каждая сделка проводится в своей точке сохранения.
+    Мейкер, на котором расчёт падает, снимается с рынка (_quarantine),
+    а лот продолжает проходить стакан дальше.
+    """
+    results = []
+    for ticket in tickets:
+        lot = claimed.get(ticket.lot.id)
+        done = []
+        while lot is not None and lot.status == 'active':
+            fills = _match_into(book, lot, claimed)
+            if not fills:
+                break
+            for fill in fills:
+                maker = fill.maker_of(lot)
+                before = [(each, each.remaining_quantity, each.status) for each in (lot, maker)]
+                try:
+                    with transaction.atomic():
+                        settle_fills([fill])
+                except ValueError as error:
+                    for each, remaining, status in before:
+                        each.remaining_quantity, each.status = remaining, status
+                    # Обеспечение мейкера на месте — не хватает у самого лота
+                    if _backed(maker, fill.quantity):
+                        raise
+                    _quarantine(book, maker, error)
+                    break
+                done.append(fill)
+                book.refresh([maker])
+            else:
+                break
+        if lot is not None:
+            book.refresh([lot])
+        results.append((ticket, lot, done))
+    return results
+
+
+def _backed(lot, quantity):
+    """Хватает ли escrow лота на исполнение quantity единиц"""
+    if lot.lot_type == 'sell':
+        frozen = FrozenInventory.objects.filter(escrow_kind=LOT, escrow_id=lot.id).aggregate(s=Sum('quantity'))['s']
+        return (frozen or 0) >= quantity
+    frozen = FrozenWallet.objects.filter(escrow_kind=LOT, escrow_id=lot.id).aggregate(s=Sum('amount'))['s']
+    return (frozen or 0) >= lot.price_per_unit * quantity
+
+
+def _quarantine(book, lot, error):
+    """
+    Снимает с рынка лот, чей расчёт невозможен (нет или не хватает escrow):
+    иначе он оставался бы лучшей ценой и валил каждый встречный лот.
+    Оставшийся escrow не трогается — расхождение разбирается вручную.
+    """
+    logger.error("Лот %s снят с рынка: %s", lot.id, error)
+    metrics.increment('lot_quarantined')
+    depth = DepthDelta()
+    depth.closed(lot)
+    MarketLot.objects.filter(id=lot.id).update(status='cancelled')
+    depth.apply()
+    lot.status = 'cancelled'
+    book.remove(lot.id)
+
+
+def _match_into(book, lot, claimed):
+    """Подбирает сделки для лота под уже взятыми блокировками стакана; остатки лотов не меняет"""
+    book.remove(lot.id)
+    fills = []
+    left = lot.remaining_quantity
+
+    for candidate_id, _, _ in book.iter_crossing(lot.lot_type, lot.price_per_unit):
+        if left == 0:
+            break
+
+        maker = claimed.get(candidate_id)
+        if maker is None:
+            # Строку может держать отмена или истечение — её не ждём
+            maker = MarketLot.objects.live().select_for_update(skip_locked=True).filter(id=candidate_id).first()
+            if maker is None:
+                if not MarketLot.objects.live().filter(id=candidate_id).exists():
+                    book.remove(candidate_id)
+                continue
+            claimed[candidate_id] = maker
+        elif maker.status != 'active' or maker.remaining_quantity == 0:
+            continue
+
+        quantity = min(left, maker.remaining_quantity)
+        fills.append(Fill.between(lot, maker, quantity, maker.price_per_unit))
+        left -= quantity
+
+    return fills
+
+
+def discard_lot(lot):
+    """Убирает лот из стакана после коммита текущей транзакции (отмена и т.п.)"""
+    book = get_book(lot.product_id, lot.currency_id)
+    transaction.on_commit(lambda: book.remove(lot.id))
+
+
+class Fill(namedtuple('Fill', ['buy_lot', 'sell_lot', 'quantity', 'price'])):
+    """Исполнение quantity единиц между buy- и sell-лотом по цене price"""
+
+    @classmethod
+    def between(cls, lot1, lot2, quantity, price):
+        if lot1.lot_type == 'buy':
+            return cls(lot1, lot2, quantity, price)
+        return cls(lot2, lot1, quantity, price)
+
+    def maker_of(self, taker):
+        return self.sell_lot if self.buy_lot is taker else self.buy_lot
+
+
+class Settlement:
+    """
+    Расчёт набора сделок: add() сразу меняет остатки лотов в памяти (следующие
+    сделки видят их), write() проводит всё накопленное одним проходом —
+    escrow, балансы, остатки лотов, агрегат стакана, лента сделок и свечи
+    меняются bulk-запросами, а не по запросу на каждую сделку.
+    Продавец получает quantity × price за вычетом комиссии брокеру его лота
+    (economy.commission), покупателю возвращается разница с ценой его лота
+    (улучшение цены).
+    """
+
+    def __init__(self):
+        self.fills = []
+        self.frozen_inventory = defaultdict(int)  # sell lot_id -> quantity
+        self.frozen_wallet = defaultdict(int)     # buy lot_id -> amount
+        self.inventory = defaultdict(int)         # (actor_id, product_id) -> delta
+        self.wallet = defaultdict(int)            # (actor_id, currency_id) -> delta
+        self.accruals = []
+        self.lots = {}
+        self.depth = DepthDelta()
+
+    def add(self, fills):
+        for buy_lot, sell_lot, quantity, price in fills:
+            self.frozen_inventory[sell_lot.id] += quantity
+            self.frozen_wallet[buy_lot.id] += buy_lot.price_per_unit * quantity
+
+            self.inventory[(buy_lot.actor_id, buy_lot.product_id)] += quantity
+            fee = commission(price * quantity)
+            self.wallet[(sell_lot.actor_id, sell_lot.currency_id)] += price * quantity - fee
+            if fee:
+                self.accruals.append(BrokerAccrual(
+                    lot_id=sell_lot.id, payer_id=sell_lot.actor_id, broker_id=sell_lot.broker_id,
+                    currency_id=sell_lot.currency_id, amount=fee,
+                ))
+            self.wallet[(buy_lot.actor_id, buy_lot.currency_id)] += (buy_lot.price_per_unit - price) * quantity
+
+            for lot in (buy_lot, sell_lot):
+                lot.remaining_quantity -= quantity
+                if lot.remaining_quantity == 0:
+                    lot.status = 'completed'
+                self.depth.add(lot, -quantity, -1 if lot.status == 'completed' else 0)
+                self.lots[lot.id] = lot
+        self.fills.extend(fills)
+
+    def write(self):
+        if not self.fills:
+            return
+
+        # Списание escrow и зачисления — одна сведённая операция журнала.
+        # Балансы всех участников блокируются одним упорядоченным запросом
+        # до первого изменения, поэтому пакет пишется один раз, в конце
+        with transaction.atomic(), ledger.operation('trade'):
+            lock_balances(self.inventory, self.wallet)
+            bulk_consume_frozen_inventory(self.frozen_inventory)
+            bulk_consume_frozen_wallet(self.frozen_wallet)
+            bulk_change_inventory(self.inventory)
+            bulk_change_wallet(self.wallet)
+            accrue(self.accruals)
+            MarketLot.objects.bulk_update(self.lots.values(), ['remaining_quantity', 'status'])
+            self.depth.apply()
+            record_trades(self.fills)
+
+
+def settle_fills(fills):
+    """Проводит набор сделок одним проходом (см. Settlement)"""
+    settlement = Settlement()
+    settlement.add(fills)
+    settlement.write()
+
+
+def execute_trade(lot1, lot2, quantity, price):
+    """Исполняет одну сделку quantity единиц между двумя лотами по цене price"""
+    settle_fills([Fill.between(lot1, lot2, quantity, price)])
+
+
+def close_lots(lots, status):
+    """
+    Снимает набор активных лотов (истечение, массовая отмена): неисполненный
+    остаток escrow возвращается в Inventory/Wallet агрегированными bulk-запросами,
+    лоты получают терминальный статус одним UPDATE.
+    Лоты должны быть заблокированы вызывающим кодом (select_for_update).
+    """
+    if not lots:
+        return
+
+    frozen_inventory, frozen_wallet = {}, {}
+    inventory = defaultdict(int)
+    wallet = defaultdict(int)
+    depth = DepthDelta()
+
+    for lot in lots:
+        if lot.lot_type == 'sell':
+            frozen_inventory[lot.id] = lot.remaining_quantity
+            inventory[(lot.actor_id, lot.product_id)] += lot.remaining_quantity
+        else:
+            frozen_wallet[lot.id] = lot.remaining_total
+            wallet[(lot.actor_id, lot.currency_id)] += lot.remaining_total
+        depth.closed(lot)
+        lot.status = status
+
+    with transaction.atomic(), ledger.operation(f"lot:{status}"):
+        lock_balances(inventory, wallet)
+        bulk_consume_frozen_inventory({lot_id: q for lot_id, q in frozen_inventory.items() if q})
+        bulk_consume_frozen_wallet({lot_id: a for lot_id, a in frozen_wallet.items() if a})
+        bulk_change_inventory(inventory)
+        bulk_change_wallet(wallet)
+        MarketLot.objects.filter(id__in=[lot.id for lot in lots]).update(status=status)
+        depth.apply()
+
+    transaction.on_commit(lambda: refresh_books(lots))
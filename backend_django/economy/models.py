@@ -1,5 +1,8 @@
 from django.db import models
+from django.db.models import F, Q
+from django.utils import timezone
 from actors.models import Actor
+from eve_backend.money import MoneyField
 from products.models import Product
 
 class Currency(models.Model):
@@ -28,6 +31,15 @@ class Tag(models.Model):
         ordering = ['name']
 
 
+class MarketLotQuerySet(models.QuerySet):
+    def live(self, now=None):
+        """Активные лоты, которые ещё не истекли (только их можно исполнять)"""
+        return self.filter(
+            Q(expires_at__isnull=True) | Q(expires_at__gt=now or timezone.now()),
+            status='active',
+        )
+
+
 class MarketLot(models.Model):
     LOT_TYPE_CHOICES = [
         ('sell', 'Продажа'),
@@ -38,6 +50,7 @@ class MarketLot(models.Model):
         ('active', 'Активен'),
         ('completed', 'Завершён'),
         ('cancelled', 'Отменён'),
+        ('expired', 'Истёк'),
     ]
 
     actor = models.ForeignKey(
@@ -46,31 +59,156 @@ class MarketLot(models.Model):
         related_name='market_lots',
         verbose_name="Актёр"
     )
+    # README, раздел 7: пусто — брокер не назначен, комиссия уходит системе
+    broker = models.ForeignKey(
+        Actor,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='brokered_lots',
+        verbose_name="Брокер"
+    )
     lot_type = models.CharField("Тип лота", max_length=10, choices=LOT_TYPE_CHOICES)
     product = models.ForeignKey(Product, on_delete=models.PROTECT, verbose_name="Товар")
     quantity = models.PositiveIntegerField("Количество")
-    price_per_unit = models.DecimalField("Цена за единицу", max_digits=16, decimal_places=2)
+    # default=0 — только для строк, существовавших до появления поля: миграция
+    # ставит им 0, backfill_lot_remaining возвращает активным полный остаток
+    remaining_quantity = models.PositiveIntegerField("Остаток к исполнению", default=0)
+    price_per_unit = MoneyField("Цена за единицу")
     currency = models.ForeignKey(Currency, on_delete=models.PROTECT, verbose_name="Валюта")
     status = models.CharField("Статус", max_length=20, choices=STATUS_CHOICES, default='active')
     created_at = models.DateTimeField("Создан", auto_now_add=True)
+    expires_at = models.DateTimeField("Истекает", null=True, blank=True)
+
+    objects = MarketLotQuerySet.as_manager()
 
     class Meta:
         verbose_name = "Рыночный лот"
         verbose_name_plural = "Рыночные лоты"
         indexes = [
-            models.Index(fields=['product', 'lot_type', 'price_per_unit', '-created_at']),
+            # Просмотр рынка: keyset по (price_per_unit, created_at, id) среди активных лотов
+            models.Index(
+                fields=['price_per_unit', 'created_at', 'id'],
+                name='marketlot_browse_idx',
+                condition=Q(status='active'),
+            ),
+            models.Index(
+                fields=['product', 'lot_type', 'price_per_unit', 'created_at', 'id'],
+                name='marketlot_product_browse_idx',
+                condition=Q(status='active'),
+            ),
             models.Index(fields=['status']),
             models.Index(fields=['currency']),
+            # Для фонового снятия истёкших лотов: только активные со сроком
+            models.Index(
+                fields=['expires_at'],
+                name='marketlot_active_expiry_idx',
+                condition=Q(status='active', expires_at__isnull=False),
+            ),
+        ]
+        constraints = [
+            # 0 <= remaining_quantity <= quantity
+            models.CheckConstraint(
+                condition=Q(remaining_quantity__lte=F('quantity')),
+                name='lot_remaining_lte_quantity'
+            ),
         ]
         ordering = ['-created_at']
 
     def __str__(self):
-        return f"[{self.get_lot_type_display()}] {self.quantity} × {self.product.name} по {self.price_per_unit} {self.currency.symbol} ({self.actor.name})"
+        return f"[{self.get_lot_type_display()}] {self.remaining_quantity}/{self.quantity} × {self.product.name} по {self.price_per_unit} {self.currency.symbol} ({self.actor.name})"
+
+    def save(self, *args, **kwargs):
+        # Новый лот ещё не исполнялся — остаток равен полному количеству
+        if self._state.adding and not self.remaining_quantity:
+            self.remaining_quantity = self.quantity
+        super().save(*args, **kwargs)
 
     @property
     def total_price(self):
         return self.price_per_unit * self.quantity
 
+    @property
+    def remaining_total(self):
+        """Сумма под неисполненный остаток (столько заморожено у buy-лота)"""
+        return self.price_per_unit * self.remaining_quantity
+
+
+class MarketDepthLevel(models.Model):
+    """
+    Агрегат стакана (L2): суммарный неисполненный остаток активных лотов
+    на уровне цены. Обновляется в той же транзакции, что и сами лоты.
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='depth_levels', verbose_name="Товар")
+    currency = models.ForeignKey(Currency, on_delete=models.CASCADE, related_name='depth_levels', verbose_name="Валюта")
+    side = models.CharField("Сторона", max_length=10, choices=MarketLot.LOT_TYPE_CHOICES)
+    price = MoneyField("Цена")
+    quantity = models.BigIntegerField("Количество", default=0)
+    lot_count = models.IntegerField("Лотов", default=0)
+
+    class Meta:
+        verbose_name = "Уровень стакана"
+        verbose_name_plural = "Уровни стакана"
+        unique_together = ('product', 'currency', 'side', 'price')
+
+    def __str__(self):
+        return f"[{self.side}] {self.product_id}/{self.currency_id} {self.price}: {self.quantity} ({self.lot_count})"
+
+
+class Trade(models.Model):
+    """Лента сделок: одна запись на каждое исполнение между двумя лотами"""
+    buy_lot = models.ForeignKey(MarketLot, on_delete=models.SET_NULL, null=True, related_name='buy_trades', verbose_name="Лот покупки")
+    sell_lot = models.ForeignKey(MarketLot, on_delete=models.SET_NULL, null=True, related_name='sell_trades', verbose_name="Лот продажи")
+    buyer = models.ForeignKey(Actor, on_delete=models.CASCADE, related_name='buy_trades', verbose_name="Покупатель")
+    seller = models.ForeignKey(Actor, on_delete=models.CASCADE, related_name='sell_trades', verbose_name="Продавец")
+    product = models.ForeignKey(Product, on_delete=models.PROTECT, verbose_name="Товар")
+    currency = models.ForeignKey(Currency, on_delete=models.PROTECT, verbose_name="Валюта")
+    quantity = models.PositiveIntegerField("Количество")
+    price = MoneyField("Цена")
+    created_at = models.DateTimeField("Время", default=timezone.now)
+
+    class Meta:
+        verbose_name = "Сделка"
+        verbose_name_plural = "Сделки"
+        indexes = [
+            models.Index(fields=['product', 'currency', '-created_at']),
+        ]
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.quantity} × {self.product_id} по {self.price} ({self.seller_id} → {self.buyer_id})"
+
+
+class Candle(models.Model):
+    """
+    Свеча OHLCV по паре (product, currency) за интервал. Обновляется
+    инкрементально при каждой сделке; графики читают только эту таблицу.
+    """
+    INTERVAL_CHOICES = [
+        ('1m', '1 минута'),
+        ('1h', '1 час'),
+        ('1d', '1 день'),
+    ]
+
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='candles', verbose_name="Товар")
+    currency = models.ForeignKey(Currency, on_delete=models.CASCADE, related_name='candles', verbose_name="Валюта")
+    interval = models.CharField("Интервал", max_length=4, choices=INTERVAL_CHOICES)
+    bucket = models.DateTimeField("Начало интервала")
+    open = MoneyField()
+    high = MoneyField()
+    low = MoneyField()
+    close = MoneyField()
+    volume = models.BigIntegerField("Объём", default=0)
+    trade_count = models.IntegerField("Сделок", default=0)
+
+    class Meta:
+        verbose_name = "Свеча"
+        verbose_name_plural = "Свечи"
+        unique_together = ('product', 'currency', 'interval', 'bucket')
+
+    def __str__(self):
+        return f"{self.product_id}/{self.currency_id} {self.interval} {self.bucket:%Y-%m-%d %H:%M}"
+
 
 class Transfer(models.Model):
     TYPE_CHOICES = [
@@ -90,7 +228,7 @@ class Transfer(models.Model):
     transfer_type = models.CharField("Тип передачи", max_length=10, choices=TYPE_CHOICES)
     product = models.ForeignKey(Product, on_delete=models.PROTECT, null=True, blank=True, verbose_name="Предмет")
     quantity = models.PositiveIntegerField(null=True, blank=True)
-    amount = models.DecimalField("Сумма", max_digits=16, decimal_places=2, default=0)
+    amount = MoneyField("Сумма", default=0)
     currency = models.ForeignKey(Currency, on_delete=models.PROTECT, null=True, blank=True, verbose_name="Валюта")
     status = models.CharField("Статус", max_length=20, choices=STATUS_CHOICES, default='pending')
     created_at = models.DateTimeField(auto_now_add=True)
@@ -105,3 +243,71 @@ class Transfer(models.Model):
             return f"Передача {self.quantity} {self.product.name} от {self.sender} к {self.recipient}"
         else:
             return f"Передача {self.amount} {self.currency.symbol} от {self.sender} к {self.recipient}"
+
+
+class BrokerAccrual(models.Model):
+    """
+    Начисление комиссии брокеру за исполнение (только добавление).
+    Сделка лишь вставляет строку, кошелёк брокера не трогает; выплату
+    проводит economy.commission.settle_commissions — пачкой, одним
+    зачислением на брокера, проставляя payout.
+    """
+    lot = models.ForeignKey(MarketLot, on_delete=models.SET_NULL, null=True, related_name='broker_accruals', verbose_name="Лот")
+    # PROTECT: удаление актора не должно уносить начисления (в т.ч. невыплаченные,
+    # уже проведённые на accrued) — актора с начислениями деактивируют
+    payer = models.ForeignKey(Actor, on_delete=models.PROTECT, related_name='paid_commissions', verbose_name="Плательщик")
+    broker = models.ForeignKey(
+        Actor,
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True,
+        related_name='broker_accruals',
+        verbose_name="Брокер",
+        help_text="Пусто — комиссия системе"
+    )
+    currency = models.ForeignKey(Currency, on_delete=models.PROTECT, verbose_name="Валюта")
+    amount = MoneyField("Комиссия")
+    created_at = models.DateTimeField("Время", default=timezone.now)
+    payout = models.UUIDField(null=True, blank=True, help_text="Пачка выплаты; пусто — ещё не выплачено")
+
+    class Meta:
+        verbose_name = "Начисление брокеру"
+        verbose_name_plural = "Начисления брокерам"
+        indexes = [
+            # Выплата и аудит читают только невыплаченные начисления
+            models.Index(
+                fields=['broker', 'currency'],
+                name='broker_accrual_unpaid_idx',
+                condition=Q(payout__isnull=True),
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.payer_id} → {self.broker_id or 'system'}: {self.amount} ({self.currency_id})"
+
+
+class BrokerPayout(models.Model):
+    """Выплата накопленных начислений одному получателю в одной валюте"""
+    batch = models.UUIDField(db_index=True, help_text="Пачка выплаты (BrokerAccrual.payout)")
+    broker = models.ForeignKey(
+        Actor,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='+',
+        verbose_name="Брокер",
+        help_text="Пусто — доля системы"
+    )
+    recipient = models.ForeignKey(Actor, on_delete=models.PROTECT, related_name='broker_payouts', verbose_name="Получатель")
+    currency = models.ForeignKey(Currency, on_delete=models.PROTECT, verbose_name="Валюта")
+    amount = MoneyField("Сумма")
+    accruals = models.PositiveIntegerField("Начислений")
+    created_at = models.DateTimeField("Время", default=timezone.now)
+
+    class Meta:
+        verbose_name = "Выплата брокеру"
+        verbose_name_plural = "Выплаты брокерам"
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.recipient_id}: {self.amount} ({self.currency_id}, начислений {self.accruals})"
@@ -0,0 +1,93 @@
+# economy/pagination.py
+import base64
+import json
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from eve_backend.money import Money
+
+
+class MarketLotKeysetPagination(BasePagination):
+    """
+    Курсорная (keyset) пагинация лотов по (price_per_unit, created_at, id).
+    Следующая страница выбирается условием «строго после последнего ключа»,
+    поэтому стоимость страницы не зависит от её номера и размера стакана.
+    Включается, только если передан cursor или page_size: без них список
+    отдаётся целиком, как раньше (так его читает фронтенд).
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    page_size = 50
+    max_page_size = 200
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if not (self.cursor_query_param in request.query_params
+                or self.page_size_query_param in request.query_params):
+            return None
+
+        self.request = request
+        self.page_size_value = self.get_page_size(request)
+
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            price, created_at, lot_id = self.decode_cursor(cursor)
+            queryset = queryset.filter(
+                Q(price_per_unit__gt=price)
+                | Q(price_per_unit=price, created_at__gt=created_at)
+                | Q(price_per_unit=price, created_at=created_at, id__gt=lot_id)
+            )
+
+        page = list(queryset.order_by('price_per_unit', 'created_at', 'id')[:self.page_size_value + 1])
+        self.has_next = len(page) > self.page_size_value
+        page = page[:self.page_size_value]
+        self.last = page[-1] if page else None
+        return page
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def encode_cursor(self, lot):
+        key = [str(lot.price_per_unit), lot.created_at.isoformat(), lot.id]
+        return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+    def decode_cursor(self, cursor):
+        try:
+            price, created_at, lot_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            created_at = parse_datetime(created_at)
+            if created_at is None:
+                raise ValueError
+            # Money: цена точнее копейки не дойдёт до MoneyField
+            return Money(price), created_at, int(lot_id)
+        except (ValueError, TypeError):
+            raise NotFound("Неверный курсор")
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.last))
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
@@ -1,8 +1,10 @@
+from django.utils import timezone
 from rest_framework import serializers
 
 from actors.models import Actor
+from eve_backend.money import Money, MoneySerializerField
 from products.models import Product
-from .models import Currency, Tag, MarketLot, Transfer
+from .models import Currency, Tag, MarketLot, Transfer, MarketDepthLevel, Trade, Candle
 
 
 class TagSerializer(serializers.ModelSerializer):
@@ -20,6 +22,8 @@ class MarketLotSerializer(serializers.ModelSerializer):
     product_description = serializers.CharField(source='product.description', read_only=True, allow_blank=True)
     currency_symbol = serializers.CharField(source='currency.symbol', read_only=True)
     actor_name = serializers.CharField(source='actor.name', read_only=True)
+    # Нулевая или отрицательная цена дала бы отрицательную комиссию и начисление брокеру
+    price_per_unit = MoneySerializerField(min_value=Money('0.01'))
     total_price = serializers.DecimalField( max_digits=18, decimal_places=2, read_only=True)
 
     # Для создания лота — передаём actor_id от фронта (мастер может любой)
@@ -36,14 +40,34 @@ class MarketLotSerializer(serializers.ModelSerializer):
             'product_name',
             'product_description',
             'quantity',
+            'remaining_quantity',
             'price_per_unit',
             'currency',
             'currency_symbol',
             'total_price',
+            'broker',
             'status',
             'created_at',
+            'expires_at',
         ]
-        read_only_fields = ['status', 'created_at', 'total_price', 'actor_name', 'product_name', 'currency_symbol']
+        read_only_fields = ['status', 'remaining_quantity', 'created_at', 'total_price', 'actor_name', 'product_name', 'currency_symbol']
+
+    def validate_expires_at(self, value):
+        if value is not None and value <= timezone.now():
+            raise serializers.ValidationError("Срок действия лота должен быть в будущем")
+        return value
+
+    def validate_broker(self, value):
+        if value is not None and not value.is_active:
+            raise serializers.ValidationError("Брокер должен быть активным актором")
+        return value
+
+    def validate(self, attrs):
+        # Продавец-брокер вернул бы себе собственную комиссию
+        broker = attrs.get('broker')
+        if broker is not None and broker.id == attrs.get('actor_id'):
+            raise serializers.ValidationError({"broker": "Брокер не может совпадать с владельцем лота"})
+        return attrs
 
     def create(self, validated_data):
         # Извлекаем actor_id и находим актора
@@ -54,12 +78,83 @@ class MarketLotSerializer(serializers.ModelSerializer):
         return MarketLot.objects.create(actor=actor, **validated_data)
 
 
+class MarketDepthLevelSerializer(serializers.ModelSerializer):
+    lots = serializers.IntegerField(source='lot_count', read_only=True)
+
+    class Meta:
+        model = MarketDepthLevel
+        fields = ['price', 'quantity', 'lots']
+
+
+class TradeSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Trade
+        fields = ['id', 'price', 'quantity', 'buyer', 'seller', 'buy_lot', 'sell_lot', 'created_at']
+
+
+class CandleSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Candle
+        fields = ['bucket', 'open', 'high', 'low', 'close', 'volume', 'trade_count']
+
+
+class MarketOverviewSerializer(serializers.Serializer):
+    """Строка обзора рынка (только для схемы: отдаётся готовый снимок из кэша)"""
+    product = serializers.IntegerField()
+    product_name = serializers.CharField()
+    currency = serializers.IntegerField()
+    best_bid = serializers.DecimalField(max_digits=16, decimal_places=2, allow_null=True)
+    best_ask = serializers.DecimalField(max_digits=16, decimal_places=2, allow_null=True)
+    spread = serializers.DecimalField(max_digits=16, decimal_places=2, allow_null=True)
+    last_price = serializers.DecimalField(max_digits=16, decimal_places=2, allow_null=True)
+
+
+class AuctionLotSerializer(serializers.Serializer):
+    """
+    Лот пакетной загрузки в режиме аукциона: только проверка полей,
+    существование actor/product/currency проверяется одним IN-запросом на модель.
+    """
+    actor_id = serializers.IntegerField(min_value=1)
+    lot_type = serializers.ChoiceField(choices=MarketLot.LOT_TYPE_CHOICES)
+    product = serializers.IntegerField(min_value=1)
+    quantity = serializers.IntegerField(min_value=1)
+    price_per_unit = MoneySerializerField(min_value=Money('0.01'))
+    currency = serializers.IntegerField(min_value=1)
+    broker = serializers.IntegerField(min_value=1, required=False, allow_null=True)
+    expires_at = serializers.DateTimeField(required=False, allow_null=True)
+
+    def validate_expires_at(self, value):
+        if value is not None and value <= timezone.now():
+            raise serializers.ValidationError("Срок действия лота должен быть в будущем")
+        return value
+
+    def validate(self, attrs):
+        if attrs.get('broker') is not None and attrs['broker'] == attrs['actor_id']:
+            raise serializers.ValidationError({"broker": "Брокер не может совпадать с владельцем лота"})
+        return attrs
+
+
+class BulkCancelSerializer(serializers.Serializer):
+    """Фильтры массовой отмены лотов; нужен хотя бы один"""
+    MAX_IDS = 10_000
+
+    actor_id = serializers.IntegerField(min_value=1, required=False, allow_null=True)
+    product = serializers.IntegerField(min_value=1, required=False, allow_null=True)
+    lot_type = serializers.ChoiceField(choices=MarketLot.LOT_TYPE_CHOICES, required=False, allow_null=True)
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1), required=False, max_length=MAX_IDS)
+
+    def validate(self, attrs):
+        if not any(attrs.get(name) for name in ('actor_id', 'product', 'lot_type', 'ids')):
+            raise serializers.ValidationError("Укажите хотя бы один фильтр: actor_id, product, lot_type, ids")
+        return attrs
+
+
 class TransferSerializer(serializers.ModelSerializer):
     sender_name = serializers.CharField(source='sender.name', read_only=True)
     recipient_name = serializers.CharField(source='recipient.name', read_only=True)
     product_name = serializers.CharField(source='product.name', read_only=True, allow_null=True)
     currency_symbol = serializers.CharField(source='currency.symbol', read_only=True, allow_null=True)
-    amount = serializers.DecimalField(max_digits=16, decimal_places=2, allow_null=True, required=False)
+    amount = MoneySerializerField(allow_null=True, required=False)
     # Для создания — передаём actor_id отправителя
     sender_actor_id = serializers.IntegerField(write_only=True)
 
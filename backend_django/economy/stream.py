@@ -0,0 +1,113 @@
+# economy/stream.py
+"""
+Потоковая подписка на рынок (Server-Sent Events) вместо опроса лотов и кошелька.
+
+GET /economy/market/stream/?product=&currency=&actor_id=
+    event: book       — уровень стакана (абсолютные quantity/lots, 0 — уровень исчез)
+    event: trade      — сделка
+    event: wallet     — баланс кошелька своего актора
+    event: inventory  — количество предмета у своего актора
+    event: overflow   — клиент не успевал читать; нужно перечитать снимок и переподключиться
+
+Работает под ASGI (uvicorn-воркеры gunicorn): каждое соединение — корутина,
+а не занятый поток воркера.
+"""
+
+import asyncio
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import JsonResponse, StreamingHttpResponse
+from rest_framework import exceptions
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+
+from accounts.authentication import AutomatTokenAuthentication
+from actors.models import Actor
+from eve_backend.events import subscribe, unsubscribe
+
+# Интервал комментария-пинга, чтобы прокси не рвали простаивающее соединение
+HEARTBEAT = 15
+
+
+def _authenticate(request):
+    """
+    Те же схемы, что и у API. EventSource в браузере не умеет заголовки,
+    поэтому JWT можно передать и параметром ?token=.
+    """
+    for backend in (AutomatTokenAuthentication(), JWTAuthentication()):
+        result = backend.authenticate(request)
+        if result:
+            return result[0]
+
+    token = request.GET.get('token')
+    if token:
+        jwt = JWTAuthentication()
+        return jwt.get_user(jwt.get_validated_token(token))
+    return None
+
+
+def _resolve_actor_id(user, actor_id):
+    """Игрок получает события только своего актора, мастер и automat — любого"""
+    if user.role == 'player':
+        actor = Actor.objects.filter(user=user).only('id').first()
+        return actor.id if actor else None
+    return actor_id
+
+
+def _int_param(request, name):
+    value = request.GET.get(name)
+    if value in (None, ''):
+        return None
+    return int(value)
+
+
+async def market_stream(request):
+    try:
+        user = await sync_to_async(_authenticate)(request)
+    except (exceptions.AuthenticationFailed, InvalidToken, TokenError):
+        user = None
+    if user is None or not user.is_active:
+        return JsonResponse({"error": "Требуется авторизация"}, status=401)
+    if not settings.EVENT_STREAM_ENABLED:
+        # Без публикации подписка молчала бы вечно
+        return JsonResponse({"error": "Поток событий выключен (EVENT_STREAM_ENABLED)"}, status=503)
+
+    try:
+        product_id = _int_param(request, 'product')
+        currency_id = _int_param(request, 'currency')
+        actor_id = _int_param(request, 'actor_id')
+    except ValueError:
+        return JsonResponse({"error": "product, currency и actor_id должны быть числами"}, status=400)
+
+    actor_id = await sync_to_async(_resolve_actor_id)(user, actor_id)
+
+    def match(event):
+        if event['type'] in ('wallet', 'inventory'):
+            return actor_id is not None and event['actor'] == actor_id
+        return ((product_id is None or event['product'] == product_id)
+                and (currency_id is None or event['currency'] == currency_id))
+
+    async def stream():
+        subscription = subscribe(match)
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    event = await subscription.get(HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                if event is None:
+                    yield "event: overflow\ndata: {}\n\n"
+                    return
+                yield f"event: {event['type']}\ndata: {json.dumps(event, cls=DjangoJSONEncoder)}\n\n"
+        finally:
+            unsubscribe(subscription)
+
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
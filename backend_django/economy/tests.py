@@ -1,3 +1,406 @@
-from django.test import TestCase
+from datetime import datetime, timezone as dt_timezone
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.db import connection
+from django.db.models import Sum
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APITestCase
+
+from accounts.models import User
+from actors.models import Actor
+from eve_backend.money import Money
+from products.models import Product
+from wallet_inventory.models import FrozenInventory, FrozenWallet, Inventory, Wallet
+from wallet_inventory.utils import change_inventory_quantity, change_wallet_amount
+from .auction import clearing_price
+from .commission import settle_commissions
+from .market_data import DepthDelta, rebuild_depth
+from .matching import get_book, reset_books
+from .models import BrokerAccrual, Candle, Currency, MarketDepthLevel, MarketLot, Trade
+
+
+class MarketTestCase(APITestCase):
+    """Пара sword/gold, мастер и три участника по 1000 gold и 50 sword (через журнал)"""
+
+    def setUp(self):
+        # Стаканы живут в памяти процесса, а данные теста откатываются
+        reset_books()
+        self.master = User.objects.create_user(login='gm', password='x', role='master', is_staff=True)
+        self.client.force_authenticate(self.master)
+        self.gold = Currency.objects.create(name='Gold', symbol='G')
+        self.sword = Product.objects.create(name='Sword', price=Decimal('10'), currency=self.gold)
+        self.alice, self.bob, self.carol = (
+            Actor.objects.create(name=name, type='npc') for name in ('alice', 'bob', 'carol')
+        )
+        for actor in (self.alice, self.bob, self.carol):
+            change_wallet_amount(actor, self.gold, Money('1000'))
+            change_inventory_quantity(actor, self.sword, 50)
+
+    def tearDown(self):
+        reset_books()
+
+    def lot_data(self, actor, lot_type, quantity, price, **extra):
+        return {
+            'actor_id': actor.id, 'lot_type': lot_type, 'product': self.sword.id,
+            'quantity': quantity, 'price_per_unit': str(price), 'currency': self.gold.id, **extra,
+        }
+
+    def post(self, url, data=None):
+        # Как в проде: обработчики on_commit (стакан, глубина) выполняются после запроса
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(url, data, format='json')
+
+    def place(self, actor, lot_type, quantity, price, **extra):
+        response = self.post('/economy/market/lots/', self.lot_data(actor, lot_type, quantity, price, **extra))
+        self.assertEqual(response.status_code, 201, response.data)
+        return MarketLot.objects.get(id=response.data['id'])
+
+    def wallet(self, actor):
+        return Wallet.objects.filter(actor=actor, currency=self.gold).aggregate(s=Sum('amount'))['s'] or 0
+
+    def inventory(self, actor):
+        return Inventory.objects.filter(actor=actor, product=self.sword).aggregate(s=Sum('quantity'))['s'] or 0
+
+    def money_supply(self):
+        """Деньги в кошельках, escrow и невыплаченных комиссиях"""
+        unpaid = BrokerAccrual.objects.filter(currency=self.gold, payout__isnull=True)
+        return sum(
+            queryset.aggregate(s=Sum('amount'))['s'] or 0
+            for queryset in (Wallet.objects.filter(currency=self.gold),
+                             FrozenWallet.objects.filter(currency=self.gold), unpaid)
+        )
+
+    def item_supply(self):
+        return sum(
+            model.objects.filter(product=self.sword).aggregate(s=Sum('quantity'))['s'] or 0
+            for model in (Inventory, FrozenInventory)
+        )
+
+
+class MatchingTests(MarketTestCase):
+    def test_price_time_priority(self):
+        older = self.place(self.alice, 'sell', 3, 12)
+        newer = self.place(self.bob, 'sell', 3, 12)
+        cheaper = self.place(self.carol, 'sell', 2, 11)
+        dave = Actor.objects.create(name='dave', type='npc')
+        change_wallet_amount(dave, self.gold, Money('100'))
+
+        buy = self.place(dave, 'buy', 4, 12)
+
+        # Сначала лучшая цена, затем более ранний лот того же уровня
+        fills = list(Trade.objects.order_by('id').values_list('sell_lot_id', 'quantity', 'price'))
+        self.assertEqual(fills, [(cheaper.id, 2, Decimal('11')), (older.id, 2, Decimal('12'))])
+        newer.refresh_from_db()
+        self.assertEqual(newer.remaining_quantity, 3)
+        buy.refresh_from_db()
+        self.assertEqual(buy.status, 'completed')
+
+    def test_partial_fill_rests_in_book(self):
+        sell = self.place(self.alice, 'sell', 10, 12)
+        buy = self.place(self.bob, 'buy', 4, 13)
+
+        sell.refresh_from_db()
+        buy.refresh_from_db()
+        self.assertEqual((sell.status, sell.remaining_quantity), ('active', 6))
+        self.assertEqual((buy.status, buy.remaining_quantity), ('completed', 0))
+        # Сделка по цене лежащего лота; escrow продавца — под неисполненный остаток
+        self.assertEqual(Trade.objects.get().price, Decimal('12'))
+        self.assertEqual(FrozenInventory.objects.get(lot=sell).quantity, 6)
+        self.assertFalse(FrozenWallet.objects.filter(lot=buy).exists())
+        self.assertEqual(self.inventory(self.bob), 54)
+
+        # Остаток исполняется следующим встречным лотом
+        self.place(self.carol, 'buy', 6, 12)
+        sell.refresh_from_db()
+        self.assertEqual((sell.status, sell.remaining_quantity), ('completed', 0))
+
+    def test_sweep_across_levels(self):
+        self.place(self.alice, 'sell', 2, 10)
+        self.place(self.alice, 'sell', 2, 11)
+        self.place(self.alice, 'sell', 2, 13)
+
+        buy = self.place(self.bob, 'buy', 5, 12)
+
+        self.assertEqual(list(Trade.objects.order_by('id').values_list('quantity', 'price')),
+                         [(2, Decimal('10')), (2, Decimal('11'))])
+        buy.refresh_from_db()
+        self.assertEqual((buy.status, buy.remaining_quantity), ('active', 1))
+        # Покупатель заморозил 5 x 12, заплатил 42, под остаток осталось 12
+        self.assertEqual(self.wallet(self.bob), Money('1000') - Money('42') - Money('12'))
+
+    def test_unbacked_maker_is_quarantined(self):
+        broken = self.place(self.alice, 'sell', 5, 11)
+        backed = self.place(self.bob, 'sell', 5, 12)
+        # Escrow лучшего мейкера потерян — расчёт по нему невозможен
+        FrozenInventory.objects.filter(lot=broken).delete()
+
+        buy = self.place(self.carol, 'buy', 5, 12)
+
+        self.assertEqual(list(Trade.objects.values_list('sell_lot_id', 'quantity')), [(backed.id, 5)])
+        broken.refresh_from_db()
+        buy.refresh_from_db()
+        self.assertEqual(broken.status, 'cancelled')
+        self.assertEqual(buy.status, 'completed')
+        self.assertNotIn(broken.id, get_book(self.sword.id, self.gold.id))
+
+    def test_no_cross_leaves_both_lots(self):
+        sell = self.place(self.alice, 'sell', 5, 12)
+        buy = self.place(self.bob, 'buy', 5, 11)
+
+        self.assertFalse(Trade.objects.exists())
+        self.assertEqual(MarketLot.objects.filter(status='active').count(), 2)
+        book = get_book(self.sword.id, self.gold.id)
+        self.assertIn(sell.id, book)
+        self.assertIn(buy.id, book)
+
+    def test_cancel_returns_escrow_and_leaves_book(self):
+        money, items = self.money_supply(), self.item_supply()
+        buy = self.place(self.bob, 'buy', 5, 8)
+        self.assertEqual(self.wallet(self.bob), Money('960'))
+
+        response = self.post(f'/economy/market/lots/{buy.id}/cancel/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.wallet(self.bob), Money('1000'))
+        self.assertFalse(FrozenWallet.objects.exists())
+        self.assertNotIn(buy.id, get_book(self.sword.id, self.gold.id))
+        self.assertEqual((self.money_supply(), self.item_supply()), (money, items))
+
+
+class ClearingPriceTests(MarketTestCase):
+    def lots(self, *levels):
+        return [SimpleNamespace(price_per_unit=Decimal(price), remaining_quantity=quantity) for price, quantity in levels]
+
+    def test_maximises_volume(self):
+        sells = self.lots((9, 10), (10, 10))
+        buys = self.lots((11, 8), (10, 8), (13, 8))
+        self.assertEqual(clearing_price(buys, sells), (Decimal(10), 20))
+
+    def test_no_cross(self):
+        self.assertEqual(clearing_price(self.lots((9, 5)), self.lots((10, 5))), (None, 0))
+        self.assertEqual(clearing_price([], self.lots((10, 5))), (None, 0))
+
+    def test_equal_candidates_take_middle(self):
+        # 10 и 12 равноценны — из чётного числа кандидатов берётся нижний средний
+        self.assertEqual(clearing_price(self.lots((12, 5)), self.lots((10, 5))), (Decimal(10), 5))
+        # Объём 6 без дисбаланса — только на 11
+        self.assertEqual(clearing_price(self.lots((12, 5), (11, 1)), self.lots((10, 5), (11, 1))),
+                         (Decimal(11), 6))
+
+    def test_auction_settles_at_clearing_price(self):
+        resting = self.place(self.carol, 'sell', 4, 15)
+        response = self.post('/economy/market/lots/bulk_create/', {'auction': True, 'lots': [
+            self.lot_data(self.alice, 'sell', 10, 9),
+            self.lot_data(self.alice, 'sell', 10, 10),
+            self.lot_data(self.bob, 'buy', 8, 11),
+            self.lot_data(self.bob, 'buy', 8, 10),
+            self.lot_data(self.bob, 'buy', 8, 13),
+        ]})
+
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(response.data['errors'], [])
+        self.assertEqual(set(Trade.objects.values_list('price', flat=True)), {Decimal(10)})
+        self.assertEqual(Trade.objects.aggregate(s=Sum('quantity'))['s'], 20)
+        # Лот стакана дороже цены клиринга не исполняется
+        resting.refresh_from_db()
+        self.assertEqual(resting.remaining_quantity, 4)
+
+
+class MarketDepthTests(MarketTestCase):
+    def depth(self, **params):
+        response = self.client.get('/economy/market/depth/', {'product': self.sword.id, 'currency': self.gold.id, **params})
+        self.assertEqual(response.status_code, 200, response.data)
+        return (
+            [(Decimal(level['price']), level['quantity'], level['lots']) for level in response.data['bids']],
+            [(Decimal(level['price']), level['quantity'], level['lots']) for level in response.data['asks']],
+        )
+
+    def levels(self):
+        return sorted(MarketDepthLevel.objects.values_list('side', 'price', 'quantity', 'lot_count'))
+
+    def test_depth_follows_lots(self):
+        self.place(self.alice, 'sell', 5, 12)
+        second = self.place(self.alice, 'sell', 3, 12)
+        self.place(self.alice, 'sell', 5, 11)
+        self.place(self.bob, 'buy', 5, 8)
+        self.assertEqual(self.depth(), ([(8, 5, 1)], [(11, 5, 1), (12, 8, 2)]))
+
+        # Сделка снимает уровень 11 целиком и часть уровня 12
+        self.place(self.bob, 'buy', 7, 12)
+        self.assertEqual(self.depth(), ([(8, 5, 1)], [(12, 6, 2)]))
+
+        self.post(f'/economy/market/lots/{second.id}/cancel/')
+        self.assertEqual(self.depth(), ([(8, 5, 1)], [(12, 3, 1)]))
+
+        # Инкрементальный агрегат совпадает с пересобранным из лотов
+        incremental = self.levels()
+        rebuild_depth()
+        self.assertEqual(self.levels(), incremental)
+
+    def test_levels_parameter(self):
+        for price in (10, 11, 12):
+            self.place(self.alice, 'sell', 1, price)
+        self.assertEqual(len(self.depth(levels=2)[1]), 2)
+        # Вне диапазона — прижимается к 1..MAX_DEPTH_LEVELS
+        self.assertEqual(len(self.depth(levels=-5)[1]), 1)
+        self.assertEqual(len(self.depth(levels=10 ** 6)[1]), 3)
+
+        url = '/economy/market/depth/'
+        self.assertEqual(self.client.get(url, {'product': self.sword.id, 'currency': self.gold.id, 'levels': 'x'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'product': 'x', 'currency': self.gold.id}).status_code, 400)
+        self.assertEqual(self.client.get(url).status_code, 400)
+
+    def test_delta_applies_levels_in_key_order(self):
+        delta = DepthDelta()
+        for price in (13, 11, 12):
+            delta.add(SimpleNamespace(product_id=self.sword.id, currency_id=self.gold.id, lot_type='sell',
+                                      price_per_unit=Decimal(price)), 1, 1)
+        with CaptureQueriesContext(connection) as queries:
+            delta.apply()
+        # Строки upsert идут в порядке (product, currency, side, price), а не вставки
+        self.assertIn("ARRAY['sell','sell','sell']::varchar[], ARRAY[1100,1200,1300]::bigint[]", queries[0]['sql'])
+        self.assertEqual([level[1] for level in self.levels()], [11, 12, 13])
+
+
+class CandleTests(MarketTestCase):
+    def candles(self, interval):
+        response = self.client.get('/economy/market/candles/',
+                                   {'product': self.sword.id, 'currency': self.gold.id, 'interval': interval})
+        self.assertEqual(response.status_code, 200, response.data)
+        return [(Decimal(c['open']), Decimal(c['high']), Decimal(c['low']), Decimal(c['close']), c['volume'],
+                 c['trade_count']) for c in response.data]
+
+    @mock.patch('economy.market_data.timezone.now', return_value=datetime(2026, 1, 1, 12, 30, 15, tzinfo=dt_timezone.utc))
+    def test_trades_merge_into_candles(self, now):
+        self.place(self.alice, 'sell', 5, 12)
+        self.place(self.alice, 'sell', 3, 13)
+        self.place(self.alice, 'sell', 5, 11)
+        self.place(self.bob, 'buy', 7, 13)
+        self.place(self.bob, 'buy', 4, 13)
+        # Второй пачкой свеча расширяется: open остаётся от первой сделки
+        for interval in ('1m', '1h', '1d'):
+            self.assertEqual(self.candles(interval), [(11, 13, 11, 13, 11, 4)])
+
+    def test_unknown_interval(self):
+        response = self.client.get('/economy/market/candles/',
+                                   {'product': self.sword.id, 'currency': self.gold.id, 'interval': '5m'})
+        self.assertEqual(response.status_code, 400)
+
+
+class BulkCancelTests(MarketTestCase):
+    URL = '/economy/market/lots/bulk_cancel/'
+
+    def setUp(self):
+        super().setUp()
+        self.asks = [self.place(self.alice, 'sell', 2, price) for price in (12, 13, 14)]
+        self.bids = [self.place(self.bob, 'buy', 3, price) for price in (5, 6)]
+
+    def statuses(self, lots):
+        return [MarketLot.objects.get(id=lot.id).status for lot in lots]
+
+    def test_filters_combine(self):
+        response = self.post(self.URL, {'actor_id': self.alice.id, 'ids': [self.asks[0].id, self.bids[0].id]})
+        self.assertEqual(response.data, {"status": "cancelled", "cancelled": 1})
+        self.assertEqual(self.statuses(self.asks), ['cancelled', 'active', 'active'])
+        self.assertEqual(self.statuses(self.bids), ['active', 'active'])
+
+    def test_escrow_returned_and_book_emptied(self):
+        response = self.post(self.URL, {'product': self.sword.id})
+        self.assertEqual(response.data["cancelled"], 5)
+        self.assertEqual((self.inventory(self.alice), self.wallet(self.bob)), (50, 1000))
+        self.assertFalse(FrozenInventory.objects.exists() or FrozenWallet.objects.exists())
+        self.assertFalse(MarketDepthLevel.objects.exists())
+        self.assertEqual(len(get_book(self.sword.id, self.gold.id)), 0)
+
+    def test_player_cancels_only_own_lots(self):
+        player = User.objects.create_user(login='p1', password='x', role='player')
+        self.alice.user = player
+        self.alice.save()
+        self.client.force_authenticate(player)
+        response = self.post(self.URL, {'ids': [lot.id for lot in self.asks + self.bids]})
+        self.assertEqual(response.data["cancelled"], 3)
+        self.assertEqual(self.statuses(self.bids), ['active', 'active'])
+
+    def test_invalid_filters(self):
+        self.assertEqual(self.post(self.URL, {}).status_code, 400)
+        self.assertEqual(self.post(self.URL, {'ids': ['x']}).status_code, 400)
+        self.assertEqual(self.post(self.URL, {'lot_type': 'swap'}).status_code, 400)
+        self.assertEqual(MarketLot.objects.filter(status='active').count(), 5)
+
+
+class LotPriceTests(MarketTestCase):
+    def test_price_must_be_positive(self):
+        for price in ('0', '-5', '0.001'):
+            with self.subTest(price):
+                response = self.post('/economy/market/lots/', self.lot_data(self.alice, 'sell', 1, price))
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('price_per_unit', str(response.data))
+
+        response = self.post('/economy/market/lots/bulk_create/', {
+            'auction': True, 'lots': [self.lot_data(self.alice, 'sell', 1, '-5')],
+        })
+        self.assertEqual(response.data['created'], [])
+        self.assertEqual(len(response.data['errors']), 1)
+        self.assertFalse(MarketLot.objects.exists())
+
+    def test_prices_stored_in_minor_units(self):
+        self.place(self.alice, 'sell', 2, '12.34')
+        self.place(self.bob, 'buy', 1, '12.34')
+        self.assertEqual(Trade.objects.get().price, Money('12.34'))
+        self.assertEqual(MarketDepthLevel.objects.get().price, Money('12.34'))
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT price FROM {Trade._meta.db_table}")
+            self.assertEqual(cursor.fetchone()[0], 1234)
+            cursor.execute(f"SELECT open, close FROM {Candle._meta.db_table} WHERE interval = '1d'")
+            self.assertEqual(cursor.fetchone(), (1234, 1234))
+
+
+@override_settings(BROKER_COMMISSION_BPS=100)
+class ConservationTests(MarketTestCase):
+    def test_trade_with_commission(self):
+        money, items = self.money_supply(), self.item_supply()
+
+        self.place(self.alice, 'sell', 10, 12, broker=self.carol.id)
+        self.place(self.bob, 'buy', 4, 13)
+
+        # 4 x 12 = 48, комиссия 1% продавца — брокеру carol
+        accrual = BrokerAccrual.objects.get()
+        self.assertEqual((accrual.payer_id, accrual.broker_id, accrual.amount), (self.alice.id, self.carol.id, Money('0.48')))
+        self.assertEqual(self.wallet(self.alice), Money('1047.52'))
+        # Покупатель замораживал по 13, разница возвращена
+        self.assertEqual(self.wallet(self.bob), Money('952'))
+        self.assertEqual((self.money_supply(), self.item_supply()), (money, items))
+
+        payouts = settle_commissions()
+        self.assertEqual([(p.recipient_id, p.amount) for p in payouts], [(self.carol.id, Money('0.48'))])
+        self.assertEqual(self.wallet(self.carol), Money('1000.48'))
+        self.assertEqual((self.money_supply(), self.item_supply()), (money, items))
+
+    def test_self_broker_is_rejected(self):
+        response = self.post('/economy/market/lots/', self.lot_data(self.alice, 'sell', 10, 12, broker=self.alice.id))
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('broker', response.data)
+        self.assertFalse(MarketLot.objects.exists())
+
+        response = self.post('/economy/market/lots/bulk_create/', {
+            'auction': True, 'lots': [self.lot_data(self.alice, 'sell', 10, 12, broker=self.alice.id)],
+        })
+        self.assertEqual(response.data['created'], [])
+        self.assertIn('broker', response.data['errors'][0]['error'])
+        self.assertFalse(MarketLot.objects.exists())
+
+    def test_cancel_returns_escrow(self):
+        money, items = self.money_supply(), self.item_supply()
+        buy = self.place(self.bob, 'buy', 5, 8)
+        self.assertEqual(self.wallet(self.bob), Money('960'))
+
+        response = self.client.post(f'/economy/market/lots/{buy.id}/cancel/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.wallet(self.bob), Money('1000'))
+        self.assertFalse(FrozenWallet.objects.exists())
+        self.assertEqual((self.money_supply(), self.item_supply()), (money, items))
@@ -2,7 +2,9 @@ from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 
 from products.views import ProductViewSet
-from .views import CurrencyViewSet, TagViewSet, MarketLotViewSet, TransferViewSet
+from .views import CurrencyViewSet, TagViewSet, MarketLotViewSet, TransferViewSet, MarketDepthView, \
+    MarketTradesView, MarketCandlesView, MarketOverviewView
+from .stream import market_stream
 
 router = DefaultRouter()
 router.register(r'products', ProductViewSet, basename='product')
@@ -12,5 +14,10 @@ router.register(r'market/lots', MarketLotViewSet, basename='market-lot')
 router.register(r'transfers', TransferViewSet, basename='transfer')
 
 urlpatterns = [
+    path('market/depth/', MarketDepthView.as_view(), name='market-depth'),
+    path('market/overview/', MarketOverviewView.as_view(), name='market-overview'),
+    path('market/stream/', market_stream, name='market-stream'),
+    path('market/trades/', MarketTradesView.as_view(), name='market-trades'),
+    path('market/candles/', MarketCandlesView.as_view(), name='market-candles'),
     path('', include(router.urls)),
 ]
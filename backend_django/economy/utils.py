@@ -1,4 +1,5 @@
 from django.db import transaction
+from wallet_inventory.escrow import EscrowRef
 from wallet_inventory.utils import (
     unfreeze_inventory,
     unfreeze_wallet,
@@ -14,7 +15,7 @@ def accept_transfer(transfer: Transfer):
     if transfer.status != 'pending' or transfer.transfer_type != 'request':
         raise ValueError("Можно принять только pending-запрос")
 
-    reason = f"transfer:{transfer.id}"
+    escrow = EscrowRef.transfer(transfer.id)
 
     with transaction.atomic():
         if transfer.product:
@@ -22,7 +23,7 @@ def accept_transfer(transfer: Transfer):
                 actor=transfer.recipient,
                 product=transfer.product,
                 quantity=transfer.quantity,
-                reason=reason,
+                escrow=escrow,
             )
             change_inventory_quantity(
                 actor=transfer.sender,
@@ -34,7 +35,7 @@ def accept_transfer(transfer: Transfer):
                 actor=transfer.recipient,
                 currency=transfer.currency,
                 amount=transfer.amount,
-                reason=reason,
+                escrow=escrow,
             )
             change_wallet_amount(
                 actor=transfer.sender,
@@ -53,7 +54,7 @@ def reject_transfer(transfer: Transfer):
     if transfer.status != 'pending' or transfer.transfer_type != 'request':
         raise ValueError("Можно отклонить только pending-запрос")
 
-    reason = f"transfer:{transfer.id}"
+    escrow = EscrowRef.transfer(transfer.id)
 
     with transaction.atomic():
         if transfer.product:
@@ -61,14 +62,14 @@ def reject_transfer(transfer: Transfer):
                 actor=transfer.recipient,
                 product=transfer.product,
                 quantity=transfer.quantity,
-                reason=reason,
+                escrow=escrow,
             )
         else:
             unfreeze_wallet(
                 actor=transfer.recipient,
                 currency=transfer.currency,
                 amount=transfer.amount,
-                reason=reason,
+                escrow=escrow,
             )
 
         transfer.status = 'rejected'
@@ -2,21 +2,32 @@
 
 from rest_framework import viewsets, status, permissions
 from rest_framework.decorators import action
+from rest_framework.exceptions import PermissionDenied, ValidationError
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.views import APIView
 from django.db import transaction
+from django.db.models import Exists, OuterRef, ProtectedError
 from django.shortcuts import get_object_or_404
-from decimal import Decimal
 
+from accounts.idempotency import idempotent, record_response
 from actors.models import Actor
-from wallet_inventory.models import FrozenInventory, FrozenWallet
-from .models import MarketLot, Transfer, Currency, Tag
-from .serializers import MarketLotSerializer, TransferSerializer, CurrencySerializer, TagSerializer
+from products.models import Product
+from .auction import run_auction
+from .market_data import DepthDelta, record_depth, market_overview
+from .matching import match_lot, execute_trade, discard_lot, close_lots
+from .pagination import MarketLotKeysetPagination
+from .models import MarketLot, Transfer, Currency, Tag, MarketDepthLevel, Trade, Candle
+from .serializers import MarketLotSerializer, BulkCancelSerializer, TransferSerializer, CurrencySerializer, TagSerializer, \
+    MarketDepthLevelSerializer, TradeSerializer, CandleSerializer, MarketOverviewSerializer
 from wallet_inventory.utils import (
     freeze_inventory, unfreeze_inventory,
     freeze_wallet, unfreeze_wallet
 )
-from wallet_inventory.utils import change_inventory_quantity, change_wallet_amount
+from wallet_inventory.utils import change_inventory_quantity, change_wallet_amount, lock_balances
+from eve_backend.db import retry_on_conflict
+from wallet_inventory import ledger, valuation
+from wallet_inventory.escrow import EscrowRef
 
 class CurrencyViewSet(viewsets.ModelViewSet):
     queryset = Currency.objects.all()
@@ -28,6 +39,21 @@ class CurrencyViewSet(viewsets.ModelViewSet):
             return [permissions.AllowAny()]
         return [permissions.IsAdminUser()]  # или IsAuthenticated, если мастерам можно создавать
 
+    # Курс валюты входит в оценку портфелей
+    def perform_update(self, serializer):
+        super().perform_update(serializer)
+        valuation.invalidate_all()
+
+    def perform_destroy(self, instance):
+        super().perform_destroy(instance)
+        valuation.invalidate_all()
+
+    def destroy(self, request, *args, **kwargs):
+        try:
+            return super().destroy(request, *args, **kwargs)
+        except ProtectedError:
+            return Response({"error": "Валюта используется в лотах, сделках или журнале"}, status=409)
+
 # ---------------- Tag ----------------
 class TagViewSet(viewsets.ModelViewSet):
     queryset = Tag.objects.all()
@@ -44,9 +70,10 @@ class MarketLotViewSet(viewsets.ModelViewSet):
     queryset = MarketLot.objects.filter(status='active').select_related('actor', 'product', 'currency')
     serializer_class = MarketLotSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = MarketLotKeysetPagination
 
     def get_queryset(self):
-        qs = MarketLot.objects.filter(status='active').select_related('actor', 'product', 'currency')
+        qs = MarketLot.objects.live().select_related('actor', 'product', 'currency')
 
         product_id = self.request.query_params.get('product')
         lot_type = self.request.query_params.get('lot_type')
@@ -57,29 +84,34 @@ class MarketLotViewSet(viewsets.ModelViewSet):
             qs = qs.filter(product_id=product_id)
         if lot_type in ['sell', 'buy']:
             qs = qs.filter(lot_type=lot_type)
+        # Теги — через EXISTS, без join и DISTINCT по всему стакану
+        product_tags = Product.tags.through.objects.filter(product_id=OuterRef('product_id'))
         if tag_id:
-            qs = qs.filter(product__tags__id=tag_id)
+            qs = qs.filter(Exists(product_tags.filter(tag_id=tag_id)))
         if tag_name:
-            qs = qs.filter(product__tags__name__iexact=tag_name)  # или contains
+            qs = qs.filter(Exists(product_tags.filter(tag__name__iexact=tag_name)))
 
-        return qs.distinct()
+        return qs
+
+    # Лот и заморозка коммитятся до сопоставления — ответ сохраняется в их транзакции
+    @idempotent(atomic=False)
+    def create(self, request, *args, **kwargs):
+        return super().create(request, *args, **kwargs)
 
     def perform_create(self, serializer):
         user = self.request.user
-        actor_id = self.request.data.get('actor_id')
-        if not actor_id:
-            return Response({"error": "actor_id обязателен"}, status=status.HTTP_400_BAD_REQUEST)
-
-        actor = get_object_or_404(Actor, id=actor_id)
+        actor = get_object_or_404(Actor, id=serializer.validated_data['actor_id'])
 
         # Проверка прав: игрок — только свой актор, мастер — любой
         if user.role == 'player' and (not actor.user or actor.user != user):
-            return Response({"error": "Можно создавать лоты только от своего актора"}, status=status.HTTP_403_FORBIDDEN)
-
-        lot = serializer.save()
-        reason = f"lot:{lot.id}"
+            raise PermissionDenied("Можно создавать лоты только от своего актора")
 
+        # Лот и заморозка — одна транзакция: при нехватке активов откатывается всё.
+        # Сопоставление идёт после коммита, пакетом с другими лотами стакана
         with transaction.atomic():
+            lot = serializer.save()
+            escrow = EscrowRef.lot(lot.id)
+
             try:
                 if lot.lot_type == 'sell':
                     # Замораживаем предметы + привязываем к лоту
@@ -87,7 +119,7 @@ class MarketLotViewSet(viewsets.ModelViewSet):
                         actor=actor,
                         product=lot.product,
                         quantity=lot.quantity,
-                        reason=reason,
+                        escrow=escrow,
                         lot=lot
                     )
                 else:  # buy
@@ -96,75 +128,32 @@ class MarketLotViewSet(viewsets.ModelViewSet):
                         actor=actor,
                         currency=lot.currency,
                         amount=total,
-                        reason=reason,
+                        escrow=escrow,
                         lot=lot
                     )
+            except ValueError as e:
+                raise ValidationError({"error": str(e)})
 
-                # Пытаемся мгновенно найти и исполнить матчинг
-                self._try_execute_match(lot)
+            record_depth(opened=[lot])
+            # Повтор запроса после этого коммита получит лот, а не вторую заморозку
+            record_response(self.request, Response(MarketLotSerializer(lot).data, status=status.HTTP_201_CREATED))
 
-            except ValueError as e:
-                # Если не хватило активов — откатываем всё
-                self._unfreeze_lot(lot, reason)
-                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        # Пытаемся мгновенно найти и исполнить матчинг
+        self._try_execute_match(lot)
 
     def _try_execute_match(self, lot):
-        """Ищет и исполняет мгновенную сделку"""
-        if lot.lot_type == 'sell':
-            match = MarketLot.objects.filter(
-                status='active',
-                lot_type='buy',
-                product=lot.product,
-                currency=lot.currency,
-                price_per_unit__gte=lot.price_per_unit,
-                quantity=lot.quantity
-            ).order_by('-price_per_unit').first()
-        else:
-            match = MarketLot.objects.filter(
-                status='active',
-                lot_type='sell',
-                product=lot.product,
-                currency=lot.currency,
-                price_per_unit__lte=lot.price_per_unit,
-                quantity=lot.quantity
-            ).order_by('price_per_unit').first()
-
-        if match:
-            with transaction.atomic():
-                self._execute_trade(lot, match)
-
-    def _execute_trade(self, lot1, lot2):
-        sell_lot = lot1 if lot1.lot_type == 'sell' else lot2
-        buy_lot = lot2 if lot2.lot_type == 'buy' else lot1
-
-        seller = sell_lot.actor
-        buyer = buy_lot.actor
-        product = sell_lot.product
-        quantity = sell_lot.quantity
-        price_per_unit = sell_lot.price_per_unit  # Цена продавца
-        total = Decimal(price_per_unit) * quantity
-        currency = sell_lot.currency
-
-        # Передаём активы
-        change_inventory_quantity(buyer, product, quantity)  # +quantity покупателю
-        change_wallet_amount(seller, currency, total)  # +total продавцу
-
-        # Удаляем замороженные записи (по lot)
-        FrozenInventory.objects.filter(lot=sell_lot).delete()
-        FrozenWallet.objects.filter(lot=buy_lot).delete()
-
-        # Завершаем лоты
-        lot1.status = 'completed'
-        lot1.save()
-        lot2.status = 'completed'
-        lot2.save()
-
-    def _unfreeze_lot(self, lot, reason):
-        """Размораживает активы при ошибке или отмене"""
+        """Сводит лот со стаканом (economy.matching), в т.ч. частично и по нескольким уровням"""
+        return match_lot(lot)
+
+    def _execute_trade(self, lot1, lot2, quantity, price):
+        execute_trade(lot1, lot2, quantity, price)
+
+    def _unfreeze_lot(self, lot, escrow):
+        """Размораживает активы под неисполненный остаток лота при отмене"""
         if lot.lot_type == 'sell':
-            unfreeze_inventory(lot.actor, lot.product, lot.quantity, reason)
+            unfreeze_inventory(lot.actor, lot.product, lot.remaining_quantity, escrow)
         else:
-            unfreeze_wallet(lot.actor, lot.currency, lot.total_price, reason)
+            unfreeze_wallet(lot.actor, lot.currency, lot.remaining_total, escrow)
 
     @action(detail=True, methods=['post'])
     def cancel(self, request, pk=None):
@@ -178,13 +167,63 @@ class MarketLotViewSet(viewsets.ModelViewSet):
         if lot.status != 'active':
             return Response({"error": "Лот уже не активен"}, status=status.HTTP_400_BAD_REQUEST)
 
-        reason = f"lot:{lot.id}"
+        if not self._cancel(lot.id):
+            return Response({"error": "Лот уже не активен"}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({"status": "cancelled"})
+
+    @retry_on_conflict('lot_cancel')
+    def _cancel(self, lot_id):
+        """Снимает лот и возвращает escrow; False — лот уже не активен"""
         with transaction.atomic():
-            self._unfreeze_lot(lot, reason)
+            # Остаток мог измениться сделкой, пока шёл запрос
+            lot = MarketLot.objects.select_for_update().get(id=lot_id)
+            if lot.status != 'active':
+                return False
+            self._unfreeze_lot(lot, EscrowRef.lot(lot.id))
+            record_depth(closed=[lot])
             lot.status = 'cancelled'
             lot.save()
+            discard_lot(lot)
+        return True
+
+    @action(detail=False, methods=['post'], url_path='bulk_cancel', permission_classes=[IsAuthenticated])
+    def bulk_cancel(self, request):
+        """
+        Массовая отмена активных лотов по фильтрам actor_id, product, lot_type, ids.
+        Escrow всех лотов возвращается агрегированными запросами в одной транзакции.
+        """
+        user = request.user
+        serializer = BulkCancelSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response({"error": serializer.errors}, status=400)
+        actor_id = serializer.validated_data.get('actor_id')
+        product_id = serializer.validated_data.get('product')
+        lot_type = serializer.validated_data.get('lot_type')
+        ids = serializer.validated_data.get('ids')
+
+        qs = MarketLot.objects.filter(status='active')
+        # Игрок может отменять только лоты своего актора
+        if user.role == 'player':
+            qs = qs.filter(actor__user=user)
+        if actor_id:
+            qs = qs.filter(actor_id=actor_id)
+        if product_id:
+            qs = qs.filter(product_id=product_id)
+        if lot_type:
+            qs = qs.filter(lot_type=lot_type)
+        if ids is not None:
+            qs = qs.filter(id__in=ids)
 
-        return Response({"status": "cancelled"})
+        @retry_on_conflict('lots_cancel')
+        def cancel_lots():
+            with transaction.atomic():
+                lots = list(qs.select_for_update(of=('self',)).order_by('id'))
+                close_lots(lots, 'cancelled')
+            return lots
+
+        lots = cancel_lots()
+        return Response({"status": "cancelled", "cancelled": len(lots)})
 
     @action(detail=False, methods=['post'], url_path='bulk_create', permission_classes=[IsAuthenticated])
     def bulk_create(self, request):
@@ -197,8 +236,18 @@ class MarketLotViewSet(viewsets.ModelViewSet):
         if not lots_data or not isinstance(lots_data, list):
             return Response({"error": "Ожидается список лотов в поле 'lots'"}, status=400)
 
+        # Режим аукциона: пакет + стакан сводятся по единой цене клиринга
+        if request.data.get('auction'):
+            lots, errors, clearing = run_auction(lots_data)
+            return Response({
+                "created": MarketLotSerializer(lots, many=True).data,
+                "errors": errors,
+                "auction": clearing,
+            })
+
         created_lots = []
         errors = []
+        depth = DepthDelta()
 
         with transaction.atomic():
             for i, lot_data in enumerate(lots_data):
@@ -210,7 +259,7 @@ class MarketLotViewSet(viewsets.ModelViewSet):
                 serializer = MarketLotSerializer(data=lot_data)
                 if serializer.is_valid():
                     lot = serializer.save()
-                    reason = f"lot:{lot.id}"
+                    escrow = EscrowRef.lot(lot.id)
 
                     try:
                         if lot.lot_type == 'sell':
@@ -218,7 +267,7 @@ class MarketLotViewSet(viewsets.ModelViewSet):
                                 actor=lot.actor,
                                 product=lot.product,
                                 quantity=lot.quantity,
-                                reason=reason,
+                                escrow=escrow,
                                 lot=lot
                             )
                         else:  # buy
@@ -227,10 +276,11 @@ class MarketLotViewSet(viewsets.ModelViewSet):
                                 actor=lot.actor,
                                 currency=lot.currency,
                                 amount=total,
-                                reason=reason,
+                                escrow=escrow,
                                 lot=lot
                             )
                         created_lots.append(serializer.data)
+                        depth.opened(lot)
                     except ValueError as e:
                         # если не хватает ресурсов — удаляем лот
                         lot.delete()
@@ -238,11 +288,127 @@ class MarketLotViewSet(viewsets.ModelViewSet):
                 else:
                     errors.append({"index": i, "error": serializer.errors})
 
+            depth.apply()
+
         return Response({
             "created": created_lots,
             "errors": errors
         })
 
+
+# Сколько уровней цен глубины рынка отдаётся на сторону максимум
+MAX_DEPTH_LEVELS = 500
+
+
+def _pair_params(request):
+    """(product_id, currency_id) из query-параметров или Response 400"""
+    try:
+        return int(request.query_params['product']), int(request.query_params['currency'])
+    except KeyError:
+        return Response({"error": "product и currency обязательны"}, status=status.HTTP_400_BAD_REQUEST)
+    except ValueError:
+        return Response({"error": "product и currency должны быть целыми"}, status=status.HTTP_400_BAD_REQUEST)
+
+
+def _limit_param(request, name, default, maximum):
+    """Целый query-параметр, зажатый в 1..maximum; None — не целое число"""
+    try:
+        value = int(request.query_params.get(name, default))
+    except ValueError:
+        return None
+    return max(1, min(value, maximum))
+
+
+class MarketDepthView(APIView):
+    """
+    Глубина рынка (L2): суммарный остаток по уровням цен для обеих сторон.
+    Читается из агрегата MarketDepthLevel, а не из списка лотов.
+    """
+    serializer_class = MarketDepthLevelSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        pair = _pair_params(request)
+        if isinstance(pair, Response):
+            return pair
+        product_id, currency_id = pair
+
+        limit = _limit_param(request, 'levels', 50, MAX_DEPTH_LEVELS)
+        if limit is None:
+            return Response({"error": "levels должен быть целым числом"}, status=status.HTTP_400_BAD_REQUEST)
+
+        levels = MarketDepthLevel.objects.filter(product_id=product_id, currency_id=currency_id)
+        bids = levels.filter(side='buy').order_by('-price')[:limit]
+        asks = levels.filter(side='sell').order_by('price')[:limit]
+
+        return Response({
+            "product": product_id,
+            "currency": currency_id,
+            "bids": MarketDepthLevelSerializer(bids, many=True).data,
+            "asks": MarketDepthLevelSerializer(asks, many=True).data,
+        })
+
+
+class MarketOverviewView(APIView):
+    """
+    Обзор рынка: лучшие bid/ask, спред и последняя цена по всем продуктам
+    одним ответом. Отдаётся из кэша снимков, который сбрасывается по продукту
+    при изменении его стакана.
+    """
+    serializer_class = MarketOverviewSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        return Response(market_overview())
+
+
+class MarketTradesView(APIView):
+    """Лента последних сделок по паре (product, currency)"""
+    serializer_class = TradeSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        pair = _pair_params(request)
+        if isinstance(pair, Response):
+            return pair
+        product_id, currency_id = pair
+
+        limit = _limit_param(request, 'limit', 100, 1000)
+        if limit is None:
+            return Response({"error": "limit должен быть целым числом"}, status=status.HTTP_400_BAD_REQUEST)
+
+        trades = Trade.objects.filter(product_id=product_id, currency_id=currency_id).order_by('-created_at', '-id')[:limit]
+        return Response(TradeSerializer(trades, many=True).data)
+
+
+class MarketCandlesView(APIView):
+    """
+    Свечи OHLCV по паре (product, currency).
+    Читаются из заранее агрегированной таблицы Candle, сырые сделки не сканируются.
+    """
+    serializer_class = CandleSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        pair = _pair_params(request)
+        if isinstance(pair, Response):
+            return pair
+        product_id, currency_id = pair
+        interval = request.query_params.get('interval', '1h')
+        if interval not in dict(Candle.INTERVAL_CHOICES):
+            return Response({"error": "interval: 1m, 1h или 1d"}, status=status.HTTP_400_BAD_REQUEST)
+
+        limit = _limit_param(request, 'limit', 200, 1000)
+        if limit is None:
+            return Response({"error": "limit должен быть целым числом"}, status=status.HTTP_400_BAD_REQUEST)
+
+        candles = Candle.objects.filter(
+            product_id=product_id, currency_id=currency_id, interval=interval
+        ).order_by('-bucket')[:limit]
+        # В ответе — по возрастанию времени, как их рисует график
+        return Response(CandleSerializer(reversed(list(candles)), many=True).data)
+
+
 class TransferViewSet(viewsets.ModelViewSet):
     queryset = Transfer.objects.all().select_related('sender', 'recipient', 'product', 'currency')
     serializer_class = TransferSerializer
@@ -260,6 +426,10 @@ class TransferViewSet(viewsets.ModelViewSet):
 
     # Убрали perform_create — вся логика теперь в сериализаторе
 
+    @idempotent
+    def create(self, request, *args, **kwargs):
+        return super().create(request, *args, **kwargs)
+
     @action(detail=True, methods=['post'])
     def accept(self, request, pk=None):
         transfer = self.get_object()
@@ -272,25 +442,36 @@ class TransferViewSet(viewsets.ModelViewSet):
         if transfer.status != 'pending' or transfer.transfer_type != 'request':
             return Response({"error": "Нельзя принять этот перевод"}, status=400)
 
-        reason = f"transfer:{transfer.id}"
+        escrow = EscrowRef.transfer(transfer.id)
 
-        with transaction.atomic():
+        try:
+            self._accept(transfer, escrow)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=400)
+
+        return Response({"status": "accepted"})
+
+    @retry_on_conflict('transfer_accept')
+    def _accept(self, transfer, escrow):
+        with transaction.atomic(), ledger.operation(str(escrow)):
+            actors = (transfer.recipient.id, transfer.sender.id)
+            # Строки обоих акторов — в общем порядке, до первого изменения
             if transfer.product:
+                lock_balances(inventory_keys=[(actor_id, transfer.product.id) for actor_id in actors])
+                # Сначала размораживаем: списание ниже не пропустит уход в минус
+                unfreeze_inventory(transfer.recipient, transfer.product, transfer.quantity, escrow)
                 # Отдаём предмет от получателя отправителю
                 change_inventory_quantity(transfer.recipient, transfer.product, -transfer.quantity)
                 change_inventory_quantity(transfer.sender, transfer.product, transfer.quantity)
-                # Размораживаем (если было заморожено)
-                unfreeze_inventory(transfer.recipient, transfer.product, transfer.quantity, reason)
             else:
+                lock_balances(wallet_keys=[(actor_id, transfer.currency.id) for actor_id in actors])
+                unfreeze_wallet(transfer.recipient, transfer.currency, transfer.amount, escrow)
                 change_wallet_amount(transfer.recipient, transfer.currency, -transfer.amount)
                 change_wallet_amount(transfer.sender, transfer.currency, transfer.amount)
-                unfreeze_wallet(transfer.recipient, transfer.currency, transfer.amount, reason)
 
             transfer.status = 'accepted'
             transfer.save()
 
-        return Response({"status": "accepted"})
-
     @action(detail=True, methods=['post'])
     def reject(self, request, pk=None):
         transfer = self.get_object()
@@ -302,14 +483,14 @@ class TransferViewSet(viewsets.ModelViewSet):
         if transfer.status != 'pending':
             return Response({"error": "Нельзя отклонить"}, status=400)
 
-        reason = f"transfer:{transfer.id}"
+        escrow = EscrowRef.transfer(transfer.id)
 
         with transaction.atomic():
             if transfer.transfer_type == 'request':
                 if transfer.product:
-                    unfreeze_inventory(transfer.recipient, transfer.product, transfer.quantity, reason)
+                    unfreeze_inventory(transfer.recipient, transfer.product, transfer.quantity, escrow)
                 else:
-                    unfreeze_wallet(transfer.recipient, transfer.currency, transfer.amount, reason)
+                    unfreeze_wallet(transfer.recipient, transfer.currency, transfer.amount, escrow)
 
             transfer.status = 'rejected'
             transfer.save()
@@ -327,14 +508,14 @@ class TransferViewSet(viewsets.ModelViewSet):
         if transfer.status != 'pending':
             return Response({"error": "Нельзя отменить"}, status=400)
 
-        reason = f"transfer:{transfer.id}"
+        escrow = EscrowRef.transfer(transfer.id)
 
         with transaction.atomic():
             if transfer.transfer_type == 'request':
                 if transfer.product:
-                    unfreeze_inventory(transfer.recipient, transfer.product, transfer.quantity, reason)
+                    unfreeze_inventory(transfer.recipient, transfer.product, transfer.quantity, escrow)
                 else:
-                    unfreeze_wallet(transfer.recipient, transfer.currency, transfer.amount, reason)
+                    unfreeze_wallet(transfer.recipient, transfer.currency, transfer.amount, escrow)
 
             transfer.status = 'cancelled'
             transfer.save()
@@ -0,0 +1,64 @@
+# eve_backend/db.py
+"""
+Повтор транзакции при конфликте блокировок.
+
+Postgres разрывает взаимную блокировку, откатывая одну из транзакций
+(deadlock_detected, 40P01), а при REPEATABLE READ может отказать в
+сериализации (serialization_failure, 40001). Такая транзакция безопасна к
+повтору целиком: декоратор повторяет функцию со случайной экспоненциальной
+паузой и считает повторы в метриках.
+"""
+
+import functools
+import logging
+import random
+import time
+
+from django.db import DatabaseError, connection
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE = {
+    '40P01': 'deadlock',
+    '40001': 'serialization',
+}
+
+
+def _conflict(error):
+    return RETRYABLE.get(getattr(error.__cause__, 'pgcode', None))
+
+
+def retry_on_conflict(operation, attempts=5, base_delay=0.02, max_delay=1.0, on_retry=None):
+    """
+    Декоратор функции, открывающей свою транзакцию. Внутри чужой транзакции
+    повтор невозможен (она уже откачена) — функция выполняется один раз,
+    а повторяет её тот, кто открыл внешнюю транзакцию.
+    on_retry(*args, **kwargs) вызывается перед повтором (сброс кэшей в памяти).
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if connection.in_atomic_block:
+                return func(*args, **kwargs)
+
+            for attempt in range(attempts):
+                try:
+                    return func(*args, **kwargs)
+                except DatabaseError as e:
+                    reason = _conflict(e)
+                    if reason is None:
+                        raise
+                    if attempt == attempts - 1:
+                        metrics.increment('db_retry_exhausted', operation=operation, reason=reason)
+                        logger.error("%s: %s, попытки исчерпаны (%d)", operation, reason, attempts)
+                        raise
+                    metrics.increment('db_retry', operation=operation, reason=reason)
+                    delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+                    logger.warning("%s: %s, повтор %d через %.3f с", operation, reason, attempt + 1, delay)
+                    if on_retry is not None:
+                        on_retry(*args, **kwargs)
+                    time.sleep(delay)
+        return wrapper
+    return decorator
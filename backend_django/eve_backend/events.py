@@ -0,0 +1,211 @@
+# eve_backend/events.py
+"""
+Шина событий для потоковых подписок (SSE).
+
+Публикация идёт через Postgres NOTIFY, но не внутри транзакций изменений:
+транзакция с NOTIFY при коммите берёт общую для всей БД блокировку, и все
+изменяющие коммиты выстроились бы в очередь. События транзакции копятся в
+памяти и уходят одним запросом из on_commit — после коммита, а при откате
+пропадают, поэтому подписчики видят лишь закоммиченные изменения, из любого
+воркера. Выключено по умолчанию (EVENT_STREAM_ENABLED).
+В каждом процессе, где есть подписчики, один поток слушает канал и
+раскладывает события по asyncio-очередям подписок.
+"""
+
+import asyncio
+import json
+import logging
+import select
+import threading
+import time
+import weakref
+
+import psycopg2
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'eve_events'
+# Лимит payload у NOTIFY — 8000 байт, оставляем запас
+MAX_PAYLOAD = 7500
+# Подписчик, не успевающий читать, отключается: клиент переподключится и перечитает снимок
+QUEUE_SIZE = 1000
+
+
+def publish(events):
+    """
+    Отправляет пачку событий (список dict с ключом type).
+    Внутри транзакции события копятся и уходят одним NOTIFY после коммита.
+    """
+    if not events or not getattr(settings, 'EVENT_STREAM_ENABLED', False):
+        return
+    if not connection.in_atomic_block:
+        _notify(events)
+        return
+    _outbox().add(events)
+
+
+_local = threading.local()
+
+
+def _outbox():
+    """
+    Буфер событий текущей транзакции; ключ — её внешний atomic-блок.
+    Колбэк отправки регистрируется раньше всех пачек буфера: если откат
+    savepoint выбросил его, откачены и все пачки — буфер начинается заново.
+    """
+    atomic = connection.atomic_blocks[0]
+    outbox = getattr(_local, 'outbox', None)
+    if outbox is None or outbox.atomic is not atomic or outbox.flush() is None:
+        outbox = _local.outbox = _Outbox(atomic)
+    return outbox
+
+
+class _Batch:
+    """
+    Пачка событий, зарегистрированная пустым колбэком on_commit. Django держит
+    колбэк, пока блок не откачен; откат savepoint выбрасывает его, и пачка,
+    на которую буфер ссылается слабо, исчезает вместе с ним.
+    """
+    __slots__ = ('events', '__weakref__')
+
+    def __init__(self, events):
+        self.events = events
+
+    def __call__(self):
+        pass
+
+
+class _Outbox:
+    def __init__(self, atomic):
+        self.atomic = atomic
+        self.batches = []
+
+        def flush():
+            if getattr(_local, 'outbox', None) is self:
+                _local.outbox = None
+            events = [event for ref in self.batches if (batch := ref()) is not None for event in batch.events]
+            if events:
+                _notify(events)
+
+        # robust: сбой NOTIFY после коммита не должен превращать успешный запрос в ошибку
+        transaction.on_commit(flush, robust=True)
+        self.flush = weakref.ref(flush)
+
+    def add(self, events):
+        batch = _Batch(events)
+        transaction.on_commit(batch)
+        self.batches.append(weakref.ref(batch))
+
+
+def _notify(events):
+    payloads, chunk, size = [], [], 2
+    for event in events:
+        encoded = json.dumps(event, cls=DjangoJSONEncoder, separators=(',', ':'))
+        if chunk and size + len(encoded) + 1 > MAX_PAYLOAD:
+            payloads.append('[' + ','.join(chunk) + ']')
+            chunk, size = [], 2
+        chunk.append(encoded)
+        size += len(encoded) + 1
+    payloads.append('[' + ','.join(chunk) + ']')
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) AS payload",
+            [CHANNEL, payloads],
+        )
+
+
+class Subscription:
+    """Очередь событий одного клиента; match(event) отбирает нужные"""
+
+    def __init__(self, match):
+        self.match = match
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(QUEUE_SIZE)
+        self.overflowed = False
+
+    def _put(self, event):
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+            self.queue.get_nowait()
+            self.queue.put_nowait(None)
+
+    def deliver(self, event):
+        self.loop.call_soon_threadsafe(self._put, event)
+
+    async def get(self, timeout):
+        """Следующее событие; None — подписка переполнена и закрывается"""
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+
+class Listener(threading.Thread):
+    """Поток, держащий LISTEN на отдельном соединении и раздающий события"""
+
+    def __init__(self):
+        super().__init__(name='eve-events-listener', daemon=True)
+        self.subscriptions = set()
+        self.lock = threading.Lock()
+
+    def run(self):
+        while True:
+            try:
+                self._listen()
+            except psycopg2.Error:
+                logger.exception("Соединение для событий потеряно, переподключение")
+                time.sleep(1)
+
+    def _listen(self):
+        db = settings.DATABASES['default']
+        conn = psycopg2.connect(
+            dbname=db['NAME'], user=db['USER'], password=db['PASSWORD'],
+            host=db['HOST'], port=db['PORT'],
+        )
+        try:
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cursor:
+                cursor.execute(f"LISTEN {CHANNEL}")
+            while True:
+                if select.select([conn], [], [], 30) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    self.dispatch(json.loads(conn.notifies.pop(0).payload))
+        finally:
+            conn.close()
+
+    def dispatch(self, events):
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+        for event in events:
+            for subscription in subscriptions:
+                if subscription.match(event):
+                    subscription.deliver(event)
+
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def subscribe(match):
+    """Регистрирует подписку; поток-слушатель стартует при первой подписке"""
+    global _listener
+    with _listener_lock:
+        if _listener is None:
+            _listener = Listener()
+            _listener.start()
+    subscription = Subscription(match)
+    with _listener.lock:
+        _listener.subscriptions.add(subscription)
+    return subscription
+
+
+def unsubscribe(subscription):
+    with _listener.lock:
+        _listener.subscriptions.discard(subscription)
@@ -0,0 +1,38 @@
+# eve_backend/metrics.py
+"""
+Счётчики процесса (повторы транзакций и т.п.).
+
+Без внешней зависимости: значения копятся в памяти процесса, читаются через
+snapshot() (например, в bench_matching), а каждое увеличение пишется в лог
+eve_backend.metrics (INFO) с накопленным значением — его видно и без snapshot().
+"""
+
+import logging
+import threading
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+_counters = Counter()
+_lock = threading.Lock()
+
+
+def _key(name, labels):
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{k}={v}' for k, v in sorted(labels.items())) + '}'
+
+
+def increment(name, value=1, **labels):
+    """Увеличивает счётчик name с метками labels (db_retry{operation=match,reason=deadlock})"""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] += value
+        total = _counters[key]
+    logger.info("%s +%s = %s", key, value, total)
+
+
+def snapshot():
+    """Текущие значения всех счётчиков"""
+    with _lock:
+        return dict(_counters)
@@ -0,0 +1,88 @@
+# eve_backend/money.py
+"""
+Денежные суммы.
+
+В БД деньги (Wallet, FrozenWallet, MarketLot.price_per_unit, Transfer.amount,
+цены сделок, уровней стакана и свечей) хранятся BIGINT в минимальных единицах: целочисленная арифметика и агрегаты
+в SQL, компактные индексы. В Python сумма — Money: Decimal ровно с
+MINOR_UNITS знаками после запятой. float не принимается нигде.
+
+ORM переводит единицы сам (MoneyField); сырой SQL получает параметры через
+to_minor() и читает колонки через Money.from_minor().
+"""
+
+from decimal import Decimal, InvalidOperation
+
+from django.core import exceptions
+from django.db import models
+from rest_framework import serializers
+
+MINOR_UNITS = 2
+MINOR_SCALE = 10 ** MINOR_UNITS
+_QUANTUM = Decimal(1).scaleb(-MINOR_UNITS)
+
+
+class Money(Decimal):
+    """Сумма в основных единицах; точнее минимальной единицы — ValueError"""
+
+    def __new__(cls, value='0'):
+        if isinstance(value, float):
+            raise TypeError("Сумма не может быть float")
+        try:
+            amount = Decimal(value)
+            quantized = amount.quantize(_QUANTUM)
+        except (InvalidOperation, TypeError, ValueError):
+            raise ValueError(f"Некорректная сумма: {value!r}")
+        if quantized != amount:
+            raise ValueError(f"Сумма точнее {_QUANTUM}: {value}")
+        return super().__new__(cls, quantized)
+
+    @classmethod
+    def from_minor(cls, minor):
+        return super().__new__(cls, Decimal(int(minor)).scaleb(-MINOR_UNITS))
+
+    @property
+    def minor(self):
+        return int(self.scaleb(MINOR_UNITS))
+
+
+def to_minor(value):
+    """Сумма (Money, Decimal, int, str) в минимальных единицах"""
+    return Money(value).minor
+
+
+class MoneyField(models.BigIntegerField):
+    """Денежное поле: BIGINT в минимальных единицах, в Python — Money"""
+    description = "Денежная сумма в минимальных единицах"
+
+    def from_db_value(self, value, expression, connection):
+        return None if value is None else Money.from_minor(value)
+
+    def to_python(self, value):
+        if value is None or isinstance(value, Money):
+            return value
+        try:
+            return Money(value)
+        except (TypeError, ValueError) as e:
+            raise exceptions.ValidationError(str(e), code='invalid')
+
+    def get_prep_value(self, value):
+        # Минуя IntegerField.get_prep_value: int() отбросил бы дробную часть
+        value = models.Field.get_prep_value(self, value)
+        return None if value is None else to_minor(value)
+
+
+class MoneySerializerField(serializers.DecimalField):
+    """Сумма в API: строка с MINOR_UNITS знаками, во внутреннем представлении — Money"""
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('max_digits', 16)
+        kwargs.setdefault('decimal_places', MINOR_UNITS)
+        super().__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        return Money(super().to_internal_value(data))
+
+
+# ModelSerializer без явного поля отдаёт MoneyField как сумму, а не как BIGINT
+serializers.ModelSerializer.serializer_field_mapping[MoneyField] = MoneySerializerField
@@ -147,6 +147,41 @@ TEMPLATES = [
     },
 ]
 
+# ==================== Cache ====================
+# Между воркерами gunicorn кэш должен быть общим (например, Redis через
+# CACHE_BACKEND=django.core.cache.backends.redis.RedisCache), иначе
+# инвалидация снимков рынка видна только в своём процессе
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    }
+}
+
+# Время жизни снимка лучших цен; инвалидируется раньше при изменении стакана
+MARKET_TOP_OF_BOOK_TTL = int(os.environ.get('MARKET_TOP_OF_BOOK_TTL', 300))
+
+# Оценка портфеля актора (сбрасывается при изменении его балансов) и лидерборд мастера
+VALUATION_CACHE_TTL = int(os.environ.get('VALUATION_CACHE_TTL', 60 * 60))
+VALUATION_LEADERBOARD_TTL = int(os.environ.get('VALUATION_LEADERBOARD_TTL', 60))
+
+# Комиссия брокеру с выручки продавца, в базисных пунктах (100 = 1%).
+# Выплата накопленного — manage.py settle_commissions
+BROKER_COMMISSION_BPS = int(os.environ.get('BROKER_COMMISSION_BPS', 100))
+
+# Сколько хранится ответ по Idempotency-Key (сек); чистка — manage.py purge_idempotency_keys
+IDEMPOTENCY_KEY_TTL = int(os.environ.get('IDEMPOTENCY_KEY_TTL', 24 * 60 * 60))
+# Аренда заготовки ключа, пока первый запрос выполняется (сек): дольше таймаута
+# воркера gunicorn (120), чтобы не истечь у живого запроса, и коротко для упавшего
+IDEMPOTENCY_LEASE = int(os.environ.get('IDEMPOTENCY_LEASE', 180))
+
+# Публикация событий рынка и балансов для SSE-стрима (Postgres NOTIFY после коммита).
+# Выключено по умолчанию: каждый коммит с событиями — ещё один запрос
+EVENT_STREAM_ENABLED = os.environ.get('EVENT_STREAM_ENABLED', 'False') == 'True'
+
+# Максимум строк в одном POST /internal/batch/update/
+BATCH_UPDATE_MAX_ROWS = int(os.environ.get('BATCH_UPDATE_MAX_ROWS', 100_000))
+
 # ==================== Логи (опционально, удобно в Docker) ====================
 LOGGING = {
     'version': 1,
@@ -160,6 +195,12 @@ LOGGING = {
         'handlers': ['console'],
         'level': 'WARNING',
     },
+    'loggers': {
+        # Счётчики eve_backend.metrics (повторы транзакций и т.п.)
+        'eve_backend.metrics': {
+            'level': os.environ.get('METRICS_LOG_LEVEL', 'INFO'),
+        },
+    },
 }
 
 PECTACULAR_SETTINGS = {
@@ -1,10 +1,12 @@
 # ---------------- Product ----------------
+from django.db.models import ProtectedError
 from rest_framework import viewsets, permissions, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 
 from products.models import Product
 from products.serializers import ProductSerializer
+from wallet_inventory import valuation
 
 
 class ProductViewSet(viewsets.ModelViewSet):
@@ -16,6 +18,25 @@ class ProductViewSet(viewsets.ModelViewSet):
             return [permissions.AllowAny()]
         return [permissions.IsAdminUser()]
 
+    # Цена продукта входит в оценку портфелей
+    def perform_update(self, serializer):
+        super().perform_update(serializer)
+        valuation.invalidate_all()
+
+    def perform_destroy(self, instance):
+        super().perform_destroy(instance)
+        valuation.invalidate_all()
+
+    def destroy(self, request, *args, **kwargs):
+        try:
+            return super().destroy(request, *args, **kwargs)
+        except ProtectedError:
+            # Лоты, сделки, проводки журнала — история продукта сохраняется
+            return Response(
+                {"error": "У продукта есть связанные финансовые записи — деактивируйте его (is_active=false)"},
+                status=409,
+            )
+
     @action(detail=False, methods=['post'], permission_classes=[permissions.IsAdminUser])
     def bulk_create(self, request):
         """
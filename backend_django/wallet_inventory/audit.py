@@ -0,0 +1,135 @@
+# wallet_inventory/audit.py
+"""
+Аудит сохранения экономики (README, инвариант 9.1): каждая монета и каждый
+предмет лежат ровно в одной из таблиц Inventory, FrozenInventory, Wallet,
+FrozenWallet или в невыплаченной комиссии брокеру (BrokerAccrual, счёт
+accrued), а общее количество актива меняется только проводками журнала.
+
+Суммы по активам хранятся в SupplyTotal вместе с watermark — id последней
+учтённой проводки. Очередной проход берёт проводки после watermark (старше
+LEDGER_GRACE, то есть уже закоммиченные), пересчитывает агрегатами суммы
+только по затронутым активам и сверяет их с прошлой суммой плюс движением
+по журналу. Полный проход сверяет все активы с журналом целиком.
+"""
+
+from collections import defaultdict
+
+from django.db.models import Max, Q, Sum
+from django.utils import timezone
+
+from . import ledger
+from economy.models import BrokerAccrual
+from .models import FrozenInventory, FrozenWallet, Inventory, LedgerEntry, SupplyTotal, Wallet
+
+_TABLES = (
+    (Inventory.objects.all(), 'product_id', 'quantity'),
+    (FrozenInventory.objects.all(), 'product_id', 'quantity'),
+    (Wallet.objects.all(), 'currency_id', 'amount'),
+    (FrozenWallet.objects.all(), 'currency_id', 'amount'),
+    (BrokerAccrual.objects.filter(payout__isnull=True), 'currency_id', 'amount'),
+)
+
+# Счета журнала, остаток которых лежит в таблицах _TABLES
+_SUPPLY_ACCOUNTS = ('available', 'frozen', 'accrued')
+
+
+def _asset_key(asset, asset_id):
+    return (asset_id, None) if asset == 'product_id' else (None, asset_id)
+
+
+def _table_totals(keys=None):
+    """Суммы по таблицам _TABLES {(product_id, currency_id): total}; keys=None — по всем активам"""
+    totals = defaultdict(int)
+    for source, asset, column in _TABLES:
+        rows = source.all()
+        if keys is not None:
+            ids = {product_id if asset == 'product_id' else currency_id for product_id, currency_id in keys}
+            ids.discard(None)
+            if not ids:
+                continue
+            rows = rows.filter(**{f'{asset}__in': ids})
+        for asset_id, total in rows.values_list(asset).annotate(total=Sum(column)):
+            totals[_asset_key(asset, asset_id)] += total
+    return totals
+
+
+def _ledger_movement(after, until=None, keys=None):
+    """
+    Движение по журналу в проводках (after, until] по id:
+    изменение количества в таблицах (счета _SUPPLY_ACCOUNTS) и остаток на clearing.
+    """
+    entries = LedgerEntry.objects.filter(id__gt=after)
+    if until is not None:
+        entries = entries.filter(id__lte=until)
+    if keys is not None:
+        entries = entries.filter(
+            Q(product_id__in={p for p, _ in keys if p}) | Q(currency_id__in={c for _, c in keys if c})
+        )
+
+    supply, clearing = defaultdict(int), defaultdict(int)
+    rows = entries.values_list('account', 'product_id', 'currency_id').annotate(total=Sum('amount'))
+    for account, product_id, currency_id, total in rows:
+        if account in _SUPPLY_ACCOUNTS:
+            supply[(product_id, currency_id)] += total
+        elif account == 'clearing':
+            clearing[(product_id, currency_id)] += total
+    return supply, clearing
+
+
+def audit(full=False):
+    """
+    Один проход аудитора. Возвращает список расхождений
+    (product_id, currency_id, ожидалось, в таблицах, несведено на clearing)
+    или None, если проход уже выполняет другой процесс.
+    """
+    with ledger.snapshot():
+        if not ledger.try_lock('economy_audit'):
+            return None
+
+        stored = {(row.product_id, row.currency_id): row for row in SupplyTotal.objects.all()}
+        previous = max((row.watermark for row in stored.values()), default=0)
+        full = full or not stored
+
+        cutoff = timezone.now() - ledger.LEDGER_GRACE
+        watermark = LedgerEntry.objects.filter(id__gt=previous, created_at__lte=cutoff).aggregate(
+            last=Max('id'))['last'] or previous
+
+        if full:
+            # Полная сверка: таблицы против всего журнала до watermark
+            supply, clearing = _ledger_movement(0, watermark)
+            keys = None
+        else:
+            supply, clearing = _ledger_movement(previous, watermark)
+            keys = set(supply) | set(clearing)
+            if not keys:
+                return []
+
+        # Таблицы читаются на момент снимка; проводки после watermark вычитаются
+        actual = _table_totals(keys)
+        later, _ = _ledger_movement(watermark, keys=keys)
+        for key, amount in later.items():
+            actual[key] -= amount
+
+        findings, rows = [], []
+        now = timezone.now()
+        for key in (set(actual) | set(supply) | set(clearing)) if full else keys:
+            if full:
+                expected = supply.get(key, 0)
+            else:
+                expected = (stored[key].total if key in stored else 0) + supply.get(key, 0)
+            drift = actual.get(key, 0) - expected
+            if drift or clearing.get(key):
+                findings.append((*key, expected, actual.get(key, 0), clearing.get(key, 0)))
+            rows.append(SupplyTotal(
+                product_id=key[0], currency_id=key[1], total=actual.get(key, 0),
+                watermark=watermark, drift=drift, checked_at=now,
+            ))
+
+        for asset in ('product', 'currency'):
+            SupplyTotal.objects.bulk_create(
+                [row for row in rows if getattr(row, f'{asset}_id')],
+                update_conflicts=True,
+                unique_fields=[asset],
+                update_fields=['total', 'watermark', 'drift', 'checked_at'],
+            )
+        return findings
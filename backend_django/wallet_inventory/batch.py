@@ -0,0 +1,135 @@
+# wallet_inventory/batch.py
+"""
+Пакетное изменение инвентаря и кошельков для automat-сервисов
+(POST /internal/batch/update/).
+
+Строка — {"actor_id", "product_id", "quantity"} или {"actor_id", "currency_id", "amount"},
+delta со знаком, как у /internal/inventory/update/ и /internal/wallet/update/.
+Id проверяются одним IN-запросом на модель, дельты одного (актор, актив)
+складываются и применяются bulk-upsert-ами из utils в одной транзакции.
+"""
+
+from collections import defaultdict
+from decimal import Decimal, InvalidOperation
+
+from django.db import transaction
+
+from actors.models import Actor
+from economy.models import Currency
+from products.models import Product
+from . import ledger
+from .utils import bulk_change_inventory, bulk_change_wallet
+
+ATOMIC = 'atomic'
+PARTIAL = 'partial'
+MODES = (ATOMIC, PARTIAL)
+
+# Как у WalletUpdateSerializer: max_digits=16, decimal_places=2
+AMOUNT_LIMIT = Decimal(10) ** 14
+
+
+def _positive_int(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+
+def _parse_row(row):
+    """(actor_id, product_id, currency_id, delta) или ValueError с текстом ошибки"""
+    if not isinstance(row, dict):
+        raise ValueError("Строка должна быть объектом")
+    actor_id = row.get('actor_id')
+    if not _positive_int(actor_id):
+        raise ValueError("actor_id должен быть положительным целым")
+
+    product_id, currency_id = row.get('product_id'), row.get('currency_id')
+    if (product_id is None) == (currency_id is None):
+        raise ValueError("Укажите либо product_id и quantity, либо currency_id и amount")
+
+    if product_id is not None:
+        quantity = row.get('quantity')
+        if not _positive_int(product_id):
+            raise ValueError("product_id должен быть положительным целым")
+        if not isinstance(quantity, int) or isinstance(quantity, bool):
+            raise ValueError("quantity должен быть целым")
+        return actor_id, product_id, None, quantity
+
+    if not _positive_int(currency_id):
+        raise ValueError("currency_id должен быть положительным целым")
+    try:
+        amount = Decimal(str(row.get('amount')))
+    except InvalidOperation:
+        raise ValueError("amount должен быть числом")
+    if not amount.is_finite() or amount.as_tuple().exponent < -2 or abs(amount) >= AMOUNT_LIMIT:
+        raise ValueError("amount: не больше 14 цифр до и 2 после запятой")
+    return actor_id, None, currency_id, amount
+
+
+def _existing(model, ids):
+    return set(model.objects.filter(id__in=ids).values_list('id', flat=True)) if ids else set()
+
+
+def validate(rows):
+    """
+    Разбирает строки и проверяет id. Возвращает [(index, actor_id, product_id, currency_id, delta)]
+    корректных строк и ошибки [{"index", "error"}].
+    """
+    parsed, errors = [], []
+    for index, row in enumerate(rows):
+        try:
+            parsed.append((index, *_parse_row(row)))
+        except ValueError as e:
+            errors.append({"index": index, "error": str(e)})
+
+    actors = _existing(Actor, {actor_id for _, actor_id, _, _, _ in parsed})
+    products = _existing(Product, {product_id for _, _, product_id, _, _ in parsed if product_id})
+    currencies = _existing(Currency, {currency_id for _, _, _, currency_id, _ in parsed if currency_id})
+
+    valid = []
+    for index, actor_id, product_id, currency_id, delta in parsed:
+        if actor_id not in actors:
+            errors.append({"index": index, "error": f"Актёр {actor_id} не существует"})
+        elif product_id and product_id not in products:
+            errors.append({"index": index, "error": f"Продукт {product_id} не существует"})
+        elif currency_id and currency_id not in currencies:
+            errors.append({"index": index, "error": f"Валюта {currency_id} не существует"})
+        else:
+            valid.append((index, actor_id, product_id, currency_id, delta))
+    errors.sort(key=lambda error: error['index'])
+    return valid, errors
+
+
+@transaction.atomic
+def apply(rows, mode=ATOMIC):
+    """
+    Применяет проверенные строки из validate(). Дельты одного (актор, актив)
+    складываются и применяются вместе.
+    ATOMIC: нехватка остатка — ValueError, ничего не меняется.
+    PARTIAL: строки ключей, которым не хватило остатка, возвращаются ошибками.
+    """
+    inventory, wallet = defaultdict(int), defaultdict(int)
+    indexes = defaultdict(list)
+    for index, actor_id, product_id, currency_id, delta in rows:
+        if product_id:
+            inventory[(actor_id, product_id)] += delta
+            indexes[(actor_id, product_id, None)].append(index)
+        else:
+            wallet[(actor_id, currency_id)] += delta
+            indexes[(actor_id, None, currency_id)].append(index)
+
+    strict = mode == ATOMIC
+    with ledger.operation('batch') as op:
+        failed_inventory = bulk_change_inventory(inventory, strict=strict)
+        failed_wallet = bulk_change_wallet(wallet, strict=strict)
+
+        # Пакет — эмиссия/изъятие: встречная проводка на external
+        failed = {(a, p, None) for a, p in failed_inventory} | {(a, None, c) for a, c in failed_wallet}
+        for (actor_id, product_id), delta in inventory.items():
+            if (actor_id, product_id, None) not in failed:
+                op.add(None, 'external', -delta, product_id, None)
+        for (actor_id, currency_id), delta in wallet.items():
+            if (actor_id, None, currency_id) not in failed:
+                op.add(None, 'external', -delta, None, currency_id)
+
+    return sorted(
+        ({"index": index, "error": "Недостаточно остатка"} for key in failed for index in indexes[key]),
+        key=lambda error: error['index'],
+    )
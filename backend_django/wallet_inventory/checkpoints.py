@@ -0,0 +1,95 @@
+# wallet_inventory/checkpoints.py
+"""
+Снимки остатков (BalanceCheckpoint) для запросов «остаток актора на момент T».
+
+Снимок берётся с отставанием LEDGER_GRACE от текущего времени: к этому моменту
+все транзакции с проводками не позже taken_at уже закоммичены. Первый снимок
+строится от текущего состояния Wallet/Inventory/Frozen* за вычетом проводок
+после taken_at, следующие — прошлый снимок плюс проводки между снимками.
+"""
+
+from collections import defaultdict
+
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from . import ledger
+from .models import BalanceCheckpoint
+
+
+def _apply(target, deltas, sign=1):
+    for key, amount in deltas.items():
+        target[key] += sign * amount
+
+
+def _last_checkpoints(actor_ids, until):
+    """Последний снимок каждого актива акторов не позже until: {key: (amount, taken_at)}"""
+    rows = (
+        BalanceCheckpoint.objects
+        .filter(actor_id__in=actor_ids, taken_at__lte=until)
+        .order_by('actor_id', 'account', 'product_id', 'currency_id', '-taken_at')
+        .distinct('actor_id', 'account', 'product_id', 'currency_id')
+        .values_list('actor_id', 'account', 'product_id', 'currency_id', 'amount', 'taken_at')
+    )
+    return {tuple(key): (amount, taken_at) for *key, amount, taken_at in rows}
+
+
+def take_checkpoint():
+    """Пишет снимок изменившихся остатков; возвращает число записей или None, если занято"""
+    with ledger.snapshot():
+        if not ledger.try_lock('balance_checkpoint'):
+            return None
+
+        taken_at = timezone.now() - ledger.LEDGER_GRACE
+        previous = BalanceCheckpoint.objects.aggregate(last=Max('taken_at'))['last']
+        if previous is not None and previous >= taken_at:
+            return 0
+
+        if previous is None:
+            amounts = defaultdict(int, ledger.projections())
+            _apply(amounts, ledger.balances(after=taken_at), -1)
+            changed = {key: amount for key, amount in amounts.items() if amount}
+        else:
+            deltas = ledger.balances(after=previous, until=taken_at)
+            last = _last_checkpoints({actor_id for actor_id, *_ in deltas}, previous)
+            changed = {key: (last[key][0] if key in last else 0) + delta for key, delta in deltas.items()}
+
+        BalanceCheckpoint.objects.bulk_create([
+            BalanceCheckpoint(
+                actor_id=actor_id, account=account, product_id=product_id, currency_id=currency_id,
+                amount=amount, taken_at=taken_at,
+            )
+            for (actor_id, account, product_id, currency_id), amount in changed.items()
+        ])
+        return len(changed)
+
+
+def balance_at(actor_id, ts):
+    """
+    Остатки актора на момент ts: {(account, product_id, currency_id): сумма} и
+    время снимка, от которого считали (None — от текущего состояния).
+    Ближайший снимок не позже ts плюс проводки после него; если такого нет —
+    ближайший снимок после ts (или текущее состояние) минус проводки после ts.
+    """
+    with ledger.snapshot():
+        amounts = defaultdict(int)
+        last = _last_checkpoints([actor_id], ts)
+        if last:
+            base = max(taken_at for _, taken_at in last.values())
+            for key, (amount, _) in last.items():
+                amounts[key] = amount
+            _apply(amounts, ledger.balances([actor_id], after=base, until=ts))
+        else:
+            # Первый снимок актора после ts содержит все его ненулевые остатки
+            base = (
+                BalanceCheckpoint.objects.filter(actor_id=actor_id, taken_at__gt=ts)
+                .aggregate(first=Min('taken_at'))['first']
+            )
+            if base is not None:
+                for key, (amount, _) in _last_checkpoints([actor_id], base).items():
+                    amounts[key] = amount
+            else:
+                _apply(amounts, ledger.projections([actor_id]))
+            _apply(amounts, ledger.balances([actor_id], after=ts, until=base), -1)
+
+        return {key[1:]: amount for key, amount in amounts.items() if amount}, base
@@ -0,0 +1,55 @@
+# wallet_inventory/escrow.py
+"""
+Владелец escrow: тип (лот, передача, ручная заморозка) и целочисленный id.
+
+Frozen* хранят ссылку в escrow_kind/escrow_id — это и ключ строки (уникален
+вместе с актором и активом), и индекс поиска и списания. reason — только
+подпись: для лотов и передач str(ref) ("lot:42"), для ручной заморозки —
+текст первой заморозки. Ручные заморозки актора по активу — одна общая строка.
+"""
+
+import re
+from typing import NamedTuple, Optional
+
+LOT = 'lot'
+TRANSFER = 'transfer'
+MANUAL = 'manual'
+
+KIND_CHOICES = [
+    (LOT, 'Лот'),
+    (TRANSFER, 'Передача'),
+    (MANUAL, 'Вручную'),
+]
+
+_TYPED = re.compile(rf'^({LOT}|{TRANSFER}):(\d+)$')
+
+
+class EscrowRef(NamedTuple):
+    kind: str
+    id: Optional[int] = None
+    label: str = ''
+
+    @classmethod
+    def lot(cls, lot_id):
+        return cls(LOT, lot_id)
+
+    @classmethod
+    def transfer(cls, transfer_id):
+        return cls(TRANSFER, transfer_id)
+
+    @classmethod
+    def of(cls, value):
+        """EscrowRef как есть; строка "lot:42"/"transfer:7" — типизированная ссылка, иначе ручная"""
+        if isinstance(value, EscrowRef):
+            return value
+        match = _TYPED.match(value or '')
+        if match:
+            return cls(match[1], int(match[2]))
+        return cls(MANUAL, None, value or MANUAL)
+
+    @property
+    def typed(self):
+        return self.id is not None
+
+    def __str__(self):
+        return f"{self.kind}:{self.id}" if self.typed else self.label
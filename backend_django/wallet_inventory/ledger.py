@@ -0,0 +1,156 @@
+# wallet_inventory/ledger.py
+"""
+Журнал движений активов (LedgerEntry).
+
+Функции wallet_inventory.utils сообщают о каждом изменении проводками.
+Внутри operation() проводки копятся в памяти и пишутся одним bulk_create
+при выходе из блока; вне операции каждый вызов utils — своя операция.
+Операция должна сводиться по каждому активу в ноль; несведённый остаток —
+ошибка учёта, транзакция откатывается. Только открытые операции эмиссии/изъятия
+(clearing=True) списывают его на счёт clearing, где его находит аудит.
+"""
+
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from . import valuation
+from .models import FrozenInventory, FrozenWallet, Inventory, LedgerEntry, Wallet
+
+_current = ContextVar('ledger_operation', default=None)
+
+# created_at проводки ставится до коммита её транзакции: читатели журнала
+# (снимки, аудит) считают закоммиченными только проводки старше этого окна
+LEDGER_GRACE = timedelta(seconds=60)
+
+
+class Operation:
+    def __init__(self, reason, clearing=False):
+        self.id = uuid.uuid4()
+        self.reason = reason
+        self.clearing = clearing
+        self.entries = []
+
+    def add(self, actor_id, account, amount, product_id=None, currency_id=None, reason=None):
+        if amount:
+            self.entries.append((actor_id, account, product_id, currency_id, amount, reason or self.reason))
+
+    def flush(self):
+        if not self.entries:
+            return
+
+        residual = defaultdict(int)
+        for _, _, product_id, currency_id, amount, _ in self.entries:
+            residual[(product_id, currency_id)] += amount
+        residual = {key: amount for key, amount in residual.items() if amount}
+        if residual and not self.clearing:
+            raise RuntimeError(f"Операция {self.reason} не сведена: {residual}")
+        for (product_id, currency_id), amount in residual.items():
+            self.add(None, 'clearing', -amount, product_id, currency_id)
+
+        now = timezone.now()
+        LedgerEntry.objects.bulk_create([
+            LedgerEntry(
+                op_id=self.id, actor_id=actor_id, account=account, product_id=product_id,
+                currency_id=currency_id, amount=amount, reason=reason[:100], created_at=now,
+            )
+            for actor_id, account, product_id, currency_id, amount, reason in self.entries
+        ])
+        valuation.invalidate(actor_id for actor_id, *_ in self.entries)
+        self.entries = []
+
+
+@contextmanager
+def operation(reason='', clearing=False):
+    """
+    Группирует проводки в одну операцию. Блок должен быть внутри транзакции
+    изменений: проводки пишутся при выходе, при исключении — отбрасываются.
+    Несведённая операция — RuntimeError, если не clearing=True.
+    Вложенный блок присоединяется к внешней операции, режим clearing — её.
+    """
+    current = _current.get()
+    if current is not None:
+        yield current
+        return
+
+    op = Operation(reason, clearing)
+    token = _current.set(op)
+    try:
+        yield op
+        op.flush()
+    finally:
+        _current.reset(token)
+
+
+def post(reason, legs):
+    """
+    Проводки одного изменения: legs — (actor_id, account, amount, product_id, currency_id).
+    В открытой операции добавляются к ней, иначе пишутся сразу.
+    """
+    with operation(reason) as op:
+        for actor_id, account, amount, product_id, currency_id in legs:
+            op.add(actor_id, account, amount, product_id, currency_id, reason)
+
+
+def balances(actor_ids=None, after=None, until=None):
+    """
+    Остатки по журналу: {(actor_id, account, product_id, currency_id): сумма} для available/frozen.
+    after/until — только проводки с created_at в (after, until].
+    """
+    entries = LedgerEntry.objects.filter(account__in=('available', 'frozen'))
+    if actor_ids is not None:
+        entries = entries.filter(actor_id__in=actor_ids)
+    if after is not None:
+        entries = entries.filter(created_at__gt=after)
+    if until is not None:
+        entries = entries.filter(created_at__lte=until)
+    rows = entries.values_list('actor_id', 'account', 'product_id', 'currency_id').annotate(total=Sum('amount'))
+    return {tuple(key): total for *key, total in rows if total}
+
+
+def projections(actor_ids=None):
+    """Те же остатки по таблицам-проекциям Wallet/Inventory/Frozen*"""
+    result = defaultdict(int)
+    sources = (
+        (Inventory, 'available', 'product_id', 'quantity'),
+        (Wallet, 'available', 'currency_id', 'amount'),
+        (FrozenInventory, 'frozen', 'product_id', 'quantity'),
+        (FrozenWallet, 'frozen', 'currency_id', 'amount'),
+    )
+    for model, account, asset, column in sources:
+        rows = model.objects.all()
+        if actor_ids is not None:
+            rows = rows.filter(actor_id__in=actor_ids)
+        for actor_id, asset_id, total in rows.values_list('actor_id', asset).annotate(total=Sum(column)):
+            if total:
+                key = (actor_id, account, asset_id, None) if asset == 'product_id' else (actor_id, account, None, asset_id)
+                result[key] += total
+    return dict(result)
+
+
+@contextmanager
+def snapshot():
+    """
+    Транзакция REPEATABLE READ: проекции и журнал читаются из одного снимка БД.
+    Уровень можно сменить только первым запросом транзакции; внутри чужой
+    транзакции остаётся её уровень.
+    """
+    outermost = not connection.in_atomic_block
+    with transaction.atomic():
+        if outermost:
+            with connection.cursor() as cursor:
+                cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        yield
+
+
+def try_lock(name):
+    """Транзакционная advisory-блокировка по имени задачи; False — уже занята"""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_xact_lock(hashtext(%s))", [name])
+        return cursor.fetchone()[0]
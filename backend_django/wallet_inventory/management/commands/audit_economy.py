@@ -0,0 +1,42 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from wallet_inventory.audit import audit
+
+
+class Command(BaseCommand):
+    help = (
+        "Проверяет сохранение экономики: суммы каждого актива по Inventory, FrozenInventory, "
+        "Wallet, FrozenWallet и невыплаченной комиссии брокерам против журнала. Пересчитывает только активы с новыми проводками"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help="Сверить все активы с журналом целиком")
+        parser.add_argument('--loop', action='store_true', help="Работать постоянно, как фоновый воркер")
+        parser.add_argument('--interval', type=float, default=60.0, help="Пауза между проходами в режиме --loop, сек")
+
+    def handle(self, *args, **options):
+        full = options['full']
+        while True:
+            findings = audit(full=full)
+            full = False
+            if findings is None:
+                self.stdout.write("Аудит уже выполняет другой процесс")
+            else:
+                self.report(findings)
+                if findings and not options['loop']:
+                    raise CommandError(f"Нарушено сохранение экономики: активов {len(findings)}")
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+    def report(self, findings):
+        for product_id, currency_id, expected, actual, clearing in findings:
+            asset = f"product:{product_id}" if product_id else f"currency:{currency_id}"
+            message = f"  {asset}: ожидалось {expected}, в таблицах {actual} (расхождение {actual - expected:+})"
+            if clearing:
+                message += f", несведено на clearing {clearing:+}"
+            self.stderr.write(self.style.ERROR(message))
+        if not findings:
+            self.stdout.write(self.style.SUCCESS("Расхождений нет"))
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from wallet_inventory.escrow import LOT, MANUAL, TRANSFER
+from wallet_inventory.models import FrozenInventory, FrozenWallet
+
+
+class Command(BaseCommand):
+    help = (
+        "Заполняет escrow_kind/escrow_id у строк Frozen*, созданных до типизированных "
+        "ссылок, по подписи reason (\"lot:42\", \"transfer:7\"), и сливает ручные заморозки "
+        "актора по активу в одну строку. Нужен один раз, до migrate с ключом "
+        "(actor, asset, escrow_kind, escrow_id)."
+    )
+
+    def handle(self, *args, **options):
+        total = merged = 0
+        with transaction.atomic(), connection.cursor() as cursor:
+            for model, asset, column in ((FrozenInventory, 'product_id', 'quantity'),
+                                         (FrozenWallet, 'currency_id', 'amount')):
+                table = model._meta.db_table
+                cursor.execute(f"""
+                    UPDATE {table}
+                    SET escrow_kind = split_part(reason, ':', 1),
+                        escrow_id = split_part(reason, ':', 2)::bigint
+                    WHERE escrow_kind = %s AND reason ~ %s
+                """, [MANUAL, rf'^({LOT}|{TRANSFER}):\d+$'])
+                self.stdout.write(f"  {model.__name__}: {cursor.rowcount}")
+                total += cursor.rowcount
+
+                # Ручные заморозки с разными подписями: остаток — в строку с меньшим id
+                cursor.execute(f"""
+                    WITH keep AS (
+                        SELECT actor_id, {asset}, MIN(id) AS id, SUM({column}) AS total
+                        FROM {table}
+                        WHERE escrow_kind = %(kind)s AND escrow_id IS NULL
+                        GROUP BY actor_id, {asset}
+                        HAVING COUNT(*) > 1
+                    ), kept AS (
+                        UPDATE {table} AS t SET {column} = keep.total
+                        FROM keep WHERE t.id = keep.id
+                    )
+                    DELETE FROM {table} AS t
+                    USING keep
+                    WHERE t.actor_id = keep.actor_id AND t.{asset} = keep.{asset}
+                      AND t.escrow_kind = %(kind)s AND t.escrow_id IS NULL AND t.id <> keep.id
+                """, {'kind': MANUAL})
+                self.stdout.write(f"  {model.__name__}: слито ручных строк {cursor.rowcount}")
+                merged += cursor.rowcount
+        self.stdout.write(f"Проставлено ссылок: {total}, слито ручных строк: {merged}")
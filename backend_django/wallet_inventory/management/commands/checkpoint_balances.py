@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from wallet_inventory.checkpoints import take_checkpoint
+
+
+class Command(BaseCommand):
+    help = (
+        "Пишет снимки остатков (BalanceCheckpoint) по изменившимся с прошлого снимка "
+        "активам — для быстрых запросов остатка на момент времени"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help="Работать постоянно, как фоновый воркер")
+        parser.add_argument('--interval', type=float, default=3600.0, help="Пауза между снимками в режиме --loop, сек")
+
+    def handle(self, *args, **options):
+        while True:
+            written = take_checkpoint()
+            if written is None:
+                self.stdout.write("Снимок уже пишет другой процесс")
+            else:
+                self.stdout.write(f"Записано остатков в снимок: {written}")
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
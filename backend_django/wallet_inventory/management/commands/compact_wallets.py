@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from eve_backend.db import retry_on_conflict
+from wallet_inventory.utils import compact_wallets
+
+
+@retry_on_conflict('compact_wallets')
+def compact():
+    with transaction.atomic():
+        return compact_wallets()
+
+
+class Command(BaseCommand):
+    help = (
+        "Сливает полосы кошельков горячих акторов (Actor.wallet_stripes > 1) "
+        "обратно в одну строку"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help="Работать постоянно, как фоновый воркер")
+        parser.add_argument('--interval', type=float, default=300.0, help="Пауза между проходами в режиме --loop, сек")
+
+    def handle(self, *args, **options):
+        while True:
+            self.stdout.write(f"Слито кошельков: {compact()}")
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
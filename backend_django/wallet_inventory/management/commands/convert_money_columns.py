@@ -0,0 +1,48 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from eve_backend.money import MINOR_SCALE, MINOR_UNITS, MoneyField
+
+
+class Command(BaseCommand):
+    help = (
+        "Переводит денежные колонки (MoneyField), ещё хранящиеся numeric в основных "
+        "единицах, в BIGINT минимальных единиц: round(value * 100). Запускать до "
+        "migrate, меняющего их тип: иначе migrate приведёт 12.50 к 13, а не к 1250. "
+        "Уже переведённые колонки и отсутствующие таблицы пропускаются."
+    )
+
+    def handle(self, *args, **options):
+        columns = [
+            (model._meta.db_table, field.column)
+            for model in apps.get_models()
+            for field in model._meta.local_concrete_fields
+            if isinstance(field, MoneyField)
+        ]
+        converted = 0
+        with transaction.atomic(), connection.cursor() as cursor:
+            for table, column in columns:
+                cursor.execute(
+                    "SELECT data_type FROM information_schema.columns "
+                    "WHERE table_schema = current_schema() AND table_name = %s AND column_name = %s",
+                    [table, column],
+                )
+                row = cursor.fetchone()
+                if row is None or row[0] != 'numeric':
+                    continue
+
+                # Дробь точнее минимальной единицы округлилась бы молча
+                cursor.execute(f'SELECT COUNT(*) FROM "{table}" WHERE "{column}" <> round("{column}", %s)',
+                               [MINOR_UNITS])
+                inexact = cursor.fetchone()[0]
+                if inexact:
+                    raise CommandError(f"{table}.{column}: {inexact} сумм точнее {MINOR_UNITS} знаков")
+
+                cursor.execute(
+                    f'ALTER TABLE "{table}" ALTER COLUMN "{column}" '
+                    f'TYPE bigint USING round("{column}" * {MINOR_SCALE})::bigint'
+                )
+                self.stdout.write(f"  {table}.{column}")
+                converted += 1
+        self.stdout.write(f"Переведено колонок: {converted}")
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from wallet_inventory import ledger
+
+
+class Command(BaseCommand):
+    help = (
+        "Сверяет журнал движений с Wallet/Inventory/Frozen* и проводит расхождения "
+        "входящими остатками со счёта external (reason=opening). "
+        "Нужен один раз для данных, накопленных до журнала."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Только показать расхождения")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            journal = ledger.balances()
+            actual = ledger.projections()
+            diff = {
+                key: actual.get(key, 0) - journal.get(key, 0)
+                for key in journal.keys() | actual.keys()
+                if actual.get(key, 0) != journal.get(key, 0)
+            }
+
+            if not options['dry_run']:
+                with ledger.operation('opening') as op:
+                    for (actor_id, account, product_id, currency_id), amount in diff.items():
+                        op.add(actor_id, account, amount, product_id, currency_id)
+                        op.add(None, 'external', -amount, product_id, currency_id)
+
+        for (actor_id, account, product_id, currency_id), amount in sorted(diff.items(), key=str):
+            asset = f"product:{product_id}" if product_id else f"currency:{currency_id}"
+            self.stdout.write(f"  актор {actor_id} {account} {asset}: {amount:+}")
+        verb = "Расхождений" if options['dry_run'] else "Проведено входящих остатков"
+        self.stdout.write(f"{verb}: {len(diff)}")
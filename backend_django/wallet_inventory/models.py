@@ -1,7 +1,11 @@
 from django.db import models
+from django.db.models import Q
+from django.utils import timezone
 from actors.models import Actor
+from eve_backend.money import MoneyField
 from economy.models import Currency, MarketLot
 from products.models import Product
+from .escrow import KIND_CHOICES, MANUAL
 
 class Inventory(models.Model):
     actor = models.ForeignKey(
@@ -34,10 +38,12 @@ class Wallet(models.Model):
         on_delete=models.CASCADE,
         related_name='holders'
     )
-    amount = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+    amount = MoneyField(default=0)
+    # Полоса кошелька (Actor.wallet_stripes): списания идут из полосы 0
+    stripe = models.PositiveSmallIntegerField(default=0)
 
     class Meta:
-        unique_together = ('actor', 'currency')
+        unique_together = ('actor', 'currency', 'stripe')
 
     def __str__(self):
         return f'{self.actor.name} - {self.amount} {self.currency.symbol}'
@@ -66,16 +72,26 @@ class FrozenInventory(models.Model):
         related_name='frozen_owners'
     )
     quantity = models.PositiveIntegerField(default=1)
-    reason = models.CharField(max_length=100, blank=True)  # например, "lot:42"
+    # Владелец escrow (см. wallet_inventory.escrow) — ключ строки; reason — только подпись, например "lot:42"
+    escrow_kind = models.CharField(max_length=16, choices=KIND_CHOICES, default=MANUAL)
+    escrow_id = models.BigIntegerField(null=True, blank=True)
+    reason = models.CharField(max_length=100, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
-        unique_together = ('actor', 'product', 'reason')
+        constraints = [
+            # Одна строка на владельца escrow; ручные (escrow_id пуст) — общая на актора и актив
+            models.UniqueConstraint(
+                fields=['actor', 'product', 'escrow_kind', 'escrow_id'],
+                nulls_distinct=False,
+                name='frozen_inventory_escrow_uniq',
+            ),
+        ]
         indexes = [
             models.Index(fields=['actor']),
             models.Index(fields=['product']),
             models.Index(fields=['lot']),
-            models.Index(fields=['reason']),
+            models.Index(fields=['escrow_kind', 'escrow_id']),
         ]
 
     def __str__(self):
@@ -105,19 +121,134 @@ class FrozenWallet(models.Model):
         on_delete=models.CASCADE,
         related_name='frozen_holders'
     )
-    amount = models.DecimalField(max_digits=16, decimal_places=2)
+    amount = MoneyField()
+    # Владелец escrow (см. wallet_inventory.escrow) — ключ строки; reason — только подпись, например "lot:42"
+    escrow_kind = models.CharField(max_length=16, choices=KIND_CHOICES, default=MANUAL)
+    escrow_id = models.BigIntegerField(null=True, blank=True)
     reason = models.CharField(max_length=100, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
-        unique_together = ('actor', 'currency', 'reason')
+        constraints = [
+            # Одна строка на владельца escrow; ручные (escrow_id пуст) — общая на актора и актив
+            models.UniqueConstraint(
+                fields=['actor', 'currency', 'escrow_kind', 'escrow_id'],
+                nulls_distinct=False,
+                name='frozen_wallet_escrow_uniq',
+            ),
+        ]
         indexes = [
             models.Index(fields=['actor']),
             models.Index(fields=['currency']),
             models.Index(fields=['lot']),
-            models.Index(fields=['reason']),
+            models.Index(fields=['escrow_kind', 'escrow_id']),
         ]
 
     def __str__(self):
         lot_str = f" (лот {self.lot.id})" if self.lot else ""
-        return f"[FROZEN] {self.actor.name} - {self.amount} {self.currency.symbol}{lot_str} ({self.reason})"
\ No newline at end of file
+        return f"[FROZEN] {self.actor.name} - {self.amount} {self.currency.symbol}{lot_str} ({self.reason})"
+
+
+class LedgerEntry(models.Model):
+    """
+    Проводка журнала движений активов (только добавление).
+    Одна операция (op_id) — набор проводок, сумма которых по каждому активу
+    равна нулю: что ушло с одного счёта, пришло на другой. Wallet/Inventory и
+    Frozen* — проекции журнала по счетам available/frozen.
+    """
+    ACCOUNT_CHOICES = [
+        ('available', 'Доступно'),
+        ('frozen', 'Заморожено'),
+        ('external', 'Внешний мир'),  # эмиссия/изъятие мастером и системными акторами
+        ('clearing', 'Клиринг'),      # несведённый остаток открытой эмиссии/изъятия (bulk_change_* вне операции)
+        ('accrued', 'Начислено'),     # комиссия брокеру до выплаты (economy.BrokerAccrual)
+    ]
+
+    op_id = models.UUIDField(db_index=True, help_text="Операция, к которой относится проводка")
+    # PROTECT: журнал только дописывается — актор или актив с историей не удаляется
+    # (вместе с ним ушли бы и его Wallet/Inventory, и аудит показал бы расхождение)
+    actor = models.ForeignKey(
+        Actor,
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True,
+        related_name='ledger_entries',
+        help_text="Пусто для счетов external/clearing и для комиссии системе на accrued"
+    )
+    account = models.CharField(max_length=16, choices=ACCOUNT_CHOICES)
+    product = models.ForeignKey(Product, on_delete=models.PROTECT, null=True, blank=True, related_name='ledger_entries')
+    currency = models.ForeignKey(Currency, on_delete=models.PROTECT, null=True, blank=True, related_name='ledger_entries')
+    amount = models.DecimalField(max_digits=20, decimal_places=2, help_text="Со знаком: + приход, - расход")
+    reason = models.CharField(max_length=100, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['actor', 'created_at']),
+        ]
+        constraints = [
+            models.CheckConstraint(
+                condition=Q(product__isnull=True) ^ Q(currency__isnull=True),
+                name='ledger_entry_single_asset'
+            ),
+        ]
+
+    def __str__(self):
+        asset = f"product:{self.product_id}" if self.product_id else f"currency:{self.currency_id}"
+        return f"{self.op_id} {self.actor_id}/{self.account} {asset} {self.amount:+}"
+
+
+class BalanceCheckpoint(models.Model):
+    """
+    Снимок остатка (actor, счёт, актив) на момент taken_at.
+    Пишется только для активов, изменившихся с прошлого снимка (ноль — тоже
+    запись), поэтому остаток на момент T — последняя запись по активу не
+    позже T плюс проводки журнала после неё.
+    """
+    actor = models.ForeignKey(Actor, on_delete=models.PROTECT, related_name='balance_checkpoints')
+    account = models.CharField(max_length=16, choices=LedgerEntry.ACCOUNT_CHOICES[:2])
+    product = models.ForeignKey(Product, on_delete=models.PROTECT, null=True, blank=True, related_name='+')
+    currency = models.ForeignKey(Currency, on_delete=models.PROTECT, null=True, blank=True, related_name='+')
+    amount = models.DecimalField(max_digits=20, decimal_places=2)
+    taken_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['actor', 'taken_at']),
+        ]
+        constraints = [
+            models.CheckConstraint(
+                condition=Q(product__isnull=True) ^ Q(currency__isnull=True),
+                name='balance_checkpoint_single_asset'
+            ),
+        ]
+
+    def __str__(self):
+        asset = f"product:{self.product_id}" if self.product_id else f"currency:{self.currency_id}"
+        return f"{self.taken_at:%Y-%m-%d %H:%M} {self.actor_id}/{self.account} {asset} = {self.amount}"
+
+
+class SupplyTotal(models.Model):
+    """
+    Общее количество актива в таблицах Inventory, FrozenInventory, Wallet,
+    FrozenWallet и в невыплаченных BrokerAccrual на момент проводки журнала watermark. Аудитор
+    пересчитывает только активы с проводками после watermark.
+    """
+    product = models.OneToOneField(Product, on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    currency = models.OneToOneField(Currency, on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    total = models.DecimalField(max_digits=24, decimal_places=2, default=0)
+    watermark = models.BigIntegerField(default=0, help_text="id последней учтённой проводки LedgerEntry")
+    drift = models.DecimalField(max_digits=24, decimal_places=2, default=0, help_text="Расхождение последней проверки")
+    checked_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.CheckConstraint(
+                condition=Q(product__isnull=True) ^ Q(currency__isnull=True),
+                name='supply_total_single_asset'
+            ),
+        ]
+
+    def __str__(self):
+        asset = f"product:{self.product_id}" if self.product_id else f"currency:{self.currency_id}"
+        return f"{asset} = {self.total} (до #{self.watermark})"
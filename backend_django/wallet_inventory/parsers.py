@@ -0,0 +1,29 @@
+# wallet_inventory/parsers.py
+import codecs
+import json
+
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+
+class NDJSONParser(BaseParser):
+    """
+    Поток JSON-объектов по одному на строку (application/x-ndjson).
+    Тело читается построчно, без загрузки всего запроса в одну строку;
+    пустые строки пропускаются. Результат — список, как у JSON-массива.
+    """
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        encoding = (parser_context or {}).get('encoding', settings.DEFAULT_CHARSET)
+        rows = []
+        for number, line in enumerate(codecs.getreader(encoding)(stream), start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                rows.append(json.loads(line))
+            except ValueError as e:
+                raise ParseError(f"NDJSON, строка {number}: {e}")
+        return rows
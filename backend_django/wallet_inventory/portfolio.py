@@ -0,0 +1,85 @@
+# wallet_inventory/portfolio.py
+"""
+Портфель актора одним запросом: кошелёк, инвентарь и оба escrow.
+
+Четыре таблицы читаются одним UNION ALL с присоединёнными продуктом,
+валютой и лотом; из строк собираются несохранённые экземпляры моделей,
+чтобы ответ отдавали те же сериализаторы, что и у отдельных эндпоинтов.
+"""
+
+from django.db import connection
+
+from economy.models import Currency, MarketLot
+from eve_backend.money import Money
+from products.models import Product
+from .models import FrozenInventory, FrozenWallet, Inventory, Wallet
+from .utils import merge_stripes
+
+_SQL = f"""
+    WITH holding AS (
+        SELECT 'inventory' AS kind, id, product_id AS asset_id, quantity::numeric AS value,
+               NULL::varchar AS escrow_kind, NULL::bigint AS escrow_id, NULL::varchar AS reason,
+               NULL::timestamptz AS created_at, NULL::bigint AS lot_id
+        FROM {Inventory._meta.db_table} WHERE actor_id = %(actor)s
+        UNION ALL
+        SELECT 'frozen_inventory', id, product_id, quantity::numeric, escrow_kind, escrow_id, reason,
+               created_at, lot_id
+        FROM {FrozenInventory._meta.db_table} WHERE actor_id = %(actor)s
+        UNION ALL
+        SELECT 'wallet', id, currency_id, amount, NULL, NULL, NULL, NULL, NULL
+        FROM {Wallet._meta.db_table} WHERE actor_id = %(actor)s
+        UNION ALL
+        SELECT 'frozen_wallet', id, currency_id, amount, escrow_kind, escrow_id, reason, created_at, lot_id
+        FROM {FrozenWallet._meta.db_table} WHERE actor_id = %(actor)s
+    )
+    SELECT h.kind, h.id, h.asset_id, h.value, h.escrow_kind, h.escrow_id, h.reason, h.created_at,
+           h.lot_id, l.lot_type,
+           p.name, p.description, p.price, p.is_active, p.is_legal, pc.symbol,
+           c.name, c.symbol
+    FROM holding h
+    LEFT JOIN {Product._meta.db_table} p ON h.kind IN ('inventory', 'frozen_inventory') AND p.id = h.asset_id
+    LEFT JOIN {Currency._meta.db_table} pc ON pc.id = p.currency_id
+    LEFT JOIN {Currency._meta.db_table} c ON h.kind IN ('wallet', 'frozen_wallet') AND c.id = h.asset_id
+    LEFT JOIN {MarketLot._meta.db_table} l ON l.id = h.lot_id
+    ORDER BY h.kind, h.id
+"""
+
+
+def _product(asset_id, name, description, price, is_active, is_legal, currency_symbol):
+    currency = Currency(symbol=currency_symbol) if currency_symbol is not None else None
+    return Product(id=asset_id, name=name, description=description, price=price,
+                   is_active=is_active, is_legal=is_legal, currency=currency)
+
+
+def actor_portfolio(actor):
+    """{'wallet', 'inventory', 'frozen_wallet', 'frozen_inventory'}: списки экземпляров моделей"""
+    with connection.cursor() as cursor:
+        cursor.execute(_SQL, {'actor': actor.id})
+        rows = cursor.fetchall()
+
+    portfolio = {'wallet': [], 'inventory': [], 'frozen_wallet': [], 'frozen_inventory': []}
+    for (kind, row_id, asset_id, value, escrow_kind, escrow_id, reason, created_at, lot_id, lot_type,
+         product_name, description, price, is_active, is_legal, product_currency_symbol,
+         currency_name, currency_symbol) in rows:
+        lot = MarketLot(id=lot_id, lot_type=lot_type) if lot_id is not None else None
+        if kind in ('inventory', 'frozen_inventory'):
+            product = _product(asset_id, product_name, description, price, is_active, is_legal,
+                               product_currency_symbol)
+            if kind == 'inventory':
+                item = Inventory(id=row_id, actor=actor, product=product, quantity=int(value))
+            else:
+                item = FrozenInventory(id=row_id, actor=actor, product=product, quantity=int(value),
+                                       escrow_kind=escrow_kind, escrow_id=escrow_id, reason=reason,
+                                       created_at=created_at, lot=lot)
+        else:
+            currency = Currency(id=asset_id, name=currency_name, symbol=currency_symbol)
+            value = Money.from_minor(value)
+            if kind == 'wallet':
+                item = Wallet(id=row_id, actor=actor, currency=currency, amount=value)
+            else:
+                item = FrozenWallet(id=row_id, actor=actor, currency=currency, amount=value,
+                                    escrow_kind=escrow_kind, escrow_id=escrow_id, reason=reason,
+                                    created_at=created_at, lot=lot)
+        portfolio[kind].append(item)
+    portfolio['wallet'] = merge_stripes(portfolio['wallet'])
+    return portfolio
@@ -5,6 +5,7 @@ from .models import Inventory, Wallet, FrozenWallet, FrozenInventory
 from products.models import Product
 from economy.models import Currency
 from actors.models import Actor
+from eve_backend.money import MoneySerializerField
 
 
 # ====================
@@ -30,7 +31,7 @@ class InventoryUpdateSerializer(serializers.Serializer):
 class WalletUpdateSerializer(serializers.Serializer):
     actor_id = serializers.IntegerField(min_value=1)
     currency_id = serializers.IntegerField(min_value=1)
-    amount = serializers.DecimalField(max_digits=16, decimal_places=2)
+    amount = MoneySerializerField()
 
     def validate_actor_id(self, value):
         if not Actor.objects.filter(id=value).exists():
@@ -72,6 +73,7 @@ class InventoryItemSerializer(serializers.ModelSerializer):
 class WalletItemSerializer(serializers.ModelSerializer):
     currency_name = serializers.CharField(source='currency.name', read_only=True)
     currency_symbol = serializers.CharField(source='currency.symbol', read_only=True)
+    amount = MoneySerializerField(read_only=True)
 
     class Meta:
         model = Wallet
@@ -88,6 +90,7 @@ class FrozenWalletItemSerializer(serializers.ModelSerializer):
     lot_id = serializers.IntegerField(source='lot.id', read_only=True, allow_null=True)
     lot_type = serializers.CharField(source='lot.get_lot_type_display', read_only=True, allow_null=True)
     reason = serializers.CharField(read_only=True)
+    amount = MoneySerializerField(read_only=True)
 
     class Meta:
         model = FrozenWallet
@@ -96,6 +99,8 @@ class FrozenWalletItemSerializer(serializers.ModelSerializer):
             'currency_name',
             'currency_symbol',
             'amount',
+            'escrow_kind',
+            'escrow_id',
             'reason',
             'lot_id',
             'lot_type',
@@ -121,6 +126,8 @@ class FrozenInventoryItemSerializer(serializers.ModelSerializer):
             'price',
             'currency_symbol',
             'quantity',
+            'escrow_kind',
+            'escrow_id',
             'reason',
             'lot_id',
             'lot_type',
@@ -143,12 +150,30 @@ class UnfreezeInventoryResponseSerializer(serializers.Serializer):
 class FreezeWalletResponseSerializer(serializers.Serializer):
     status = serializers.CharField()
     frozen_id = serializers.IntegerField()
-    amount = serializers.DecimalField(max_digits=16, decimal_places=2)
+    amount = MoneySerializerField()
     lot_id = serializers.IntegerField(allow_null=True)
     reason = serializers.CharField()
 
 class UnfreezeWalletResponseSerializer(serializers.Serializer):
     status = serializers.CharField()
-    amount = serializers.DecimalField(max_digits=16, decimal_places=2)
+    amount = MoneySerializerField()
     currency_id = serializers.IntegerField()
-    reason = serializers.CharField()
\ No newline at end of file
+    reason = serializers.CharField()
+
+class ActorPortfolioSerializer(serializers.Serializer):
+    actor_id = serializers.IntegerField()
+    actor_name = serializers.CharField()
+    wallet = WalletItemSerializer(many=True)
+    inventory = InventoryItemSerializer(many=True)
+    frozen_wallet = FrozenWalletItemSerializer(many=True)
+    frozen_inventory = FrozenInventoryItemSerializer(many=True)
+
+class ActorValuationSerializer(serializers.Serializer):
+    actor_id = serializers.IntegerField()
+    actor_name = serializers.CharField()
+    cash = serializers.DecimalField(max_digits=24, decimal_places=2)
+    frozen_cash = serializers.DecimalField(max_digits=24, decimal_places=2)
+    items = serializers.DecimalField(max_digits=24, decimal_places=2)
+    frozen_items = serializers.DecimalField(max_digits=24, decimal_places=2)
+    total = serializers.DecimalField(max_digits=24, decimal_places=2)
+    unpriced_items = serializers.IntegerField()
@@ -1,3 +1,337 @@
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import ProtectedError, Sum
 from django.test import TestCase
+from rest_framework.exceptions import ValidationError
+from rest_framework.test import APIClient
+
+from accounts.models import User
+from actors.models import Actor
+from economy.models import Currency, MarketDepthLevel
+from eve_backend.money import Money, MoneySerializerField, to_minor
+from products.models import Product
+from . import ledger
+from .audit import audit
+from .escrow import EscrowRef
+from .models import FrozenInventory, FrozenWallet, Inventory, LedgerEntry, SupplyTotal, Wallet
+from .utils import (
+    change_inventory_quantity, change_wallet_amount, freeze_inventory, freeze_wallet,
+    unfreeze_inventory, unfreeze_wallet,
+)
+
+
+class BalanceTestCase(TestCase):
+    """Актор alice с 100 gold и 10 sword"""
+
+    def setUp(self):
+        self.gold = Currency.objects.create(name='Gold', symbol='G')
+        self.sword = Product.objects.create(name='Sword', price=Decimal('10'), currency=self.gold)
+        self.alice = Actor.objects.create(name='alice', type='npc')
+        change_wallet_amount(self.alice, self.gold, Money('100'))
+        change_inventory_quantity(self.alice, self.sword, 10)
+
+    def balances(self):
+        """(кошелёк, заморожено денег, инвентарь, заморожено предметов)"""
+        return (
+            Wallet.objects.filter(actor=self.alice).aggregate(s=Sum('amount'))['s'] or 0,
+            FrozenWallet.objects.filter(actor=self.alice).aggregate(s=Sum('amount'))['s'] or 0,
+            Inventory.objects.filter(actor=self.alice).aggregate(s=Sum('quantity'))['s'] or 0,
+            FrozenInventory.objects.filter(actor=self.alice).aggregate(s=Sum('quantity'))['s'] or 0,
+        )
+
+
+class GuardedMutationTests(BalanceTestCase):
+    def test_overdraw_changes_nothing(self):
+        attempts = [
+            (change_wallet_amount, (self.alice, self.gold, Money('-100.01'))),
+            (change_inventory_quantity, (self.alice, self.sword, -11)),
+            (freeze_wallet, (self.alice, self.gold, Money('150'), 'hold')),
+            (freeze_inventory, (self.alice, self.sword, 11, 'hold')),
+            (unfreeze_wallet, (self.alice, self.gold, Money('1'), 'hold')),
+            (unfreeze_inventory, (self.alice, self.sword, 1, 'hold')),
+        ]
+        for func, args in attempts:
+            # Функции без своего savepoint: ошибка ломает внешнюю транзакцию, поэтому у каждой попытки свой блок
+            with self.subTest(func.__name__), self.assertRaises(ValueError), transaction.atomic():
+                func(*args)
+        self.assertEqual(self.balances(), (100, 0, 10, 0))
+
+    def test_freeze_pools_and_unfreezes(self):
+        freeze_wallet(self.alice, self.gold, Money('30'), 'hold')
+        frozen = freeze_wallet(self.alice, self.gold, Money('20'), 'hold')
+        freeze_inventory(self.alice, self.sword, 4, 'hold')
+        self.assertEqual(frozen.amount, Money('50'))
+        self.assertEqual(FrozenWallet.objects.count(), 1)
+        self.assertEqual(self.balances(), (50, 50, 6, 4))
+
+        with self.assertRaises(ValueError), transaction.atomic():
+            unfreeze_wallet(self.alice, self.gold, Money('60'), 'hold')
+        unfreeze_wallet(self.alice, self.gold, Money('50'), 'hold')
+        unfreeze_inventory(self.alice, self.sword, 4, 'hold')
+        self.assertEqual(self.balances(), (100, 0, 10, 0))
+        self.assertFalse(FrozenWallet.objects.exists() or FrozenInventory.objects.exists())
+
+    def test_debit_to_zero(self):
+        self.assertEqual(change_inventory_quantity(self.alice, self.sword, -10), {'status': 'deleted'})
+        self.assertEqual(change_wallet_amount(self.alice, self.gold, Money('-100')),
+                         {'status': 'ok', 'amount': Money('0')})
+        self.assertEqual(self.balances(), (0, 0, 0, 0))
+
+
+class LedgerTests(BalanceTestCase):
+    def test_unbalanced_operation_raises(self):
+        entries = LedgerEntry.objects.count()
+        with self.assertRaises(RuntimeError), transaction.atomic(), ledger.operation('broken') as op:
+            op.add(self.alice.id, 'available', 5, None, self.gold.id)
+        self.assertEqual(LedgerEntry.objects.count(), entries)
+
+    def test_open_operation_posts_residual_to_clearing(self):
+        with transaction.atomic(), ledger.operation('mint', clearing=True) as op:
+            op.add(self.alice.id, 'available', 5, None, self.gold.id)
+        self.assertEqual(LedgerEntry.objects.get(account='clearing').amount, -5)
+
+    def test_history_is_protected(self):
+        for instance in (self.alice, self.sword, self.gold):
+            with self.subTest(instance), self.assertRaises(ProtectedError), transaction.atomic():
+                instance.delete()
+        self.assertEqual(self.balances(), (100, 0, 10, 0))
+
+
+@mock.patch.object(ledger, 'LEDGER_GRACE', timedelta(0))
+class AuditTests(BalanceTestCase):
+    def totals(self):
+        return {(row.product_id, row.currency_id): row.total for row in SupplyTotal.objects.all()}
+
+    def test_incremental_pass_follows_ledger(self):
+        self.assertEqual(audit(), [])
+        self.assertEqual(self.totals(), {(self.sword.id, None): 10, (None, self.gold.id): 100})
+
+        change_wallet_amount(self.alice, self.gold, Money('25.50'))
+        freeze_inventory(self.alice, self.sword, 3, 'hold')
+        self.assertEqual(audit(), [])
+        self.assertEqual(self.totals(), {(self.sword.id, None): 10, (None, self.gold.id): Decimal('125.50')})
+        self.assertEqual(SupplyTotal.objects.get(currency=self.gold).watermark, LedgerEntry.objects.latest('id').id)
+
+    def test_drift_outside_ledger(self):
+        audit()
+        # Изменение в обход журнала: инкрементальный проход видит его, когда актив снова движется
+        Wallet.objects.filter(actor=self.alice).update(amount=Money('90'))
+        self.assertEqual(audit(), [])
+        change_wallet_amount(self.alice, self.gold, Money('1'))
+        self.assertEqual(audit(), [(None, self.gold.id, 101, 91, 0)])
+        # Полный проход сверяет все активы с журналом целиком
+        Inventory.objects.filter(actor=self.alice).update(quantity=12)
+        self.assertCountEqual(audit(full=True), [(self.sword.id, None, 10, 12, 0), (None, self.gold.id, 101, 91, 0)])
+
+    def test_recent_entries_wait_for_grace(self):
+        audit()
+        with mock.patch.object(ledger, 'LEDGER_GRACE', timedelta(minutes=5)):
+            change_wallet_amount(self.alice, self.gold, Money('5'))
+            # Свежая проводка ещё не учтена, а её движение вычитается из таблиц
+            self.assertEqual(audit(), [])
+            self.assertEqual(self.totals()[(None, self.gold.id)], 100)
+        self.assertEqual(audit(), [])
+        self.assertEqual(self.totals()[(None, self.gold.id)], 105)
+
+
+class BatchUpdateTests(BalanceTestCase):
+    URL = '/internal/batch/update/'
+
+    def setUp(self):
+        super().setUp()
+        self.bob = Actor.objects.create(name='bob', type='npc')
+        self.client = APIClient()
+        self.client.force_authenticate(
+            User.objects.create_user(login='bot', password='x', role='automat', is_staff=True))
+
+    def post(self, rows, mode=None):
+        return self.client.post(self.URL + (f'?mode={mode}' if mode else ''), rows, format='json')
+
+    def test_atomic_batch_is_all_or_nothing(self):
+        response = self.post([
+            {'actor_id': self.alice.id, 'product_id': self.sword.id, 'quantity': 5},
+            {'actor_id': self.bob.id, 'currency_id': self.gold.id, 'amount': '12.50'},
+            {'actor_id': self.alice.id, 'currency_id': self.gold.id, 'amount': '-2.5'},
+        ])
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(response.data['applied'], 3)
+        self.assertEqual(self.balances(), (Decimal('97.50'), 0, 15, 0))
+        self.assertEqual(Wallet.objects.get(actor=self.bob).amount, Money('12.50'))
+
+        # Списание сверх остатка откатывает весь пакет
+        response = self.post([
+            {'actor_id': self.bob.id, 'product_id': self.sword.id, 'quantity': 1},
+            {'actor_id': self.alice.id, 'product_id': self.sword.id, 'quantity': -500},
+        ])
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Inventory.objects.filter(actor=self.bob).exists())
+
+    def test_atomic_batch_rejects_invalid_rows(self):
+        response = self.post([
+            {'actor_id': self.alice.id, 'product_id': self.sword.id, 'quantity': 1},
+            {'actor_id': self.bob.id, 'currency_id': self.gold.id, 'amount': '1.234'},
+            'x',
+        ])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([error['index'] for error in response.data['errors']], [1, 2])
+        self.assertEqual(self.balances(), (100, 0, 10, 0))
+
+    def test_partial_batch_reports_failed_rows(self):
+        response = self.post([
+            {'actor_id': self.alice.id, 'product_id': self.sword.id, 'quantity': -500},
+            {'actor_id': 10 ** 9, 'currency_id': self.gold.id, 'amount': '1'},
+            {'actor_id': self.bob.id, 'product_id': self.sword.id, 'quantity': 1},
+            {'actor_id': self.alice.id, 'product_id': self.sword.id, 'quantity': 10},
+        ], mode='partial')
+        self.assertEqual(response.status_code, 200, response.data)
+        # Дельты одного (актор, актив) складываются: -500 + 10 не проходит обе строки
+        self.assertEqual((response.data['applied'], response.data['failed']), (1, 3))
+        self.assertEqual([error['index'] for error in response.data['errors']], [0, 1, 3])
+        self.assertEqual(self.balances(), (100, 0, 10, 0))
+        self.assertEqual(Inventory.objects.get(actor=self.bob).quantity, 1)
+
+    def test_ndjson_body(self):
+        body = '\n'.join(
+            f'{{"actor_id": {self.bob.id}, "currency_id": {self.gold.id}, "amount": "3.5"}}' for _ in range(4)
+        ) + '\n\n'
+        response = self.client.post(self.URL, data=body.encode(), content_type='application/x-ndjson')
+        self.assertEqual(response.data['applied'], 4)
+        self.assertEqual(Wallet.objects.get(actor=self.bob).amount, Money('14'))
+
+        response = self.client.post(self.URL, data=b'{"actor_id": 1}\n{bad', content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 400)
+
+
+class EscrowTests(BalanceTestCase):
+    def test_rows_keyed_by_escrow_owner(self):
+        freeze_inventory(self.alice, self.sword, 2, EscrowRef.lot(1))
+        freeze_inventory(self.alice, self.sword, 3, EscrowRef.lot(2))
+        freeze_inventory(self.alice, self.sword, 1, 'quest')
+        freeze_inventory(self.alice, self.sword, 1, 'repair')
+        rows = FrozenInventory.objects.order_by('escrow_kind', 'escrow_id')
+        self.assertEqual(
+            [(row.escrow_kind, row.escrow_id, row.quantity, row.reason) for row in rows],
+            [('lot', 1, 2, 'lot:1'), ('lot', 2, 3, 'lot:2'), ('manual', None, 2, 'quest')],
+        )
+
+        # Ручная разморозка не трогает escrow лотов
+        with self.assertRaises(ValueError), transaction.atomic():
+            unfreeze_inventory(self.alice, self.sword, 3, 'quest')
+        unfreeze_inventory(self.alice, self.sword, 3, EscrowRef.lot(2))
+        self.assertEqual(self.balances(), (100, 0, 6, 4))
+
+    def test_manual_endpoints_reject_typed_reason(self):
+        freeze_wallet(self.alice, self.gold, Money('40'), EscrowRef.lot(7))
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user(login='bot', password='x', role='automat', is_staff=True))
+        requests = [
+            ('/internal/wallet/unfreeze/', {'currency_id': self.gold.id, 'amount': '40', 'reason': 'lot:7'}),
+            ('/internal/wallet/freeze/', {'currency_id': self.gold.id, 'amount': '5', 'reason': 'transfer:3'}),
+            ('/internal/inventory/unfreeze/', {'product_id': self.sword.id, 'quantity': 1, 'reason': 'lot:7'}),
+            ('/internal/inventory/freeze/', {'product_id': self.sword.id, 'quantity': 1, 'reason': 'lot:8'}),
+        ]
+        for url, data in requests:
+            with self.subTest(url):
+                response = client.post(url, {'actor_id': self.alice.id, **data}, format='json')
+                self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.balances(), (60, 40, 10, 0))
+
+        # Обычная подпись, похожая на ссылку, остаётся ручной
+        response = client.post('/internal/wallet/freeze/', {
+            'actor_id': self.alice.id, 'currency_id': self.gold.id, 'amount': '5', 'reason': 'lot 7 deposit',
+        }, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+
+
+class MoneyTests(TestCase):
+    def setUp(self):
+        self.gold = Currency.objects.create(name='Gold', symbol='G')
+        self.sword = Product.objects.create(name='Sword', price=Decimal('10'), currency=self.gold)
+        self.alice = Actor.objects.create(name='alice', type='npc')
+
+    def raw(self, model, column, row_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT {column} FROM {model._meta.db_table} WHERE id = %s", [row_id])
+            return cursor.fetchone()[0]
+
+    def test_money_field_round_trip(self):
+        wallet = Wallet.objects.create(actor=self.alice, currency=self.gold, amount=Money('12.34'))
+
+        self.assertEqual(self.raw(Wallet, 'amount', wallet.id), 1234)
+        wallet.refresh_from_db()
+        self.assertIsInstance(wallet.amount, Money)
+        self.assertEqual(wallet.amount, Decimal('12.34'))
+        self.assertEqual(Wallet.objects.filter(amount=Decimal('12.34')).count(), 1)
+
+    def test_minor_units(self):
+        self.assertEqual(Money.from_minor(1234), Money('12.34'))
+        self.assertEqual(to_minor('0.5'), 50)
+        self.assertEqual(Money(7).minor, 700)
+
+    def test_rejects_float_and_sub_minor(self):
+        with self.assertRaises(TypeError):
+            Money(1.5)
+        with self.assertRaises(ValueError):
+            Money('0.001')
+        field = MoneySerializerField()
+        self.assertEqual(field.run_validation('3.10'), Money('3.1'))
+        with self.assertRaises(ValidationError):
+            field.run_validation('1.234')
+
+    def test_convert_money_columns(self):
+        wallet = Wallet.objects.create(actor=self.alice, currency=self.gold, amount=Money('12.34'))
+        level = MarketDepthLevel.objects.create(product=self.sword, currency=self.gold, side='sell',
+                                                price=Money('7.50'), quantity=1, lot_count=1)
+        # Колонки в старом виде: numeric в основных единицах
+        with connection.cursor() as cursor:
+            # Отложенные проверки FK вставок выше иначе не дают менять таблицу в той же транзакции
+            cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+            for model, column in ((Wallet, 'amount'), (MarketDepthLevel, 'price')):
+                cursor.execute(f"ALTER TABLE {model._meta.db_table} ALTER COLUMN {column} "
+                               f"TYPE numeric(16, 2) USING {column} / 100.0")
+
+        out = StringIO()
+        call_command('convert_money_columns', stdout=out)
+        self.assertIn("Переведено колонок: 2", out.getvalue())
+        self.assertEqual(self.raw(Wallet, 'amount', wallet.id), 1234)
+        self.assertEqual(MarketDepthLevel.objects.get(id=level.id).price, Money('7.50'))
+
+
+class WalletStripeTests(BalanceTestCase):
+    def setUp(self):
+        super().setUp()
+        self.bank = Actor.objects.create(name='bank', type='npc', wallet_stripes=4)
+        for _ in range(20):
+            change_wallet_amount(self.bank, self.gold, Money('1.25'))
+
+    def rows(self):
+        return Wallet.objects.filter(actor=self.bank)
+
+    def test_credits_spread_over_stripes(self):
+        self.assertLessEqual(self.rows().count(), 4)
+        self.assertEqual(self.rows().aggregate(s=Sum('amount'))['s'], 25)
+
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user(login='gm', password='x', role='master', is_staff=True))
+        wallet = client.get(f'/internal/actor/{self.bank.id}/wallet/').data['wallet']
+        self.assertEqual([Decimal(row['amount']) for row in wallet], [25])
+
+    def test_debit_folds_stripes(self):
+        # Полоса 0 меньше списания — полосы сливаются, и списание проходит
+        self.assertEqual(change_wallet_amount(self.bank, self.gold, Money('-24')),
+                         {'status': 'ok', 'amount': Money('1')})
+        self.assertEqual(list(self.rows().values_list('stripe', 'amount')), [(0, Money('1'))])
+        with self.assertRaises(ValueError), transaction.atomic():
+            change_wallet_amount(self.bank, self.gold, Money('-2'))
 
-# Create your tests here.
+    def test_compact_wallets_command(self):
+        out = StringIO()
+        call_command('compact_wallets', stdout=out)
+        self.assertEqual(list(self.rows().values_list('stripe', 'amount')), [(0, Money('25'))])
+        # Кошелёк без полос не трогается
+        self.assertEqual(Wallet.objects.filter(actor=self.alice).count(), 1)
@@ -1,17 +1,23 @@
 from django.urls import path
-from .views import InventoryUpdateView, WalletUpdateView, ActorWalletView, ActorInventoryView, ActorFrozenWalletView, \
-    ActorFrozenInventoryView, FreezeInventoryView, UnfreezeInventoryView, FreezeWalletView, UnfreezeWalletView
+from .views import InventoryUpdateView, WalletUpdateView, BatchUpdateView, ActorWalletView, ActorInventoryView, ActorFrozenWalletView, \
+    ActorFrozenInventoryView, ActorPortfolioView, ActorBalanceAtView, \
+    ActorValuationView, ValuationLeaderboardView, FreezeInventoryView, UnfreezeInventoryView, FreezeWalletView, UnfreezeWalletView
 
 urlpatterns = [
     # Существующие
     path('inventory/update/', InventoryUpdateView.as_view()),
     path('wallet/update/', WalletUpdateView.as_view()),
+    path('batch/update/', BatchUpdateView.as_view()),
     path('actor/<int:actor_id>/inventory/', ActorInventoryView.as_view()),
     path('actor/<int:actor_id>/wallet/', ActorWalletView.as_view()),
 
     # Новые — просмотр замороженных активов
     path('actor/<int:actor_id>/frozen_inventory/', ActorFrozenInventoryView.as_view(), name='actor-frozen-inventory'),
     path('actor/<int:actor_id>/frozen_wallet/', ActorFrozenWalletView.as_view(), name='actor-frozen-wallet'),
+    path('actor/<int:actor_id>/portfolio/', ActorPortfolioView.as_view(), name='actor-portfolio'),
+    path('actor/<int:actor_id>/balance_at/', ActorBalanceAtView.as_view(), name='actor-balance-at'),
+    path('actor/<int:actor_id>/valuation/', ActorValuationView.as_view(), name='actor-valuation'),
+    path('valuation/leaderboard/', ValuationLeaderboardView.as_view(), name='valuation-leaderboard'),
 
     # Internal freeze/unfreeze (уже есть)
     path('inventory/freeze/', FreezeInventoryView.as_view()),
@@ -1,134 +1,721 @@
 # wallet_inventory/utils.py
 
-from django.db import transaction
+from django.db import connection, transaction
+
+from actors.models import Actor
+from eve_backend.events import publish
+from eve_backend.money import Money, to_minor
+from . import ledger
+from .escrow import LOT, MANUAL, EscrowRef
 from .models import Inventory, Wallet, FrozenInventory, FrozenWallet
 
 
+def _publish_inventory(quantities):
+    """События изменения инвентаря {(actor_id, product_id): quantity} для подписчиков"""
+    publish([
+        {"type": "inventory", "actor": actor_id, "product": product_id, "quantity": max(quantity, 0)}
+        for (actor_id, product_id), quantity in quantities.items()
+    ])
 
-@transaction.atomic
-def unfreeze_inventory(actor, product, quantity, reason="manual"):
-    """Возвращает замороженные предметы обратно в инвентарь"""
-    try:
-        frozen = FrozenInventory.objects.get(actor=actor, product=product, reason=reason)
-    except FrozenInventory.DoesNotExist:
-        raise ValueError(f"Нет замороженных {product.name} по причине '{reason}'")
-
-    if frozen.quantity < quantity:
-        raise ValueError(f"Недостаточно заморожено: {frozen.quantity} < {quantity}")
-
-    frozen.quantity -= quantity
-    if frozen.quantity <= 0:
-        frozen.delete()
-    else:
-        frozen.save()
 
-    inv, _ = Inventory.objects.get_or_create(actor=actor, product=product)
-    inv.quantity += quantity
-    inv.save()
-    return inv
+def _publish_wallets(amounts):
+    """События изменения кошельков {(actor_id, currency_id): amount} для подписчиков"""
+    publish([
+        {"type": "wallet", "actor": actor_id, "currency": currency_id, "amount": amount}
+        for (actor_id, currency_id), amount in amounts.items()
+    ])
 
 
-@transaction.atomic
-def freeze_inventory(actor, product, quantity, reason="manual", lot=None):
-    """Перемещает quantity предметов из обычного инвентаря в frozen"""
-    if not actor.is_system:
-        inv, _ = Inventory.objects.get_or_create(actor=actor, product=product)
-        if inv.quantity < quantity:
-            raise ValueError(f"Недостаточно {product.name} в инвентаре: {inv.quantity} < {quantity}")
-
-        inv.quantity -= quantity
-        if inv.quantity <= 0:
-            inv.delete()
-        else:
-            inv.save()
+# ====================
+# Одиночные операции: каждое изменение — один SQL-запрос (CTE / ON CONFLICT)
+# с проверкой остатка в WHERE, без чтения строки в Python.
+# Проводки журнала пишутся в той же транзакции (savepoint=False — без
+# SAVEPOINT, если транзакция уже открыта вызывающим кодом)
+# ====================
+
+INVENTORY = Inventory._meta.db_table
+WALLET = Wallet._meta.db_table
+FROZEN_INVENTORY = FrozenInventory._meta.db_table
+FROZEN_WALLET = FrozenWallet._meta.db_table
+
+ACTOR = Actor._meta.db_table
+
+# Деньги в этих таблицах — BIGINT в минимальных единицах (eve_backend.money):
+# параметры передаются через to_minor(), прочитанное — через Money.from_minor()
+
+# Кошелёк актора с Actor.wallet_stripes > 1 разбит на полосы: зачисление идёт
+# в случайную полосу (горячие акторы не ждут блокировку одной строки),
+# списание — только из полосы 0, остаток — сумма полос. compact_wallets()
+# сливает полосы в полосу 0
 
-    frozen, _ = FrozenInventory.objects.get_or_create(
-        actor=actor, product=product, reason=reason,
-        defaults={'quantity': quantity, 'lot': lot}
+
+def _stripe_for(actor):
+    """Случайная полоса кошелька актора (SQL-выражение); у обычного актора — 0"""
+    return f"(SELECT floor(random() * wallet_stripes)::smallint FROM {ACTOR} WHERE id = {actor})"
+
+
+def _wallet_total(alias):
+    """Остаток кошелька по всем полосам для изменённой строки alias"""
+    return (
+        f"{alias}.amount + COALESCE((SELECT SUM(o.amount) FROM {WALLET} o WHERE o.actor_id = {alias}.actor_id"
+        f" AND o.currency_id = {alias}.currency_id AND o.stripe <> {alias}.stripe), 0)"
     )
-    if not frozen._state.adding:
-        frozen.quantity += quantity
-        frozen.save()
+
+
+def _fetchone(sql, params):
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchone()
+
+
+def _escrow_where(typed):
+    """Строка escrow по (escrow_kind, escrow_id); у ручной заморозки escrow_id пуст"""
+    if typed:
+        return " AND escrow_kind = %(kind)s AND escrow_id = %(escrow_id)s"
+    return " AND escrow_kind = %(kind)s AND escrow_id IS NULL"
+
+
+def _escrow_params(ref):
+    return {'kind': ref.kind, 'escrow_id': ref.id, 'reason': str(ref)}
+
+
+def _debit_cte(table, asset, column, delete_empty, escrow=None):
+    """
+    CTE debit(balance): списывает %(value)s со строки (actor, asset[, escrow]),
+    только если остатка хватает. С delete_empty строка, уходящая в ноль,
+    удаляется: условия UPDATE и DELETE взаимоисключающие, поэтому в одном
+    запросе они никогда не трогают одну строку.
+    """
+    where = f"actor_id = %(actor)s AND {asset} = %(asset)s" + (_escrow_where(escrow) if escrow is not None else "")
+    if not delete_empty:
+        striped = table == WALLET
+        return f"""debit AS (
+            UPDATE {table} SET {column} = {column} - %(value)s
+            WHERE {where} {"AND stripe = 0" if striped else ""} AND {column} >= %(value)s
+            RETURNING {_wallet_total(table) if striped else column} AS balance
+        )"""
+    return f"""updated AS (
+            UPDATE {table} SET {column} = {column} - %(value)s
+            WHERE {where} AND {column} > %(value)s
+            RETURNING {column} AS balance
+        ), deleted AS (
+            DELETE FROM {table}
+            WHERE {where} AND {column} = %(value)s
+            RETURNING 0 AS balance
+        ), debit AS (
+            SELECT balance FROM updated UNION ALL SELECT balance FROM deleted
+        )"""
+
+
+def _credit_sql(table, asset, column, source=None):
+    """Зачисление %(value)s upsert-ом; с source — только если в CTE source есть строка"""
+    if table == WALLET:
+        return f"""
+            INSERT INTO {table} AS t (actor_id, {asset}, stripe, {column})
+            SELECT %(actor)s, %(asset)s, {_stripe_for('%(actor)s')}, %(value)s {f"FROM {source}" if source else ""}
+            ON CONFLICT (actor_id, {asset}, stripe) DO UPDATE SET {column} = t.{column} + EXCLUDED.{column}
+            RETURNING t.id, {_wallet_total('t')}
+        """
+    return f"""
+        INSERT INTO {table} AS t (actor_id, {asset}, {column})
+        SELECT %(actor)s, %(asset)s, %(value)s {f"FROM {source}" if source else ""}
+        ON CONFLICT (actor_id, {asset}) DO UPDATE SET {column} = t.{column} + EXCLUDED.{column}
+        RETURNING t.id, t.{column}
+    """
+
+
+def _frozen_credit_sql(table, asset, column, source=None):
+    """
+    Добавление в escrow (actor, asset, escrow_kind, escrow_id); lot и подпись
+    reason проставляются только новой строке
+    """
+    return f"""
+        INSERT INTO {table} AS t (actor_id, {asset}, escrow_kind, escrow_id, reason, {column}, lot_id, created_at)
+        SELECT %(actor)s, %(asset)s, %(kind)s, %(escrow_id)s::bigint, %(reason)s, %(value)s, %(lot)s::bigint, NOW()
+        {f"FROM {source}" if source else ""}
+        ON CONFLICT (actor_id, {asset}, escrow_kind, escrow_id) DO UPDATE SET {column} = t.{column} + EXCLUDED.{column}
+        RETURNING t.id, t.{column}, t.lot_id
+    """
+
+
+_FREEZE_INVENTORY = f"""
+    WITH {_debit_cte(INVENTORY, 'product_id', 'quantity', delete_empty=True)},
+    frozen AS ({_frozen_credit_sql(FROZEN_INVENTORY, 'product_id', 'quantity', source='debit')})
+    SELECT frozen.id, frozen.quantity, frozen.lot_id, debit.balance FROM frozen, debit
+"""
+_FREEZE_WALLET = f"""
+    WITH {_debit_cte(WALLET, 'currency_id', 'amount', delete_empty=False)},
+    frozen AS ({_frozen_credit_sql(FROZEN_WALLET, 'currency_id', 'amount', source='debit')})
+    SELECT frozen.id, frozen.amount, frozen.lot_id, debit.balance FROM frozen, debit
+"""
+# {typed: sql}: типизированный escrow ищется по индексу (escrow_kind, escrow_id)
+_UNFREEZE_INVENTORY = {typed: f"""
+    WITH {_debit_cte(FROZEN_INVENTORY, 'product_id', 'quantity', delete_empty=True, escrow=typed)}
+    {_credit_sql(INVENTORY, 'product_id', 'quantity', source='debit')}
+""" for typed in (True, False)}
+_UNFREEZE_WALLET = {typed: f"""
+    WITH {_debit_cte(FROZEN_WALLET, 'currency_id', 'amount', delete_empty=True, escrow=typed)}
+    {_credit_sql(WALLET, 'currency_id', 'amount', source='debit')}
+""" for typed in (True, False)}
+_DEBIT_INVENTORY = f"WITH {_debit_cte(INVENTORY, 'product_id', 'quantity', delete_empty=True)} SELECT balance FROM debit"
+_DEBIT_WALLET = f"WITH {_debit_cte(WALLET, 'currency_id', 'amount', delete_empty=False)} SELECT balance FROM debit"
+_CREDIT_INVENTORY = _credit_sql(INVENTORY, 'product_id', 'quantity')
+_CREDIT_WALLET = _credit_sql(WALLET, 'currency_id', 'amount')
+
+
+def _balance(table, asset, column, actor, asset_id, escrow=None):
+    """Текущий остаток (у кошелька — сумма полос) — только для текста ошибки, на успешном пути не читается"""
+    sql = f"SELECT SUM({column}) FROM {table} WHERE actor_id = %(actor)s AND {asset} = %(asset)s"
+    params = {'actor': actor.id, 'asset': asset_id}
+    if escrow is not None:
+        sql += _escrow_where(escrow.typed)
+        params.update(_escrow_params(escrow))
+    value = _fetchone(sql, params)[0]
+    if value is None:
+        return None
+    return Money.from_minor(value) if column == 'amount' else value
+
+
+def _source_leg(actor, amount, product_id, currency_id):
+    """Откуда берётся заморозка: системный актор не расходует запас — эмиссия извне"""
+    if actor.is_system:
+        return (None, 'external', amount, product_id, currency_id)
+    return (actor.id, 'available', amount, product_id, currency_id)
+
+
+@transaction.atomic(savepoint=False)
+def unfreeze_inventory(actor, product, quantity, escrow=MANUAL):
+    """Возвращает замороженные предметы обратно в инвентарь; escrow — EscrowRef или подпись"""
+    escrow = EscrowRef.of(escrow)
+    params = {'actor': actor.id, 'asset': product.id, 'value': quantity, **_escrow_params(escrow)}
+    row = _fetchone(_UNFREEZE_INVENTORY[escrow.typed], params)
+    if row is None:
+        frozen = _balance(FROZEN_INVENTORY, 'product_id', 'quantity', actor, product.id, escrow)
+        if frozen is None:
+            raise ValueError(f"Нет замороженных {product.name} по причине '{escrow}'")
+        raise ValueError(f"Недостаточно заморожено: {frozen} < {quantity}")
+
+    inv_id, inv_quantity = row
+    ledger.post(str(escrow), [
+        (actor.id, 'frozen', -quantity, product.id, None),
+        (actor.id, 'available', quantity, product.id, None),
+    ])
+    _publish_inventory({(actor.id, product.id): inv_quantity})
+    return Inventory(id=inv_id, actor=actor, product=product, quantity=inv_quantity)
+
+
+@transaction.atomic(savepoint=False)
+def freeze_inventory(actor, product, quantity, escrow=MANUAL, lot=None):
+    """Перемещает quantity предметов из обычного инвентаря в frozen под escrow (EscrowRef или подпись)"""
+    escrow = EscrowRef.of(escrow)
+    params = {'actor': actor.id, 'asset': product.id, 'value': quantity, 'lot': lot.id if lot else None,
+              **_escrow_params(escrow)}
+    if actor.is_system:
+        # Системный актор не расходует инвентарь
+        row = _fetchone(_frozen_credit_sql(FROZEN_INVENTORY, 'product_id', 'quantity'), params)
+    else:
+        row = _fetchone(_FREEZE_INVENTORY, params)
+        if row is None:
+            available = _balance(INVENTORY, 'product_id', 'quantity', actor, product.id) or 0
+            raise ValueError(f"Недостаточно {product.name} в инвентаре: {available} < {quantity}")
+        _publish_inventory({(actor.id, product.id): row[3]})
+
+    ledger.post(str(escrow), [
+        _source_leg(actor, -quantity, product.id, None),
+        (actor.id, 'frozen', quantity, product.id, None),
+    ])
+    frozen_id, frozen_quantity, lot_id = row[:3]
+    frozen = FrozenInventory(id=frozen_id, actor=actor, product=product, quantity=frozen_quantity,
+                             escrow_kind=escrow.kind, escrow_id=escrow.id, reason=str(escrow), lot_id=lot_id)
+    if lot is not None and lot.id == lot_id:
+        frozen.lot = lot
     return frozen
 
-@transaction.atomic
-def freeze_wallet(actor, currency, amount, reason="manual", lot=None):
-    """Замораживает деньги"""
-    if not actor.is_system:
-        wallet, _ = Wallet.objects.get_or_create(actor=actor, currency=currency, defaults={'amount': 0})
-        if wallet.amount < amount:
-            raise ValueError(f"Недостаточно средств: {wallet.amount} < {amount}")
-
-        wallet.amount -= amount
-        wallet.save()
-
-    frozen, _ = FrozenWallet.objects.get_or_create(
-        actor=actor, currency=currency, reason=reason,
-        defaults={'amount': amount, 'lot': lot}
-    )
-    if not frozen._state.adding:
-        frozen.amount += amount
-        frozen.save()
+@transaction.atomic(savepoint=False)
+def freeze_wallet(actor, currency, amount, escrow=MANUAL, lot=None):
+    """Замораживает деньги под escrow (EscrowRef или подпись)"""
+    escrow = EscrowRef.of(escrow)
+    params = {'actor': actor.id, 'asset': currency.id, 'value': to_minor(amount), 'lot': lot.id if lot else None,
+              **_escrow_params(escrow)}
+    if actor.is_system:
+        row = _fetchone(_frozen_credit_sql(FROZEN_WALLET, 'currency_id', 'amount'), params)
+    else:
+        row = _fetchone(_FREEZE_WALLET, params)
+        if row is None and compact_wallets([(actor.id, currency.id)]):
+            row = _fetchone(_FREEZE_WALLET, params)
+        if row is None:
+            available = _balance(WALLET, 'currency_id', 'amount', actor, currency.id) or 0
+            raise ValueError(f"Недостаточно средств: {available} < {amount}")
+        _publish_wallets({(actor.id, currency.id): Money.from_minor(row[3])})
+
+    ledger.post(str(escrow), [
+        _source_leg(actor, -amount, None, currency.id),
+        (actor.id, 'frozen', amount, None, currency.id),
+    ])
+    frozen_id, frozen_amount, lot_id = row[:3]
+    frozen = FrozenWallet(id=frozen_id, actor=actor, currency=currency, amount=Money.from_minor(frozen_amount),
+                          escrow_kind=escrow.kind, escrow_id=escrow.id, reason=str(escrow), lot_id=lot_id)
+    if lot is not None and lot.id == lot_id:
+        frozen.lot = lot
     return frozen
 
 
-@transaction.atomic
-def unfreeze_wallet(actor, currency, amount, reason="manual"):
-    """Размораживает деньги обратно"""
-    try:
-        frozen = FrozenWallet.objects.get(actor=actor, currency=currency, reason=reason)
-    except FrozenWallet.DoesNotExist:
-        raise ValueError(f"Нет замороженных средств по причине '{reason}'")
-
-    if frozen.amount < amount:
-        raise ValueError(f"Недостаточно заморожено: {frozen.amount} < {amount}")
-
-    frozen.amount -= amount
-    if frozen.amount <= 0:
-        frozen.delete()
-    else:
-        frozen.save()
+@transaction.atomic(savepoint=False)
+def unfreeze_wallet(actor, currency, amount, escrow=MANUAL):
+    """Размораживает деньги обратно; escrow — EscrowRef или подпись"""
+    escrow = EscrowRef.of(escrow)
+    params = {'actor': actor.id, 'asset': currency.id, 'value': to_minor(amount), **_escrow_params(escrow)}
+    row = _fetchone(_UNFREEZE_WALLET[escrow.typed], params)
+    if row is None:
+        frozen = _balance(FROZEN_WALLET, 'currency_id', 'amount', actor, currency.id, escrow)
+        if frozen is None:
+            raise ValueError(f"Нет замороженных средств по причине '{escrow}'")
+        raise ValueError(f"Недостаточно заморожено: {frozen} < {amount}")
 
-    wallet, _ = Wallet.objects.get_or_create(actor=actor, currency=currency, defaults={'amount': 0})
-    wallet.amount += amount
-    wallet.save()
-    return wallet
+    wallet_id, wallet_amount = row[0], Money.from_minor(row[1])
+    ledger.post(str(escrow), [
+        (actor.id, 'frozen', -amount, None, currency.id),
+        (actor.id, 'available', amount, None, currency.id),
+    ])
+    _publish_wallets({(actor.id, currency.id): wallet_amount})
+    return Wallet(id=wallet_id, actor=actor, currency=currency, amount=wallet_amount)
 
 
-@transaction.atomic
+@transaction.atomic(savepoint=False)
 def change_inventory_quantity(actor, product, quantity_delta):
     """
     Универсальная функция: добавляет/вычитает quantity_delta (может быть отрицательным).
     Используется и в update_view, и в сделках.
+    Списание больше остатка — ValueError, ничего не меняется.
     """
     if quantity_delta == 0:
-        return {'status': 'ok', 'quantity': Inventory.objects.filter(actor=actor, product=product).first().quantity or 0}
+        quantity = _balance(INVENTORY, 'product_id', 'quantity', actor, product.id)
+        return {'status': 'ok', 'quantity': quantity or 0}
 
-    obj, created = Inventory.objects.get_or_create(actor=actor, product=product)
-    obj.quantity += quantity_delta
+    params = {'actor': actor.id, 'asset': product.id, 'value': abs(quantity_delta)}
+    if quantity_delta > 0:
+        _, quantity = _fetchone(_CREDIT_INVENTORY, params)
+    else:
+        row = _fetchone(_DEBIT_INVENTORY, params)
+        if row is None:
+            available = _balance(INVENTORY, 'product_id', 'quantity', actor, product.id) or 0
+            raise ValueError(f"Недостаточно {product.name} в инвентаре: {available} < {-quantity_delta}")
+        quantity = row[0]
 
-    if obj.quantity <= 0:
-        obj.delete()
+    # Вне операции — эмиссия/изъятие; в операции (перевод) причина берётся от неё
+    with ledger.operation('change') as op:
+        op.add(actor.id, 'available', quantity_delta, product.id, None)
+        op.add(None, 'external', -quantity_delta, product.id, None)
+    _publish_inventory({(actor.id, product.id): quantity})
+    if quantity == 0:
         return {'status': 'deleted'}
-    else:
-        obj.save()
-        return {'status': 'ok', 'quantity': obj.quantity}
+    return {'status': 'ok', 'quantity': quantity}
 
 
-@transaction.atomic
+@transaction.atomic(savepoint=False)
 def change_wallet_amount(actor, currency, amount_delta):
     """
     Универсальная функция для изменения баланса.
+    Списание больше остатка — ValueError (раньше баланс молча обрезался до нуля).
     """
     if amount_delta == 0:
-        wallet = Wallet.objects.filter(actor=actor, currency=currency).first()
-        return {'status': 'ok', 'amount': wallet.amount if wallet else 0}
+        amount = _balance(WALLET, 'currency_id', 'amount', actor, currency.id)
+        return {'status': 'ok', 'amount': amount or 0}
+
+    params = {'actor': actor.id, 'asset': currency.id, 'value': to_minor(abs(amount_delta))}
+    if amount_delta > 0:
+        _, amount = _fetchone(_CREDIT_WALLET, params)
+    else:
+        row = _fetchone(_DEBIT_WALLET, params)
+        if row is None and compact_wallets([(actor.id, currency.id)]):
+            row = _fetchone(_DEBIT_WALLET, params)
+        if row is None:
+            available = _balance(WALLET, 'currency_id', 'amount', actor, currency.id) or 0
+            raise ValueError(f"Недостаточно средств: {available} < {-amount_delta}")
+        amount = row[0]
+    amount = Money.from_minor(amount)
+
+    # Вне операции — эмиссия/изъятие; в операции (перевод) причина берётся от неё
+    with ledger.operation('change') as op:
+        op.add(actor.id, 'available', amount_delta, None, currency.id)
+        op.add(None, 'external', -amount_delta, None, currency.id)
+    _publish_wallets({(actor.id, currency.id): amount})
+    return {'status': 'ok', 'amount': amount}
+
+
+# ====================
+# Массовые операции: один запрос на выборку с блокировкой и bulk-запись
+# ====================
+
+# Строки блокируются в едином порядке (actor_id, asset_id), инвентарь раньше
+# кошельков: встречные операции одних и тех же акторов ждут друг друга,
+# а не сцепляются во взаимную блокировку
+
+def _lock_inventory(keys):
+    """Блокирует строки Inventory для набора (actor_id, product_id)"""
+    if not keys:
+        return {}
+    actor_ids = {actor_id for actor_id, _ in keys}
+    product_ids = {product_id for _, product_id in keys}
+    rows = (
+        Inventory.objects.select_for_update()
+        .filter(actor_id__in=actor_ids, product_id__in=product_ids)
+        .order_by('actor_id', 'product_id')
+    )
+    return {(row.actor_id, row.product_id): row for row in rows}
+
+
+def _lock_wallets(keys, skip_striped=False):
+    """
+    Блокирует строки Wallet (полосу 0) для набора (actor_id, currency_id).
+    skip_striped — не трогать полосатые кошельки: зачисления в них не ждут друг друга
+    """
+    if not keys:
+        return {}
+    actor_ids = {actor_id for actor_id, _ in keys}
+    currency_ids = {currency_id for _, currency_id in keys}
+    rows = (
+        Wallet.objects.select_for_update(of=('self',))
+        .filter(actor_id__in=actor_ids, currency_id__in=currency_ids, stripe=0)
+        .order_by('actor_id', 'currency_id')
+    )
+    if skip_striped:
+        rows = rows.filter(actor__wallet_stripes__lte=1)
+    return {(row.actor_id, row.currency_id): row for row in rows}
+
+
+def lock_balances(inventory_keys=(), wallet_keys=()):
+    """
+    Блокирует строки Inventory и Wallet многосторонней операции (сделка,
+    перевод, снятие лотов) в едином порядке до первого изменения.
+    Ещё не созданные строки заблокировать нельзя — их создаст upsert.
+    """
+    _lock_inventory(set(inventory_keys))
+    _lock_wallets(set(wallet_keys), skip_striped=True)
+
+
+_COMPACT_WALLETS = f"""
+    WITH moved AS (
+        DELETE FROM {WALLET} AS w
+        WHERE w.stripe > 0 {{keys}}
+        RETURNING w.actor_id, w.currency_id, w.amount
+    )
+    INSERT INTO {WALLET} AS t (actor_id, currency_id, stripe, amount)
+    SELECT actor_id, currency_id, 0, SUM(amount) FROM moved GROUP BY actor_id, currency_id
+    ON CONFLICT (actor_id, currency_id, stripe) DO UPDATE SET amount = t.amount + EXCLUDED.amount
+"""
+
+
+def compact_wallets(keys=None):
+    """
+    Сливает полосы кошельков в полосу 0 одним запросом. keys — набор
+    (actor_id, currency_id), None — все кошельки. Остаток не меняется,
+    проводок нет. Возвращает число кошельков, в которых были полосы.
+    """
+    if keys is None:
+        sql, params = _COMPACT_WALLETS.format(keys=""), []
+    else:
+        keys = list(keys)
+        if not keys:
+            return 0
+        sql = _COMPACT_WALLETS.format(
+            keys="AND (w.actor_id, w.currency_id) IN (SELECT * FROM unnest(%s::bigint[], %s::bigint[]))"
+        )
+        params = [[actor_id for actor_id, _ in keys], [currency_id for _, currency_id in keys]]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.rowcount
+
+
+def merge_stripes(wallets):
+    """Строки Wallet одного актора → по строке на валюту с суммой полос (для чтения)"""
+    merged = {}
+    for wallet in wallets:
+        if wallet.currency_id in merged:
+            merged[wallet.currency_id].amount += wallet.amount
+        else:
+            merged[wallet.currency_id] = wallet
+    return list(merged.values())
+
+
+def _write_inventory(rows, quantities):
+    """Записывает новые количества: обновление, создание или удаление пустых строк"""
+    to_update, to_create, to_delete = [], [], []
+    for key, quantity in quantities.items():
+        row = rows.get(key)
+        if row is None:
+            if quantity > 0:
+                to_create.append(Inventory(actor_id=key[0], product_id=key[1], quantity=quantity))
+        elif quantity <= 0:
+            to_delete.append(row.id)
+        elif row.quantity != quantity:
+            row.quantity = quantity
+            to_update.append(row)
+
+    if to_update:
+        Inventory.objects.bulk_update(to_update, ['quantity'])
+    if to_create:
+        Inventory.objects.bulk_create(to_create)
+    if to_delete:
+        Inventory.objects.filter(id__in=to_delete).delete()
+    _publish_inventory(quantities)
+
+
+def _write_wallets(rows, amounts):
+    to_update, to_create = [], []
+    for key, amount in amounts.items():
+        row = rows.get(key)
+        if row is None:
+            to_create.append(Wallet(actor_id=key[0], currency_id=key[1], amount=amount))
+        elif row.amount != amount:
+            row.amount = amount
+            to_update.append(row)
+
+    if to_update:
+        Wallet.objects.bulk_update(to_update, ['amount'])
+    if to_create:
+        Wallet.objects.bulk_create(to_create)
+    _publish_wallets(amounts)
+
+
+def _bulk_change_sql(table, asset, column, value_type):
+    """
+    Применяет дельты из unnest одним запросом: списания — UPDATE с проверкой
+    остатка, зачисления — upsert. Возвращает (id, actor_id, asset, balance)
+    изменённых строк; списание, которому не хватило остатка, строки не вернёт.
+    Кошелёк списывается из полосы 0, зачисляется в случайную полосу актора.
+    """
+    striped = table == WALLET
+    balance = _wallet_total('t') if striped else f"t.{column}"
+    if striped:
+        credit = f"""
+            INSERT INTO {table} AS t (actor_id, {asset}, stripe, {column})
+            SELECT delta.actor_id, delta.asset_id, floor(random() * a.wallet_stripes)::smallint, delta.value
+            FROM delta JOIN {ACTOR} a ON a.id = delta.actor_id WHERE delta.value > 0
+            ON CONFLICT (actor_id, {asset}, stripe) DO UPDATE SET {column} = t.{column} + EXCLUDED.{column}"""
+    else:
+        credit = f"""
+            INSERT INTO {table} AS t (actor_id, {asset}, {column})
+            SELECT actor_id, asset_id, value FROM delta WHERE value > 0
+            ON CONFLICT (actor_id, {asset}) DO UPDATE SET {column} = t.{column} + EXCLUDED.{column}"""
+    return f"""
+        WITH delta(actor_id, asset_id, value) AS (
+            SELECT * FROM unnest(%s::bigint[], %s::bigint[], %s::{value_type}[])
+        ), debit AS (
+            UPDATE {table} AS t SET {column} = t.{column} + delta.value
+            FROM delta
+            WHERE delta.value < 0 AND t.actor_id = delta.actor_id AND t.{asset} = delta.asset_id
+                {"AND t.stripe = 0" if striped else ""} AND t.{column} + delta.value >= 0
+            RETURNING t.id, t.actor_id, t.{asset}, {balance}
+        ), credit AS ({credit}
+            RETURNING t.id, t.actor_id, t.{asset}, {balance}
+        )
+        SELECT * FROM debit UNION ALL SELECT * FROM credit
+    """
+
+
+_BULK_CHANGE_INVENTORY = _bulk_change_sql(INVENTORY, 'product_id', 'quantity', 'bigint')
+_BULK_CHANGE_WALLET = _bulk_change_sql(WALLET, 'currency_id', 'amount', 'bigint')
+
+
+def _bulk_change(sql, deltas, money=False):
+    """money — дельты и остатки в деньгах: в SQL уходят минимальные единицы"""
+    deltas = {key: delta for key, delta in deltas.items() if delta}
+    if not deltas:
+        return [], []
+    keys = list(deltas)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [
+            [actor_id for actor_id, _ in keys],
+            [asset_id for _, asset_id in keys],
+            [to_minor(deltas[key]) if money else deltas[key] for key in keys],
+        ])
+        rows = cursor.fetchall()
+    if money:
+        rows = [(*row[:3], Money.from_minor(row[3])) for row in rows]
+    missing = set(keys) - {(actor_id, asset_id) for _, actor_id, asset_id, _ in rows}
+    return rows, sorted(missing)
+
+
+# Массовые изменения должны идти внутри транзакции вызывающего кода: при
+# ValueError часть дельт уже применена, и откатывается вся транзакция
+# (savepoint=False — без лишних SAVEPOINT/RELEASE на каждую пачку)
+
+@transaction.atomic(savepoint=False)
+def bulk_change_inventory(deltas, strict=True):
+    """
+    Применяет изменения {(actor_id, product_id): delta} одним запросом.
+    Уход количества в минус — ValueError; со strict=False такие списания
+    пропускаются, остальные применяются, возвращается список пропущенных ключей.
+    """
+    rows, missing = _bulk_change(_BULK_CHANGE_INVENTORY, deltas)
+    if missing and strict:
+        actor_id, product_id = missing[0]
+        raise ValueError(f"Недостаточно предметов {product_id} у актора {actor_id}: {deltas[missing[0]]}")
+    # Вне операции — открытая эмиссия/изъятие без встречной проводки: остаток на clearing
+    with ledger.operation('change', clearing=True) as op:
+        for _, actor_id, product_id, _ in rows:
+            op.add(actor_id, 'available', deltas[(actor_id, product_id)], product_id, None)
+
+    empty = [row_id for row_id, _, _, quantity in rows if quantity == 0]
+    if empty:
+        Inventory.objects.filter(id__in=empty, quantity=0).delete()
+    _publish_inventory({(actor_id, product_id): quantity for _, actor_id, product_id, quantity in rows})
+    return missing
+
+
+@transaction.atomic(savepoint=False)
+def bulk_change_wallet(deltas, strict=True):
+    """Применяет изменения {(actor_id, currency_id): delta} одним запросом; strict — как у инвентаря"""
+    rows, missing = _bulk_change(_BULK_CHANGE_WALLET, deltas, money=True)
+    if missing and compact_wallets(missing):
+        # Полосы слиты в полосу 0 — ещё одна попытка для не прошедших списаний
+        retried, missing = _bulk_change(_BULK_CHANGE_WALLET, {key: deltas[key] for key in missing}, money=True)
+        rows += retried
+    if missing and strict:
+        actor_id, _ = missing[0]
+        raise ValueError(f"Недостаточно средств у актора {actor_id}: {deltas[missing[0]]}")
+    # Вне операции — открытая эмиссия/изъятие без встречной проводки: остаток на clearing
+    with ledger.operation('change', clearing=True) as op:
+        for _, actor_id, currency_id, _ in rows:
+            op.add(actor_id, 'available', deltas[(actor_id, currency_id)], None, currency_id)
+
+    _publish_wallets({(actor_id, currency_id): amount for _, actor_id, currency_id, amount in rows})
+    return missing
+
+
+@transaction.atomic
+def bulk_freeze_inventory(entries):
+    """
+    Замораживает предметы под набор лотов.
+    entries — список (actor, product_id, quantity, escrow: EscrowRef, lot_id).
+    Записи, на которые не хватает инвентаря, пропускаются; возвращает их индексы.
+    """
+    rows = _lock_inventory({(actor.id, product_id) for actor, product_id, *_ in entries if not actor.is_system})
+    quantities = {key: row.quantity for key, row in rows.items()}
+
+    failed, frozen = [], []
+    for i, (actor, product_id, quantity, escrow, lot_id) in enumerate(entries):
+        if not actor.is_system:
+            key = (actor.id, product_id)
+            available = quantities.get(key, 0)
+            if available < quantity:
+                failed.append(i)
+                continue
+            quantities[key] = available - quantity
+
+        frozen.append(FrozenInventory(
+            actor_id=actor.id, product_id=product_id, quantity=quantity, lot_id=lot_id,
+            escrow_kind=escrow.kind, escrow_id=escrow.id, reason=str(escrow),
+        ))
+
+    _write_inventory(rows, quantities)
+    FrozenInventory.objects.bulk_create(frozen)
+    with ledger.operation('freeze') as op:
+        skipped = set(failed)
+        for i, (actor, product_id, quantity, escrow, _) in enumerate(entries):
+            if i not in skipped:
+                op.add(*_source_leg(actor, -quantity, product_id, None), reason=str(escrow))
+                op.add(actor.id, 'frozen', quantity, product_id, None, reason=str(escrow))
+    return failed
+
+
+@transaction.atomic
+def bulk_freeze_wallet(entries):
+    """
+    Замораживает деньги под набор лотов.
+    entries — список (actor, currency_id, amount, escrow: EscrowRef, lot_id).
+    Записи, на которые не хватает средств, пропускаются; возвращает их индексы.
+    """
+    keys = {(actor.id, currency_id) for actor, currency_id, *_ in entries if not actor.is_system}
+    # Списание идёт из полосы 0: полосатые кошельки сначала сливаются
+    compact_wallets({(actor.id, currency_id) for actor, currency_id, *_ in entries
+                     if not actor.is_system and actor.wallet_stripes > 1})
+    rows = _lock_wallets(keys)
+    amounts = {key: row.amount for key, row in rows.items()}
+
+    failed, frozen = [], []
+    for i, (actor, currency_id, amount, escrow, lot_id) in enumerate(entries):
+        if not actor.is_system:
+            key = (actor.id, currency_id)
+            available = amounts.get(key, 0)
+            if available < amount:
+                failed.append(i)
+                continue
+            amounts[key] = available - amount
+
+        frozen.append(FrozenWallet(
+            actor_id=actor.id, currency_id=currency_id, amount=amount, lot_id=lot_id,
+            escrow_kind=escrow.kind, escrow_id=escrow.id, reason=str(escrow),
+        ))
+
+    _write_wallets(rows, amounts)
+    FrozenWallet.objects.bulk_create(frozen)
+    with ledger.operation('freeze') as op:
+        skipped = set(failed)
+        for i, (actor, currency_id, amount, escrow, _) in enumerate(entries):
+            if i not in skipped:
+                op.add(*_source_leg(actor, -amount, None, currency_id), reason=str(escrow))
+                op.add(actor.id, 'frozen', amount, None, currency_id, reason=str(escrow))
+    return failed
+
+
+def _bulk_consume_sql(table, asset, column, value_type):
+    """
+    Списание escrow по лотам из unnest: уменьшение или удаление опустевшей строки.
+    Строки ищутся по индексу (escrow_kind, escrow_id) — один запрос на все лоты.
+    Возвращает (lot_id, actor_id, asset, value) списанного.
+    """
+    return f"""
+        WITH consumed(lot_id, value) AS (
+            SELECT * FROM unnest(%s::bigint[], %s::{value_type}[])
+        ), updated AS (
+            UPDATE {table} AS t SET {column} = t.{column} - consumed.value
+            FROM consumed
+            WHERE t.escrow_kind = '{LOT}' AND t.escrow_id = consumed.lot_id AND t.{column} > consumed.value
+            RETURNING consumed.lot_id, t.actor_id, t.{asset}, consumed.value
+        ), deleted AS (
+            DELETE FROM {table} AS t
+            USING consumed
+            WHERE t.escrow_kind = '{LOT}' AND t.escrow_id = consumed.lot_id AND t.{column} = consumed.value
+            RETURNING consumed.lot_id, t.actor_id, t.{asset}, consumed.value
+        )
+        SELECT * FROM updated UNION ALL SELECT * FROM deleted
+    """
+
+
+_BULK_CONSUME_INVENTORY = _bulk_consume_sql(FROZEN_INVENTORY, 'product_id', 'quantity', 'bigint')
+_BULK_CONSUME_WALLET = _bulk_consume_sql(FROZEN_WALLET, 'currency_id', 'amount', 'bigint')
+
+
+def _bulk_consume(sql, values, money=False):
+    if not values:
+        return []
+    lot_ids = list(values)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [lot_ids, [to_minor(values[lot_id]) if money else values[lot_id] for lot_id in lot_ids]])
+        rows = cursor.fetchall()
+    if money:
+        rows = [(*row[:3], Money.from_minor(row[3])) for row in rows]
+    missing = set(lot_ids) - {row[0] for row in rows}
+    if missing:
+        raise ValueError(f"Недостаточно заморожено под лот {min(missing)}")
+    return rows
+
 
-    obj, created = Wallet.objects.get_or_create(actor=actor, currency=currency, defaults={'amount': 0})
-    obj.amount += amount_delta
+@transaction.atomic(savepoint=False)
+def bulk_consume_frozen_inventory(quantities):
+    """Списывает исполненный escrow предметов {lot_id: quantity} без возврата в инвентарь"""
+    rows = _bulk_consume(_BULK_CONSUME_INVENTORY, quantities)
+    with ledger.operation('consume') as op:
+        for lot_id, actor_id, product_id, quantity in rows:
+            op.add(actor_id, 'frozen', -quantity, product_id, None, reason=str(EscrowRef.lot(lot_id)))
 
-    if obj.amount < 0:
-        obj.amount = 0
 
-    obj.save()
-    return {'status': 'ok', 'amount': obj.amount}
\ No newline at end of file
+@transaction.atomic(savepoint=False)
+def bulk_consume_frozen_wallet(amounts):
+    """Списывает исполненный escrow денег {lot_id: amount} без возврата в кошелёк"""
+    rows = _bulk_consume(_BULK_CONSUME_WALLET, amounts, money=True)
+    with ledger.operation('consume') as op:
+        for lot_id, actor_id, currency_id, amount in rows:
+            op.add(actor_id, 'frozen', -amount, None, currency_id, reason=str(EscrowRef.lot(lot_id)))
@@ -0,0 +1,130 @@
+# wallet_inventory/valuation.py
+"""
+Оценка портфелей в базовой валюте.
+
+Деньги пересчитываются по Currency.exchange_rate, предметы (свободные и в
+escrow) — по Product.price в валюте продукта. Всё считается одним
+агрегирующим SQL-запросом; предметы без цены или валюты не оцениваются и
+возвращаются количеством в unpriced_items.
+
+Оценка актора кэшируется до изменения его балансов: журнал (ledger) после
+коммита сбрасывает ключи акторов операции. Смена цен и курсов сбрасывает
+все оценки разом через поколение ключей.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+
+from actors.models import Actor
+from economy.models import Currency
+from eve_backend.money import MINOR_SCALE
+from products.models import Product
+from .models import FrozenInventory, FrozenWallet, Inventory, Wallet
+
+_GENERATION_KEY = 'valuation:generation'
+
+_HOLDINGS = f"""
+    SELECT w.actor_id, 'cash' AS bucket, w.amount::numeric / {MINOR_SCALE} * c.exchange_rate AS value,
+           0 AS unpriced
+    FROM {Wallet._meta.db_table} w
+    JOIN {Currency._meta.db_table} c ON c.id = w.currency_id
+    {{where_w}}
+    UNION ALL
+    SELECT w.actor_id, 'frozen_cash', w.amount::numeric / {MINOR_SCALE} * c.exchange_rate, 0
+    FROM {FrozenWallet._meta.db_table} w
+    JOIN {Currency._meta.db_table} c ON c.id = w.currency_id
+    {{where_w}}
+    UNION ALL
+    SELECT i.actor_id, 'items', i.quantity * p.price * c.exchange_rate,
+           CASE WHEN p.price IS NULL OR c.id IS NULL THEN i.quantity ELSE 0 END
+    FROM {Inventory._meta.db_table} i
+    JOIN {Product._meta.db_table} p ON p.id = i.product_id
+    LEFT JOIN {Currency._meta.db_table} c ON c.id = p.currency_id
+    {{where_i}}
+    UNION ALL
+    SELECT i.actor_id, 'frozen_items', i.quantity * p.price * c.exchange_rate,
+           CASE WHEN p.price IS NULL OR c.id IS NULL THEN i.quantity ELSE 0 END
+    FROM {FrozenInventory._meta.db_table} i
+    JOIN {Product._meta.db_table} p ON p.id = i.product_id
+    LEFT JOIN {Currency._meta.db_table} c ON c.id = p.currency_id
+    {{where_i}}
+"""
+
+_AGGREGATE = """
+    SELECT h.actor_id, a.name,
+           ROUND(COALESCE(SUM(h.value) FILTER (WHERE h.bucket = 'cash'), 0), 2),
+           ROUND(COALESCE(SUM(h.value) FILTER (WHERE h.bucket = 'frozen_cash'), 0), 2),
+           ROUND(COALESCE(SUM(h.value) FILTER (WHERE h.bucket = 'items'), 0), 2),
+           ROUND(COALESCE(SUM(h.value) FILTER (WHERE h.bucket = 'frozen_items'), 0), 2),
+           ROUND(COALESCE(SUM(h.value), 0), 2) AS total,
+           SUM(h.unpriced)
+    FROM ({holdings}) h
+    JOIN {actors} a ON a.id = h.actor_id
+    {where}
+    GROUP BY h.actor_id, a.name
+"""
+
+_ACTOR_SQL = _AGGREGATE.format(
+    holdings=_HOLDINGS.format(where_w="WHERE w.actor_id = %(actor)s", where_i="WHERE i.actor_id = %(actor)s"),
+    actors=Actor._meta.db_table,
+    where="",
+)
+_LEADERBOARD_SQL = _AGGREGATE.format(
+    holdings=_HOLDINGS.format(where_w="", where_i=""),
+    actors=Actor._meta.db_table,
+    where="WHERE %(type)s::varchar IS NULL OR a.type = %(type)s",
+) + " ORDER BY total DESC, h.actor_id LIMIT %(limit)s"
+
+_FIELDS = ('cash', 'frozen_cash', 'items', 'frozen_items', 'total', 'unpriced_items')
+
+
+def _row(actor_id, name, *values):
+    return {"actor_id": actor_id, "actor_name": name, **dict(zip(_FIELDS, values))}
+
+
+def _generation():
+    return cache.get(_GENERATION_KEY, 0)
+
+
+def _actor_key(generation, actor_id):
+    return f"valuation:{generation}:actor:{actor_id}"
+
+
+def actor_valuation(actor):
+    """Оценка одного актора (из кэша или одним запросом)"""
+    key = _actor_key(_generation(), actor.id)
+    valuation = cache.get(key)
+    if valuation is None:
+        with connection.cursor() as cursor:
+            cursor.execute(_ACTOR_SQL, {'actor': actor.id})
+            row = cursor.fetchone()
+        valuation = _row(*row) if row else _row(actor.id, actor.name, *(0,) * len(_FIELDS))
+        cache.set(key, valuation, timeout=settings.VALUATION_CACHE_TTL)
+    return valuation
+
+
+def leaderboard(limit, actor_type=None):
+    """Топ акторов по оценке; кэшируется на VALUATION_LEADERBOARD_TTL"""
+    key = f"valuation:{_generation()}:leaderboard:{actor_type or ''}:{limit}"
+    rows = cache.get(key)
+    if rows is None:
+        with connection.cursor() as cursor:
+            cursor.execute(_LEADERBOARD_SQL, {'type': actor_type, 'limit': limit})
+            rows = [_row(*row) for row in cursor.fetchall()]
+        cache.set(key, rows, timeout=settings.VALUATION_LEADERBOARD_TTL)
+    return rows
+
+
+def invalidate(actor_ids):
+    """Сбрасывает оценки акторов после коммита текущей транзакции"""
+    actor_ids = {actor_id for actor_id in actor_ids if actor_id is not None}
+    if actor_ids:
+        transaction.on_commit(lambda: cache.delete_many(
+            [_actor_key(_generation(), actor_id) for actor_id in actor_ids]
+        ))
+
+
+def invalidate_all():
+    """Смена цен или курсов: новое поколение ключей, старые истекут сами"""
+    transaction.on_commit(lambda: cache.set(_GENERATION_KEY, _generation() + 1, timeout=None))
@@ -1,21 +1,34 @@
 # wallet_inventory/views.py
+from collections import defaultdict
+
+from django.conf import settings
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from rest_framework import permissions
 from rest_framework import status
 from rest_framework.exceptions import NotFound
+from rest_framework.parsers import JSONParser
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from accounts.idempotency import idempotent
+from eve_backend.money import Money
 from actors.models import Actor
 from economy.models import Currency, MarketLot
 from products.models import Product
+from . import batch, valuation
+from .checkpoints import balance_at
+from .escrow import EscrowRef
 from .models import Inventory, Wallet, FrozenWallet, FrozenInventory
+from .parsers import NDJSONParser
+from .portfolio import actor_portfolio
 from .serializers import InventoryUpdateSerializer, WalletUpdateSerializer, InventoryItemSerializer, \
     WalletItemSerializer, FrozenWalletItemSerializer, FrozenInventoryItemSerializer, FreezeInventoryResponseSerializer, \
-    FreezeWalletResponseSerializer
+    FreezeWalletResponseSerializer, ActorPortfolioSerializer, ActorValuationSerializer
 from .utils import unfreeze_wallet, freeze_wallet, unfreeze_inventory, freeze_inventory, change_inventory_quantity, \
-    change_wallet_amount
+    change_wallet_amount, merge_stripes
 
 
 class InternalPermission(permissions.BasePermission):
@@ -37,7 +50,10 @@ class InventoryUpdateView(APIView):
         product = Product.objects.get(id=serializer.validated_data['product_id'])
         quantity = serializer.validated_data['quantity']
 
-        result = change_inventory_quantity(actor, product, quantity)
+        try:
+            result = change_inventory_quantity(actor, product, quantity)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=400)
 
         if result['status'] == 'deleted':
             return Response({'status': 'deleted'}, status=200)
@@ -55,10 +71,53 @@ class WalletUpdateView(APIView):
         currency = Currency.objects.get(id=serializer.validated_data['currency_id'])
         amount = serializer.validated_data['amount']
 
-        result = change_wallet_amount(actor, currency, amount)
+        try:
+            result = change_wallet_amount(actor, currency, amount)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=400)
         return Response(result, status=200)
 
 
+class BatchUpdateView(APIView):
+    """
+    Пакет изменений инвентаря и кошельков: JSON-массив или NDJSON-поток строк
+    {"actor_id", "product_id", "quantity"} / {"actor_id", "currency_id", "amount"}.
+    ?mode=atomic (по умолчанию) — всё или ничего; ?mode=partial — применяются
+    корректные строки, ошибочные возвращаются в errors с индексом строки.
+    """
+    permission_classes = [InternalPermission]
+    parser_classes = [JSONParser, NDJSONParser]
+
+    @idempotent
+    def post(self, request):
+        mode = request.query_params.get('mode', batch.ATOMIC)
+        if mode not in batch.MODES:
+            return Response({'error': 'mode: atomic или partial'}, status=400)
+
+        rows = request.data
+        if not isinstance(rows, list):
+            return Response({'error': 'Ожидается массив строк или NDJSON'}, status=400)
+        if len(rows) > settings.BATCH_UPDATE_MAX_ROWS:
+            return Response({'error': f'Не больше {settings.BATCH_UPDATE_MAX_ROWS} строк в пакете'}, status=400)
+
+        valid, errors = batch.validate(rows)
+        if errors and mode == batch.ATOMIC:
+            return Response({'error': 'Пакет не применён', 'errors': errors}, status=400)
+
+        try:
+            errors += batch.apply(valid, mode)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=400)
+
+        errors.sort(key=lambda error: error['index'])
+        return Response({
+            'mode': mode,
+            'applied': len(rows) - len(errors),
+            'failed': len(errors),
+            'errors': errors,
+        }, status=200)
+
+
 class ActorInventoryView(APIView):
     serializer_class = InventoryItemSerializer
     permission_classes = [IsAuthenticated]  # или можно AllowAny, если публично
@@ -97,7 +156,8 @@ class ActorWalletView(APIView):
         # if actor.user != request.user and request.user.role != 'master':
         #     raise PermissionDenied()
 
-        wallets = Wallet.objects.filter(actor=actor).select_related('currency')
+        # Кошелёк горячего актора может быть разбит на полосы — показываем сумму
+        wallets = merge_stripes(Wallet.objects.filter(actor=actor).select_related('currency').order_by('id'))
         serializer = WalletItemSerializer(wallets, many=True)
         return Response({
             "actor_id": actor.id,
@@ -154,10 +214,128 @@ class ActorFrozenInventoryView(APIView):
         })
 
 
+class ActorPortfolioView(APIView):
+    """
+    Кошелёк, инвентарь и оба escrow актора одним ответом — вместо четырёх
+    вызовов. Два запроса: актор и один UNION ALL по четырём таблицам.
+    """
+    serializer_class = ActorPortfolioSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, actor_id):
+        actor = Actor.objects.only('id', 'name', 'user_id').filter(id=actor_id).first()
+        if actor is None:
+            raise NotFound("Актёр не найден")
+
+        # Сравнение по user_id — без лишнего запроса за пользователем
+        if request.user.role == 'player' and actor.user_id != request.user.id:
+            return Response({"error": "Нет доступа"}, status=403)
+
+        return Response(ActorPortfolioSerializer({
+            "actor_id": actor.id,
+            "actor_name": actor.name,
+            **actor_portfolio(actor),
+        }).data)
+
+
+class ActorValuationView(APIView):
+    """
+    Оценка актора в базовой валюте: кошелёк и escrow по курсу валюты,
+    инвентарь и escrow по Product.price. Один агрегирующий запрос,
+    результат кэшируется до изменения балансов актора.
+    """
+    serializer_class = ActorValuationSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, actor_id):
+        actor = Actor.objects.only('id', 'name', 'user_id').filter(id=actor_id).first()
+        if actor is None:
+            raise NotFound("Актёр не найден")
+
+        if request.user.role == 'player' and actor.user_id != request.user.id:
+            return Response({"error": "Нет доступа"}, status=403)
+
+        return Response(ActorValuationSerializer(valuation.actor_valuation(actor)).data)
+
+
+class ValuationLeaderboardView(APIView):
+    """
+    Лидерборд мастера: акторы по убыванию оценки (?limit=, ?type= — тип актора).
+    Один запрос на все акторы, ответ кэшируется на VALUATION_LEADERBOARD_TTL.
+    """
+    serializer_class = ActorValuationSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        if request.user.role != 'master':
+            return Response({"error": "Только мастер может смотреть лидерборд"}, status=403)
+
+        try:
+            limit = int(request.query_params.get('limit', 50))
+        except ValueError:
+            return Response({"error": "limit должен быть целым"}, status=400)
+        if not 1 <= limit <= 1000:
+            return Response({"error": "limit: от 1 до 1000"}, status=400)
+
+        rows = valuation.leaderboard(limit, request.query_params.get('type') or None)
+        return Response(ActorValuationSerializer(rows, many=True).data)
+
+
+class ActorBalanceAtView(APIView):
+    """
+    Остатки актора на момент ts (ISO 8601): ближайший снимок BalanceCheckpoint
+    плюс проводки журнала между снимком и ts, без пересчёта всей истории.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, actor_id):
+        try:
+            actor = Actor.objects.get(id=actor_id)
+        except Actor.DoesNotExist:
+            raise NotFound("Актёр не найден")
+
+        if request.user.role == 'player' and actor.user != request.user:
+            return Response({"error": "Нет доступа"}, status=403)
+
+        ts = parse_datetime(request.query_params.get('ts', ''))
+        if ts is None:
+            return Response({"error": "ts обязателен, формат ISO 8601"}, status=400)
+        if timezone.is_naive(ts):
+            ts = timezone.make_aware(ts)
+
+        amounts, checkpoint = balance_at(actor.id, ts)
+        wallet, inventory = defaultdict(dict), defaultdict(dict)
+        for (account, product_id, currency_id), amount in amounts.items():
+            if product_id:
+                inventory[product_id][account] = int(amount)
+            else:
+                wallet[currency_id][account] = amount
+
+        return Response({
+            "actor_id": actor.id,
+            "ts": ts,
+            "checkpoint": checkpoint,
+            "wallet": [
+                {"currency_id": currency_id, "amount": a.get('available', 0), "frozen": a.get('frozen', 0)}
+                for currency_id, a in sorted(wallet.items())
+            ],
+            "inventory": [
+                {"product_id": product_id, "quantity": a.get('available', 0), "frozen": a.get('frozen', 0)}
+                for product_id, a in sorted(inventory.items())
+            ],
+        })
+
+
+# Escrow лотов и передач ("lot:42", "transfer:7") ведут сами лоты и передачи:
+# ручная разморозка такого escrow оставила бы активный лот без обеспечения
+TYPED_REASON_ERROR = 'reason вида "lot:N" или "transfer:N" зарезервирован за лотами и передачами'
+
+
 class FreezeInventoryView(APIView):
     permission_classes = [InternalPermission]
     serializer_class = FreezeInventoryResponseSerializer  # только для Swagger
 
+    @idempotent
     def post(self, request):
         actor_id = request.data.get('actor_id')
         product_id = request.data.get('product_id')
@@ -167,6 +345,8 @@ class FreezeInventoryView(APIView):
 
         if not all([actor_id, product_id]):
             return Response({'error': 'actor_id и product_id обязательны'}, status=400)
+        if EscrowRef.of(reason).typed:
+            return Response({'error': TYPED_REASON_ERROR}, status=400)
 
         try:
             quantity = int(quantity)
@@ -184,7 +364,7 @@ class FreezeInventoryView(APIView):
                 actor=actor,
                 product=product,
                 quantity=quantity,
-                reason=reason,
+                escrow=reason,
                 lot=lot
             )
 
@@ -205,6 +385,7 @@ class FreezeWalletView(APIView):
     permission_classes = [InternalPermission]
     serializer_class = FreezeWalletResponseSerializer
 
+    @idempotent
     def post(self, request):
         actor_id = request.data.get('actor_id')
         currency_id = request.data.get('currency_id')
@@ -214,13 +395,16 @@ class FreezeWalletView(APIView):
 
         if not all([actor_id, currency_id, amount]):
             return Response({'error': 'actor_id, currency_id, amount обязательны'}, status=400)
+        if EscrowRef.of(reason).typed:
+            return Response({'error': TYPED_REASON_ERROR}, status=400)
 
         try:
-            amount = float(amount)
+            # JSON-число приходит float-ом: через str, без двоичного округления
+            amount = Money(str(amount))
             if amount <= 0:
                 raise ValueError("amount должен быть > 0")
         except (ValueError, TypeError):
-            return Response({'error': 'amount должен быть положительным'}, status=400)
+            return Response({'error': 'amount должен быть положительным, не больше 2 знаков после запятой'}, status=400)
 
         try:
             actor = get_object_or_404(Actor, id=actor_id)
@@ -231,14 +415,14 @@ class FreezeWalletView(APIView):
                 actor=actor,
                 currency=currency,
                 amount=amount,
-                reason=reason,
+                escrow=reason,
                 lot=lot
             )
 
             return Response({
                 'status': 'frozen',
                 'frozen_id': frozen.id,
-                'amount': float(frozen.amount),
+                'amount': str(frozen.amount),
                 'lot_id': frozen.lot.id if frozen.lot else None,
                 'reason': reason
             })
@@ -250,6 +434,7 @@ class FreezeWalletView(APIView):
 class UnfreezeInventoryView(APIView):
     permission_classes = [InternalPermission]
 
+    @idempotent
     def post(self, request):
         actor_id = request.data.get('actor_id')
         product_id = request.data.get('product_id')
@@ -258,6 +443,8 @@ class UnfreezeInventoryView(APIView):
 
         if not all([actor_id, product_id, quantity]):
             return Response({'error': 'actor_id, product_id и quantity обязательны'}, status=status.HTTP_400_BAD_REQUEST)
+        if EscrowRef.of(reason).typed:
+            return Response({'error': TYPED_REASON_ERROR}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
             quantity = int(quantity)
@@ -270,7 +457,7 @@ class UnfreezeInventoryView(APIView):
             actor = get_object_or_404(Actor, id=actor_id)
             product = get_object_or_404(Product, id=product_id)
 
-            unfreeze_inventory(actor=actor, product=product, quantity=quantity, reason=reason)
+            unfreeze_inventory(actor=actor, product=product, quantity=quantity, escrow=reason)
 
             return Response({
                 'status': 'unfrozen',
@@ -286,6 +473,7 @@ class UnfreezeInventoryView(APIView):
 class UnfreezeWalletView(APIView):
     permission_classes = [InternalPermission]
 
+    @idempotent
     def post(self, request):
         actor_id = request.data.get('actor_id')
         currency_id = request.data.get('currency_id')
@@ -294,23 +482,26 @@ class UnfreezeWalletView(APIView):
 
         if not all([actor_id, currency_id, amount]):
             return Response({'error': 'actor_id, currency_id и amount обязательны'}, status=status.HTTP_400_BAD_REQUEST)
+        if EscrowRef.of(reason).typed:
+            return Response({'error': TYPED_REASON_ERROR}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
-            amount = float(amount)
+            amount = Money(str(amount))
             if amount <= 0:
                 raise ValueError("amount должен быть положительным")
         except (ValueError, TypeError):
-            return Response({'error': 'amount должен быть положительным числом'}, status=status.HTTP_400_BAD_REQUEST)
+            return Response({'error': 'amount должен быть положительным числом, не больше 2 знаков после запятой'},
+                            status=status.HTTP_400_BAD_REQUEST)
 
         try:
             actor = get_object_or_404(Actor, id=actor_id)
             currency = get_object_or_404(Currency, id=currency_id)
 
-            unfreeze_wallet(actor=actor, currency=currency, amount=amount, reason=reason)
+            unfreeze_wallet(actor=actor, currency=currency, amount=amount, escrow=reason)
 
             return Response({
                 'status': 'unfrozen',
-                'amount': amount,
+                'amount': str(amount),
                 'currency_id': currency.id,
                 'reason': reason
             }, status=status.HTTP_200_OK)